@@ -22,6 +22,15 @@ setup(
         , "pytest==5.3.1"
         , "alt-pytest-asyncio==0.5.1"
         ]
+      , "orjson":
+        [ "orjson"
+        ]
+      , "msgpack":
+        [ "msgpack"
+        ]
+      , "cbor":
+        [ "cbor2"
+        ]
       , "peer":
         [ "tornado==5.1.1"
         , "delfick_project==0.5"
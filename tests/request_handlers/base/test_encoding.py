@@ -0,0 +1,269 @@
+# coding: spec
+
+from whirlwind.request_handlers.encoding import (
+    JsonEncoder,
+    OrjsonEncoder,
+    MsgpackEncoder,
+    CborEncoder,
+    MissingEncoderLibrary,
+    Offload,
+    estimate_size,
+    default_offload,
+)
+from whirlwind.request_handlers.base import Simple, reprer
+
+from tornado.testing import AsyncHTTPTestCase
+from unittest import mock
+import tornado
+import pytest
+import threading
+import json
+import sys
+
+
+class Other:
+    def __repr__(s):
+        return "<<<OTHER>>>"
+
+
+describe "JsonEncoder":
+    it "is pretty by default":
+        encoder = JsonEncoder()
+        assert encoder.dumps({"b": 1, "a": Other()}, reprer) == (
+            '{\n    "a": "<<<OTHER>>>",\n    "b": 1\n}'
+        )
+        assert encoder.dumps({"b": 1, "a": 2}, reprer, pretty=False) == '{"b": 1, "a": 2}'
+
+    it "can be compact":
+        encoder = JsonEncoder(compact=True)
+        assert encoder.dumps({"b": 1, "a": [Other()]}, reprer) == '{"b":1,"a":["<<<OTHER>>>"]}'
+        assert encoder.dumpb({"b": 1}, reprer) == b'{"b":1}'
+
+describe "Binary encoders":
+    it "complains if the library isn't installed":
+        for Encoder, library in ((MsgpackEncoder, "msgpack"), (CborEncoder, "cbor2")):
+            with mock.patch.dict(sys.modules, {library: None}):
+                with pytest.raises(MissingEncoderLibrary):
+                    Encoder()
+
+    it "keeps bytes and uses the reprer for everything else":
+        for Encoder, library in ((MsgpackEncoder, "msgpack"), (CborEncoder, "cbor2")):
+            pytest.importorskip(library)
+            encoder = Encoder()
+            assert encoder.binary
+
+            obj = {"one": b"\x00\x01", "two": [Other(), 2]}
+            assert encoder.loads(encoder.dumpb(obj, reprer)) == {
+                "one": b"\x00\x01",
+                "two": ["<<<OTHER>>>", 2],
+            }
+
+            with pytest.raises(ValueError):
+                encoder.loads(b"\xc1")
+
+describe "Encoding in parts":
+
+    def encoders(self):
+        yield JsonEncoder()
+        yield JsonEncoder(compact=True)
+        try:
+            yield OrjsonEncoder()
+        except MissingEncoderLibrary:
+            return
+        else:
+            yield OrjsonEncoder(compact=True)
+
+    it "yields the same json as dumps":
+        for encoder in self.encoders():
+            for obj in ([], [1], [{"b": [1, 2], "a": Other()}, "two", [3]], {"a": [1]}, "one"):
+                for pretty in (True, False):
+                    parts = list(encoder.iterencode(obj, reprer, pretty=pretty))
+                    assert "".join(parts) == encoder.dumps(obj, reprer, pretty=pretty)
+
+    it "yields each item of a list on its own":
+        parts = list(JsonEncoder(compact=True).iterencode([1, {"a": 2}], reprer))
+        assert parts == ["[", "1", ",", '{"a":2}', "]"]
+
+    async it "can encode an async iterator":
+
+        async def items(*values):
+            for value in values:
+                yield value
+
+        for encoder in self.encoders():
+            for obj in ([], [1], [{"b": [1, 2], "a": Other()}, "two", [3]]):
+                parts = [part async for part in encoder.aiterencode(items(*obj), reprer)]
+                assert "".join(parts) == encoder.dumps(obj, reprer)
+
+describe "OrjsonEncoder":
+    it "complains if orjson isn't installed":
+        with mock.patch.dict(sys.modules, {"orjson": None}):
+            with pytest.raises(MissingEncoderLibrary):
+                OrjsonEncoder()
+
+    it "encodes with orjson":
+        pytest.importorskip("orjson")
+        encoder = OrjsonEncoder(compact=True)
+        assert encoder.dumps({"b": 1, 2: [Other()]}, reprer) == '{"b":1,"2":["<<<OTHER>>>"]}'
+
+describe "Offload":
+    it "estimates the size of json":
+        obj = {"one": [1, 2, "three"], "two": {"four": None}}
+        assert len(json.dumps(obj)) <= estimate_size(obj, 1000) < len(json.dumps(obj)) * 2
+
+        # It stops once it knows the size is over the limit
+        big = {"items": [{"name": "a" * 50} for _ in range(1000)]}
+        assert 100 < estimate_size(big, 100) < len(json.dumps(big)) / 10
+
+    it "only offloads things over the threshold":
+        offload = Offload(threshold=20)
+        assert not offload.should_offload_body("[1, 2]")
+        assert offload.should_offload_body(b"[1, 2, 3, 4, 5, 6, 7, 8]")
+        assert not offload.should_offload_reply([1])
+        assert offload.should_offload_reply({"one": "two three four five"})
+        assert not offload.should_offload_reply("two three four five six")
+
+        offload = Offload(threshold=None)
+        assert not offload.should_offload_body("a" * 10000)
+        assert not offload.should_offload_reply(["a" * 10000])
+
+    it "doesn't offload anything by default":
+        assert Simple.offload is default_offload
+        assert not default_offload.should_offload_body("a" * 10 * 1024 * 1024)
+        assert not default_offload.should_offload_reply(["a" * 10 * 1024 * 1024])
+
+    async it "runs functions on the thread pool":
+        offload = Offload(max_workers=1)
+        try:
+            assert await offload.run(lambda a: (a, threading.current_thread().name), 1) == (
+                1,
+                "whirlwind-json_0",
+            )
+        finally:
+            offload.shutdown()
+
+describe AsyncHTTPTestCase, "Handlers with an encoder":
+
+    def get_app(self):
+        class Handler(Simple):
+            encoder = JsonEncoder(compact=True)
+
+            async def do_get(s):
+                return {"one": Other(), "two": 2}
+
+        return tornado.web.Application([("/", Handler)])
+
+    it "encodes the reply once with the encoder":
+        response = self.fetch("/")
+        assert response.code == 200
+        assert response.body == b'{"one":"<<<OTHER>>>","two":2}'
+
+describe AsyncHTTPTestCase, "Handlers streaming replies":
+
+    def get_app(self):
+        self.rows = [{"row": i, "other": Other()} for i in range(20)]
+
+        class Handler(Simple):
+            stream_threshold = 10
+            stream_chunk_size = 100
+
+            async def do_get(s):
+                return self.rows
+
+            async def do_put(s):
+                return self.rows[:5]
+
+            async def do_post(s):
+                async def rows():
+                    for row in self.rows:
+                        yield row
+
+                return rows()
+
+        class Broken(Simple):
+            async def do_get(s):
+                async def rows():
+                    raise ValueError("NOPE")
+                    yield
+
+                return rows()
+
+        return tornado.web.Application([("/", Handler), ("/broken", Broken)])
+
+    it "streams lists bigger than the threshold":
+        response = self.fetch("/")
+        assert response.code == 200
+        assert response.headers["Transfer-Encoding"] == "chunked"
+        assert response.body == JsonEncoder().dumpb(self.rows, reprer)
+
+    it "doesn't stream smaller lists":
+        response = self.fetch("/", method="PUT", body=b"")
+        assert response.code == 200
+        assert "Transfer-Encoding" not in response.headers
+        assert response.body == JsonEncoder().dumpb(self.rows[:5], reprer)
+
+    it "streams async iterators":
+        response = self.fetch("/", method="POST", body=b"")
+        assert response.code == 200
+        assert response.body == JsonEncoder().dumpb(self.rows, reprer)
+
+    it "sends an error if the stream fails before anything is sent":
+        response = self.fetch("/broken")
+        assert response.code == 500
+        assert json.loads(response.body.decode())["error_code"] == "InternalServerError"
+
+describe AsyncHTTPTestCase, "Handlers offloading big bodies":
+
+    def get_app(self):
+        self.threads = threads = []
+
+        class Encoder(JsonEncoder):
+            def dumpb(s, obj, default, *, pretty=True):
+                threads.append(("dumpb", threading.current_thread().name))
+                return super().dumpb(obj, default, pretty=pretty)
+
+            def loads(s, data):
+                threads.append(("loads", threading.current_thread().name))
+                return super().loads(data)
+
+        class Handler(Simple):
+            encoder = Encoder()
+            offload = Offload(threshold=200)
+
+            async def do_put(s):
+                return await s.json_body()
+
+            async def do_get(s):
+                return {"data": b"x" * 300}
+
+        self.offload = Handler.offload
+        return tornado.web.Application([("/", Handler)])
+
+    def tearDown(self):
+        super().tearDown()
+        self.offload.shutdown()
+
+    it "does small bodies on the event loop and big ones on the thread pool":
+        for body in ({"hello": "there"}, {"items": list(range(100))}):
+            del self.threads[:]
+            response = self.fetch("/", method="PUT", body=json.dumps(body))
+            assert response.code == 200
+            assert json.loads(response.body.decode()) == body
+
+            assert [kind for kind, _ in self.threads] == ["loads", "dumpb"]
+            names = [name for _, name in self.threads]
+            if len(body) == 1 and "hello" in body:
+                assert names == [threading.current_thread().name] * 2
+            else:
+                assert all(name.startswith("whirlwind-json") for name in names)
+
+    it "doesn't encode bytes on the thread pool if they are sent as multipart":
+        response = self.fetch("/", headers={"Accept": "multipart/mixed"})
+        assert response.code == 200
+        assert response.headers["Content-Type"].startswith("multipart/mixed; boundary=")
+        assert b"x" * 300 in response.body
+        assert self.threads == [("dumpb", threading.current_thread().name)]
+
+    it "complains about invalid json":
+        response = self.fetch("/", method="PUT", body="{" * 300)
+        assert response.code == 400
@@ -0,0 +1,73 @@
+# coding: spec
+
+from whirlwind.request_handlers.base import json_spec
+
+from delfick_project.norms import BadSpecValue, Meta
+import pytest
+
+describe "json_spec":
+    it "returns json values as they are":
+        for val in (
+            None,
+            True,
+            1,
+            1.5,
+            "s",
+            b"bytes",
+            [],
+            {},
+            [1, [2, [3, {"a": [4, {"b": None}]}]], "c"],
+            {"a": {"b": {"c": [{}, []]}}, "d": 1},
+        ):
+            assert json_spec.normalise(Meta.empty(), val) is val
+
+    it "doesn't recurse for deeply nested values":
+        val = []
+        for _ in range(10000):
+            val = [val, {"a": 1}]
+        assert json_spec.normalise(Meta.empty(), val) is val
+
+    it "complains about values that aren't json":
+        for val in (object(), {1, 2}, (1, 2), [1, {"a": [2, object()]}]):
+            with pytest.raises(BadSpecValue, match="Expected a json value"):
+                json_spec.normalise(Meta.empty(), val)
+
+    it "says where the bad value is":
+        with pytest.raises(BadSpecValue) as error:
+            json_spec.normalise(Meta.empty(), {"a": [1, {"b": object()}], "c": 2})
+        assert error.value.kwargs["meta"].path == "a[1].b"
+
+    it "complains about keys that aren't strings":
+        with pytest.raises(BadSpecValue, match="Expected a string") as error:
+            json_spec.normalise(Meta.empty(), {"a": [{"b": 1, 2: 3}]})
+        assert error.value.kwargs["meta"].path == "a[0].2"
+
+    it "allows containers that are shared":
+        shared = {"a": [1, 2]}
+        val = [shared, {"b": shared}, shared]
+        assert json_spec.normalise(Meta.empty(), val) is val
+
+        # Checking shared values doesn't take exponential time
+        val = [1]
+        for _ in range(100):
+            val = [val, val]
+        assert json_spec.normalise(Meta.empty(), val) is val
+
+    it "complains about values that contain themselves":
+        val = {"a": [1, {}]}
+        val["a"][1]["b"] = val["a"]
+        with pytest.raises(BadSpecValue, match="Value contains itself") as error:
+            json_spec.normalise(Meta.empty(), val)
+        assert error.value.kwargs["meta"].path == "a[1].b"
+
+    it "complains about a cyclic cbor body":
+        cbor2 = pytest.importorskip("cbor2")
+        a = []
+        a.append(a)
+        encoded = cbor2.dumps(a, value_sharing=True)
+        assert encoded == bytes.fromhex("d81c81d81d00")
+
+        val = cbor2.loads(encoded)
+        assert val[0] is val
+        with pytest.raises(BadSpecValue, match="Value contains itself"):
+            json_spec.normalise(Meta.empty(), val)
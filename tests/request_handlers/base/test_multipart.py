@@ -0,0 +1,104 @@
+# coding: spec
+
+from whirlwind.request_handlers.multipart import (
+    MultipartParser,
+    BadMultipart,
+    multipart_boundary,
+)
+from whirlwind.request_handlers.uploads import UploadTooBig
+
+import pytest
+
+
+def make_body(boundary, *parts):
+    body = []
+    for headers, data in parts:
+        body.append(f"--{boundary}\r\n{headers}\r\n\r\n".encode() + data + b"\r\n")
+    body.append(f"--{boundary}--\r\n".encode())
+    return b"".join(body)
+
+
+describe "multipart_boundary":
+    it "gets the boundary from a form-data content type":
+        assert multipart_boundary("multipart/form-data; boundary=abc") == b"abc"
+        assert multipart_boundary('multipart/form-data; boundary="a b"') == b"a b"
+        assert multipart_boundary("multipart/form-data") is None
+        assert multipart_boundary("application/json") is None
+
+describe "MultipartParser":
+
+    @pytest.fixture()
+    def body(self):
+        return make_body(
+            "XyZ",
+            (
+                'Content-Disposition: form-data; name="attachment"; filename="thing.txt"\r\nContent-Type: text/plain',
+                b"hello\r\n--XY there" * 10,
+            ),
+            ('Content-Disposition: form-data; name="__body__"', b'{"command": "one"}'),
+            ('Content-Disposition: form-data; name="attachment"; filename="empty"', b""),
+        )
+
+    def check(self, parser):
+        parser.finish()
+
+        first, second = parser.files["attachment"]
+        assert first.filename == "thing.txt"
+        assert first.content_type == "text/plain"
+        assert first.size == 170
+        assert first.file.read() == b"hello\r\n--XY there" * 10
+        assert second.filename == "empty"
+        assert second.read() == b""
+
+        assert parser.arguments == {"__body__": [b'{"command": "one"}']}
+
+    it "parses a body given all at once", body:
+        parser = MultipartParser(b"XyZ", max_size=None, spool_size=10)
+        parser.feed(body)
+        self.check(parser)
+
+    it "parses a body given a byte at a time", body:
+        parser = MultipartParser(b"XyZ", max_size=None, spool_size=10)
+        for i in range(len(body)):
+            parser.feed(body[i : i + 1])
+        self.check(parser)
+
+    it "spools big files to disk", body:
+        parser = MultipartParser(b"XyZ", max_size=None, spool_size=100)
+        parser.feed(body)
+        parser.finish()
+        assert parser.files["attachment"][0].file._rolled
+        assert not parser.files["attachment"][1].file._rolled
+
+    it "complains if the body is too big", body:
+        parser = MultipartParser(b"XyZ", max_size=len(body) - 1, spool_size=10)
+        parser.feed(body[:10])
+        with pytest.raises(UploadTooBig):
+            parser.feed(body[10:])
+
+    it "complains if the body doesn't finish", body:
+        parser = MultipartParser(b"XyZ", max_size=None, spool_size=10)
+        parser.feed(body[:-10])
+        with pytest.raises(BadMultipart):
+            parser.finish()
+
+    it "complains about parts without a name":
+        parser = MultipartParser(b"XyZ", max_size=None, spool_size=10)
+        with pytest.raises(BadMultipart):
+            parser.feed(make_body("XyZ", ("Content-Disposition: form-data", b"stuff")))
+
+    it "complains about headers that aren't utf-8":
+        parser = MultipartParser(b"XyZ", max_size=None, spool_size=10)
+        headers = 'Content-Disposition: form-data; name="\xff"'
+        body = make_body("XyZ", (headers, b"stuff")).replace("\xff".encode(), b"\xff")
+        with pytest.raises(BadMultipart, match="utf-8"):
+            parser.feed(body)
+
+    it "limits the size of parts that aren't files", body:
+        parser = MultipartParser(b"XyZ", max_size=None, spool_size=10, max_field_size=18)
+        parser.feed(body)
+        self.check(parser)
+
+        parser = MultipartParser(b"XyZ", max_size=None, spool_size=10, max_field_size=17)
+        with pytest.raises(UploadTooBig, match="maximum of 17 bytes"):
+            parser.feed(body)
@@ -218,6 +218,71 @@ describe AsyncHTTPTestCase, "Simple without error":
             assert response.body == self.result.encode()
 
 # This is so the send_msg logic in AsyncCatcher works
+describe AsyncHTTPTestCase, "Simple with bytes":
+
+    def get_app(self):
+        self.data = bytes(range(256)) * 4
+
+        class FilledSimple(Simple):
+            async def do_get(s):
+                return self.data
+
+            async def do_put(s):
+                return memoryview(self.data)[:10]
+
+            async def do_post(s):
+                return {"name": "firmware", "data": self.data, "more": [bytearray(b"ab")]}
+
+        return tornado.web.Application([("/", FilledSimple)])
+
+    it "sends bytes as they are":
+        response = self.fetch("/")
+        assert response.code == 200
+        assert response.headers["Content-Type"] == "application/octet-stream"
+        assert response.body == self.data
+
+        response = self.fetch("/", method="PUT", body=b"")
+        assert response.body == self.data[:10]
+
+    it "hexlifies bytes inside json by default":
+        response = self.fetch("/", method="POST", body=b"")
+        assert json.loads(response.body.decode()) == {
+            "name": "firmware",
+            "data": self.data.hex(),
+            "more": [repr(bytearray(b"ab"))],
+        }
+
+    it "sends bytes inside json as multipart if asked to":
+        response = self.fetch(
+            "/", method="POST", body=b"", headers={"Accept": "multipart/mixed, application/json"}
+        )
+        assert response.code == 200
+
+        content_type = response.headers["Content-Type"]
+        assert content_type.startswith("multipart/mixed; boundary=")
+        boundary = content_type.split("boundary=")[1].encode()
+
+        parts = response.body.split(b"--" + boundary)
+        assert parts[0] == b""
+        assert parts[-1] == b"--\r\n"
+
+        found = []
+        for part in parts[1:-1]:
+            headers, body = part.split(b"\r\n\r\n", 1)
+            found.append((headers.strip().split(b"\r\n"), body[:-2]))
+
+        assert found[0][0] == [b"Content-Type: application/json; charset=UTF-8"]
+        assert json.loads(found[0][1].decode()) == {
+            "name": "firmware",
+            "data": {"__binary__": 0},
+            "more": [{"__binary__": 1}],
+        }
+        assert found[1] == (
+            [b"Content-Type: application/octet-stream", b"Content-ID: 0"],
+            self.data,
+        )
+        assert found[2] == ([b"Content-Type: application/octet-stream", b"Content-ID: 1"], b"ab")
+
 describe AsyncHTTPTestCase, "no ws_connection object":
 
     def get_app(self):
@@ -347,3 +412,70 @@ describe AsyncHTTPTestCase, "Simple with error":
             self.assert_correct_response(
                 response, status=501, body={"status": 501, "reason": self.reason}
             )
+
+describe "Simple when the client disconnects":
+
+    async def disconnect(self, server_wrapper, Handler):
+        started = asyncio.Future()
+        finished = asyncio.Future()
+
+        class H(Handler):
+            async def do_get(s):
+                started.set_result(True)
+                try:
+                    await asyncio.sleep(0.3)
+                except asyncio.CancelledError:
+                    finished.set_result("cancelled")
+                    raise
+                finished.set_result("finished")
+                return {"done": True}
+
+        async with server_wrapper(None, lambda server: [("/slow", H)]) as server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.runner.port)
+            writer.write(b"GET /slow HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            await started
+            writer.close()
+            return await finished
+
+    async it "cancels the request", server_wrapper:
+        cancelled = []
+
+        class Handler(Simple):
+            def request_cancelled_on_disconnect(s):
+                cancelled.append(s.request.path)
+
+        assert await self.disconnect(server_wrapper, Handler) == "cancelled"
+        assert cancelled == ["/slow"]
+
+    async it "can let the request finish", server_wrapper:
+
+        class Handler(Simple):
+            cancel_on_disconnect = False
+
+        assert await self.disconnect(server_wrapper, Handler) == "finished"
+
+    async it "cancels a reply that is being streamed", server_wrapper:
+        started = asyncio.Future()
+        finished = asyncio.Future()
+
+        class H(Simple):
+            async def do_get(s):
+                async def items():
+                    yield 1
+                    started.set_result(True)
+                    try:
+                        await asyncio.sleep(0.3)
+                    except asyncio.CancelledError:
+                        finished.set_result("cancelled")
+                        raise
+                    finished.set_result("finished")
+                    yield 2
+
+                return items()
+
+        async with server_wrapper(None, lambda server: [("/slow", H)]) as server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.runner.port)
+            writer.write(b"GET /slow HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            await started
+            writer.close()
+            assert await finished == "cancelled"
@@ -0,0 +1,79 @@
+# coding: spec
+
+from whirlwind.request_handlers.uploads import (
+    Upload,
+    UploadTooBig,
+    UploadInterrupted,
+    upload_frame,
+    parse_upload_frame,
+)
+
+import asyncio
+import pytest
+
+describe "upload frames":
+    it "puts the message_id before the data":
+        frame = upload_frame("☃", b"data")
+        assert frame == b"\x00\x03" + "☃".encode() + b"data"
+
+        message_id, data = parse_upload_frame(frame)
+        assert message_id == "☃"
+        assert bytes(data) == b"data"
+
+    it "complains about frames that are too short":
+        for frame in (b"", b"\x00", b"\x00\x05abc"):
+            with pytest.raises(ValueError):
+                parse_upload_frame(frame)
+
+describe "Upload":
+    async it "reads data as it arrives":
+        upload = Upload(max_size=None, spool_size=4)
+
+        reading = asyncio.ensure_future(upload.read(10))
+        await asyncio.sleep(0)
+        assert not reading.done()
+
+        upload.add(b"abc")
+        assert await reading == b"abc"
+
+        upload.add(b"defgh")
+        upload.finish()
+        assert await upload.read(2) == b"de"
+        assert await upload.read() == b"fgh"
+        assert await upload.read() == b""
+
+    async it "spools to a file":
+        upload = Upload(max_size=None, spool_size=4)
+        upload.add(b"abc")
+        assert not upload.file._rolled
+        upload.add(b"defgh")
+        assert upload.file._rolled
+
+        upload.finish()
+        assert (await upload.wait()).read() == b"abcdefgh"
+
+    async it "can be iterated in chunks":
+        upload = Upload(max_size=None, spool_size=4, chunk_size=3)
+        upload.add(b"abcdefgh")
+        upload.finish()
+        assert [chunk async for chunk in upload] == [b"abc", b"def", b"gh"]
+
+    async it "fails when it's too big":
+        upload = Upload(max_size=4, spool_size=4)
+        upload.add(b"abc")
+        upload.add(b"de")
+        assert upload.size == 3
+
+        with pytest.raises(UploadTooBig):
+            await upload.read()
+        with pytest.raises(UploadTooBig):
+            await upload.wait()
+
+    async it "is interrupted when closed":
+        upload = Upload(max_size=None, spool_size=4)
+        waiting = asyncio.ensure_future(upload.wait())
+        await asyncio.sleep(0)
+
+        upload.close()
+        with pytest.raises(UploadInterrupted):
+            await waiting
@@ -1,15 +1,22 @@
 # coding: spec
 
 from whirlwind.request_handlers.base import SimpleWebSocketBase, Finished, MessageFromExc
+from whirlwind.request_handlers.encoding import JsonEncoder, Offload, MsgpackEncoder, CborEncoder
+from whirlwind.request_handlers.uploads import upload_frame, UploadTooBig
 from whirlwind import test_helpers as thp
 from whirlwind.server import Server
 
 from contextlib import contextmanager
 from unittest import mock
 import asynctest
+import array
 import asyncio
+import logging
+import json
 import pytest
 import socket
+import sys
+import threading
 import types
 import time
 import uuid
@@ -776,3 +783,634 @@ describe "SimpleWebSocketBase":
             ({"progress": {"error": "progress"}}, None),
             ({"error": "Stuff", "status": 400}, (Finished, error2, None)),
         ]
+
+    async it "escapes closing tags in replies", make_wrapper:
+
+        class Handler(SimpleWebSocketBase):
+            async def process_message(s, path, body, message_id, message_key, progress_cb):
+                return "</script>"
+
+        async with make_wrapper(Handler) as server:
+            connection = await server.runner.ws_connect(
+                skip_hook=True, path="/v1/ws_no_server_time"
+            )
+            await server.runner.ws_write(
+                connection, {"path": "/one", "body": {}, "message_id": "one"},
+            )
+            assert (
+                await connection.read_message() == '{"reply": "<\\/script>", "message_id": "one"}'
+            )
+
+            connection.close()
+            assert await server.runner.ws_read(connection) is None
+
+    async it "can cancel a message", make_wrapper:
+        started = asyncio.Future()
+        cancelled = asyncio.Future()
+
+        class Handler(SimpleWebSocketBase):
+            async def process_message(s, path, body, message_id, message_key, progress_cb):
+                started.set_result(True)
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.set_result(True)
+                    raise
+
+        async with make_wrapper(Handler) as server:
+            connection = await server.runner.ws_connect(
+                skip_hook=True, path="/v1/ws_no_server_time"
+            )
+            await server.runner.ws_write(
+                connection, {"path": "/one", "body": {}, "message_id": "one"},
+            )
+            await started
+
+            await server.runner.ws_write(
+                connection,
+                {"path": "__cancel__", "body": {"message_id": "one"}, "message_id": "two"},
+            )
+            assert await server.runner.ws_read(connection) == {
+                "message_id": "two",
+                "reply": {"cancelled": True},
+            }
+            assert await server.runner.ws_read(connection) == {
+                "message_id": "one",
+                "reply": {"status": 499, "error": "Cancelled by client", "error_code": "Cancelled"},
+            }
+            assert await cancelled
+
+            await server.runner.ws_write(
+                connection,
+                {"path": "__cancel__", "body": {"message_id": "one"}, "message_id": "three"},
+            )
+            assert await server.runner.ws_read(connection) == {
+                "message_id": "three",
+                "reply": {
+                    "cancelled": False,
+                    "error": "No such message in progress",
+                    "error_code": "NoSuchMessage",
+                    "wanted": "one",
+                },
+            }
+
+            connection.close()
+            assert await server.runner.ws_read(connection) is None
+
+    describe "closing the connection":
+
+        async def run(self, make_wrapper, Handler, wait_after_close):
+            started = asyncio.Future()
+            finished = asyncio.Future()
+            cancelled = []
+
+            class H(Handler):
+                def websocket_tasks_cancelled(s, count):
+                    cancelled.append(count)
+
+                async def process_message(s, path, body, message_id, message_key, progress_cb):
+                    started.set_result(True)
+                    try:
+                        await asyncio.sleep(0.2)
+                    except asyncio.CancelledError:
+                        finished.set_result("cancelled")
+                        raise
+                    finished.set_result("finished")
+
+            async with make_wrapper(H) as server:
+                connection = await server.runner.ws_connect(
+                    skip_hook=True, path="/v1/ws_no_server_time"
+                )
+                await server.runner.ws_write(
+                    connection, {"path": "/one/two", "body": {}, "message_id": str(uuid.uuid1())},
+                )
+                await started
+
+                connection.close()
+                assert await server.runner.ws_read(connection) is None
+                await asyncio.sleep(wait_after_close)
+                return await finished, cancelled
+
+        async it "cancels messages still being processed", make_wrapper, caplog:
+            got = await self.run(make_wrapper, SimpleWebSocketBase, 0)
+            assert got == ("cancelled", [1])
+            assert [r for r in caplog.records if r.levelno >= logging.ERROR] == []
+
+        async it "can wait before cancelling", make_wrapper:
+
+            class Handler(SimpleWebSocketBase):
+                close_grace_period = 0.5
+
+            got = await self.run(make_wrapper, Handler, 0)
+            assert got == ("finished", [])
+
+            class Handler(SimpleWebSocketBase):
+                close_grace_period = 0.05
+
+            got = await self.run(make_wrapper, Handler, 0)
+            assert got == ("cancelled", [1])
+
+        async it "can let messages finish", make_wrapper:
+
+            class Handler(SimpleWebSocketBase):
+                close_grace_period = None
+
+            got = await self.run(make_wrapper, Handler, 0)
+            assert got == ("finished", [])
+
+    describe "big messages":
+
+        async it "decodes and encodes them on the offload thread pool", make_wrapper:
+            threads = []
+
+            class Encoder(JsonEncoder):
+                def dumps(s, obj, default, *, pretty=True):
+                    threads.append(("dumps", threading.current_thread().name))
+                    return super().dumps(obj, default, pretty=pretty)
+
+                def loads(s, data):
+                    threads.append(("loads", threading.current_thread().name))
+                    return super().loads(data)
+
+            class Handler(SimpleWebSocketBase):
+                encoder = Encoder()
+                offload = Offload(threshold=200)
+
+                async def process_message(s, path, body, message_id, message_key, progress_cb):
+                    return body
+
+            small = {"hello": "there"}
+            big = {"items": list(range(100))}
+
+            async with make_wrapper(Handler) as server:
+                connection = await server.runner.ws_connect(
+                    skip_hook=True, path="/v1/ws_no_server_time"
+                )
+
+                for body in (small, big):
+                    del threads[:]
+                    await server.runner.ws_write(
+                        connection, {"path": "/one", "body": body, "message_id": "1"}
+                    )
+                    res = await server.runner.ws_read(connection)
+                    assert res == {"reply": body, "message_id": "1"}
+
+                    names = {name for _, name in threads}
+                    if body is small:
+                        assert names == {threading.current_thread().name}
+                    else:
+                        assert [kind for kind, _ in threads] == ["loads", "dumps"]
+                        assert all(name.startswith("whirlwind-json") for name in names)
+
+                connection.close()
+                assert await server.runner.ws_read(connection) is None
+            Handler.offload.shutdown()
+
+    describe "batching replies":
+
+        async def run(self, make_wrapper, Handler, subprotocols):
+            handlers = []
+
+            class H(Handler):
+                def open(s):
+                    handlers.append(s)
+                    super().open()
+
+                async def process_message(s, path, body, message_id, message_key, progress_cb):
+                    for i in range(5):
+                        progress_cb(i)
+                    return "done"
+
+            frames = []
+            async with make_wrapper(H) as server:
+                connection = await server.runner.ws_connect(
+                    skip_hook=True, path="/v1/ws_no_server_time", subprotocols=subprotocols
+                )
+                await server.runner.ws_write(
+                    connection, {"path": "/one", "body": {}, "message_id": "1"}
+                )
+
+                replies = []
+                while not replies or replies[-1] != {"reply": "done", "message_id": "1"}:
+                    frame = await server.runner.ws_read(connection)
+                    frames.append(frame)
+                    replies.extend(frame if type(frame) is list else [frame])
+
+                connection.close()
+                assert await server.runner.ws_read(connection) is None
+
+            assert replies == [
+                *[{"reply": {"progress": i}, "message_id": "1"} for i in range(5)],
+                {"reply": "done", "message_id": "1"},
+            ]
+            return frames, handlers[0].flush_stats
+
+        async it "sends a frame per reply without the subprotocol", make_wrapper:
+
+            class Handler(SimpleWebSocketBase):
+                def transform_progress(s, body, progress, **kwargs):
+                    yield {"progress": progress}
+
+            frames, stats = await self.run(make_wrapper, Handler, None)
+            assert len(frames) == 6
+            assert stats == {
+                "frames": 6,
+                "replies": 6,
+                "bytes": mock.ANY,
+                "largest_batch": 1,
+                "compressed": 0,
+            }
+
+        async it "sends replies together with the subprotocol", make_wrapper:
+
+            class Handler(SimpleWebSocketBase):
+                def transform_progress(s, body, progress, **kwargs):
+                    yield {"progress": progress}
+
+            frames, stats = await self.run(make_wrapper, Handler, ["whirlwind.batched"])
+            assert all(type(frame) is list for frame in frames)
+            assert len(frames) < 6
+            assert stats["replies"] == 6
+            assert stats["frames"] == len(frames)
+
+        async it "doesn't put more than batch_max_replies in a frame", make_wrapper:
+
+            class Handler(SimpleWebSocketBase):
+                batch_window = 0.05
+                batch_max_replies = 2
+
+                def transform_progress(s, body, progress, **kwargs):
+                    yield {"progress": progress}
+
+            frames, stats = await self.run(make_wrapper, Handler, ["whirlwind.batched"])
+            assert [len(frame) for frame in frames] == [2, 2, 2]
+            assert stats["largest_batch"] == 2
+
+    describe "compression":
+
+        async def run(self, make_wrapper, compression_options):
+            handlers = []
+            big = {"items": [{"name": "same", "value": 1}] * 200}
+
+            class Handler(SimpleWebSocketBase):
+                compression_level = 6
+                compression_min_size = 100
+
+                def open(s):
+                    handlers.append(s)
+                    super().open()
+
+                async def process_message(s, path, body, message_id, message_key, progress_cb):
+                    return big
+
+            async with make_wrapper(Handler) as server:
+                connection = await server.runner.ws_connect(
+                    skip_hook=True, path="/v1/ws", compression_options=compression_options
+                )
+                assert (await server.runner.ws_read(connection))["message_id"] == "__server_time__"
+
+                await server.runner.ws_write(
+                    connection, {"path": "/one", "body": {}, "message_id": "1"}
+                )
+                assert await server.runner.ws_read(connection) == {"reply": big, "message_id": "1"}
+
+                connection.close()
+                assert await server.runner.ws_read(connection) is None
+
+            return handlers[0].flush_stats
+
+        it "has compression options":
+
+            assert SimpleWebSocketBase.get_compression_options(SimpleWebSocketBase) is None
+
+            class Handler(SimpleWebSocketBase):
+                compression_level = 9
+                compression_mem_level = 4
+
+            assert Handler.get_compression_options(Handler) == {
+                "compression_level": 9,
+                "mem_level": 4,
+            }
+
+        async it "only compresses big frames", make_wrapper:
+            from tornado.websocket import WebSocketProtocol13
+
+            # write_frame relies on this private attribute and falls back to
+            # compressing everything without it
+            protocol = WebSocketProtocol13(mock.Mock(name="handler"), False, mock.Mock())
+            assert hasattr(protocol, "_compressor"), "tornado no longer has _compressor"
+
+            stats = await self.run(make_wrapper, {})
+            assert stats["frames"] == 2
+            assert stats["compressed"] == 1
+
+        async it "doesn't compress for clients that don't want it", make_wrapper:
+            stats = await self.run(make_wrapper, None)
+            assert stats["frames"] == 2
+            assert stats["compressed"] == 0
+
+    describe "binary subprotocols":
+
+        async def run(self, make_wrapper, subprotocol, encoder):
+            class Handler(SimpleWebSocketBase):
+                async def process_message(s, path, body, message_id, message_key, progress_cb):
+                    progress_cb({"got": body["data"]})
+                    return {"data": body["data"] + b"\x02", "other": Other()}
+
+                def transform_progress(s, body, progress, **kwargs):
+                    yield {"progress": progress}
+
+            class Other:
+                def __repr__(s):
+                    return "<OTHER>"
+
+            async with make_wrapper(Handler) as server:
+                connection = await server.runner.ws_connect(
+                    skip_hook=True, path="/v1/ws_no_server_time", subprotocols=[subprotocol]
+                )
+                assert connection.selected_subprotocol == subprotocol
+
+                await connection.write_message(
+                    encoder.dumpb(
+                        {"path": "/one", "body": {"data": b"\x00\x01"}, "message_id": "1"}, repr
+                    ),
+                    binary=True,
+                )
+
+                replies = []
+                for _ in range(2):
+                    frame = await connection.read_message()
+                    assert type(frame) is bytes
+                    replies.append(encoder.loads(frame))
+
+                await connection.write_message(b"\xc1", binary=True)
+                error = encoder.loads(await connection.read_message())
+
+                connection.close()
+                assert await server.runner.ws_read(connection) is None
+
+            assert replies == [
+                {"reply": {"progress": {"got": b"\x00\x01"}}, "message_id": "1"},
+                {"reply": {"data": b"\x00\x01\x02", "other": "<OTHER>"}, "message_id": "1"},
+            ]
+            assert error["reply"]["error"].startswith("Message wasn't valid json")
+
+        async it "can use msgpack", make_wrapper:
+            pytest.importorskip("msgpack")
+            await self.run(make_wrapper, "whirlwind.msgpack", MsgpackEncoder())
+
+        async it "can use cbor", make_wrapper:
+            pytest.importorskip("cbor2")
+            await self.run(make_wrapper, "whirlwind.cbor", CborEncoder())
+
+        async it "complains about a cbor body that contains itself", make_wrapper:
+            cbor2 = pytest.importorskip("cbor2")
+
+            class Handler(SimpleWebSocketBase):
+                async def process_message(s, path, body, message_id, message_key, progress_cb):
+                    return "processed"
+
+            body = []
+            body.append(body)
+            message = {"path": "/one", "body": body, "message_id": "1"}
+
+            async with make_wrapper(Handler) as server:
+                connection = await server.runner.ws_connect(
+                    skip_hook=True, path="/v1/ws_no_server_time", subprotocols=["whirlwind.cbor"]
+                )
+                await connection.write_message(
+                    cbor2.dumps(message, value_sharing=True), binary=True
+                )
+
+                reply = cbor2.loads(await connection.read_message())
+                assert reply["reply"]["error_code"] == "InvalidMessage"
+
+                connection.close()
+                assert await server.runner.ws_read(connection) is None
+
+        async it "uses json if the library isn't installed", make_wrapper:
+
+            class Handler(SimpleWebSocketBase):
+                async def process_message(s, path, body, message_id, message_key, progress_cb):
+                    return body
+
+            with mock.patch.dict(sys.modules, {"msgpack": None}):
+                async with make_wrapper(Handler) as server:
+                    connection = await server.runner.ws_connect(
+                        skip_hook=True,
+                        path="/v1/ws_no_server_time",
+                        subprotocols=["whirlwind.msgpack"],
+                    )
+                    assert connection.selected_subprotocol is None
+
+                    await server.runner.ws_write(
+                        connection, {"path": "/one", "body": {"a": 1}, "message_id": "1"}
+                    )
+                    assert await server.runner.ws_read(connection) == {
+                        "reply": {"a": 1},
+                        "message_id": "1",
+                    }
+
+                    connection.close()
+                    assert await server.runner.ws_read(connection) is None
+
+    describe "bytes replies":
+
+        async it "sends bytes in a binary frame after a message about them", make_wrapper:
+            # Two bytes for each item so the length of the memoryview isn't the size
+            items = array.array("H", range(128))
+            data = items.tobytes()
+
+            class Handler(SimpleWebSocketBase):
+                async def process_message(s, path, body, message_id, message_key, progress_cb):
+                    progress_cb("starting")
+                    return memoryview(items)
+
+                def transform_progress(s, body, progress, **kwargs):
+                    yield {"progress": progress}
+
+            for subprotocols in (None, ["whirlwind.batched"]):
+                async with make_wrapper(Handler) as server:
+                    connection = await server.runner.ws_connect(
+                        skip_hook=True, path="/v1/ws_no_server_time", subprotocols=subprotocols
+                    )
+                    await server.runner.ws_write(
+                        connection, {"path": "/one", "body": {}, "message_id": "1"}
+                    )
+
+                    progress = await server.runner.ws_read(connection)
+                    if subprotocols:
+                        progress = progress[0]
+                    assert progress == {"reply": {"progress": "starting"}, "message_id": "1"}
+
+                    header = await server.runner.ws_read(connection)
+                    if subprotocols:
+                        header = header[0]
+                    assert header == {"message_id": "1", "binary": 256}
+                    assert await connection.read_message() == data
+
+                    connection.close()
+                    assert await server.runner.ws_read(connection) is None
+
+    describe "uploads":
+
+        @pytest.fixture()
+        def Handler(self):
+            class Handler(SimpleWebSocketBase):
+                upload_max_size = 10
+                upload_spool_size = 4
+
+                async def process_message(s, path, body, message_id, message_key, progress_cb):
+                    upload = s.upload_for(message_key)
+                    if upload is None:
+                        return {"upload": None}
+
+                    chunks = []
+                    try:
+                        async for chunk in upload:
+                            chunks.append(chunk)
+                            progress_cb(len(chunk))
+                    except UploadTooBig:
+                        return {"too_big": True}
+
+                    return {"upload": b"".join(chunks).decode(), "size": upload.size}
+
+                def transform_progress(s, body, progress, **kwargs):
+                    yield {"progress": progress}
+
+            return Handler
+
+        async it "gives the message the data from binary frames", make_wrapper, Handler:
+            async with make_wrapper(Handler) as server:
+                connection = await server.runner.ws_connect(
+                    skip_hook=True, path="/v1/ws_no_server_time"
+                )
+
+                await server.runner.ws_write(
+                    connection, {"path": "/one", "body": {}, "message_id": "2"}
+                )
+                assert await server.runner.ws_read(connection) == {
+                    "reply": {"upload": None},
+                    "message_id": "2",
+                }
+
+                await server.runner.ws_write(
+                    connection, {"path": "/one", "body": {}, "message_id": "1", "upload": True}
+                )
+                await connection.write_message(upload_frame("1", b"hel"), binary=True)
+                assert await server.runner.ws_read(connection) == {
+                    "reply": {"progress": 3},
+                    "message_id": "1",
+                }
+
+                await connection.write_message(upload_frame("1", b"lo"), binary=True)
+                await connection.write_message(upload_frame("1", b""), binary=True)
+                assert await server.runner.ws_read(connection) == {
+                    "reply": {"progress": 2},
+                    "message_id": "1",
+                }
+                assert await server.runner.ws_read(connection) == {
+                    "reply": {"upload": "hello", "size": 5},
+                    "message_id": "1",
+                }
+
+                await server.runner.ws_write(
+                    connection, {"path": "__upload__", "body": "more", "message_id": "1"}
+                )
+                assert await server.runner.ws_read(connection) == {
+                    "reply": {
+                        "status": 404,
+                        "error": "No upload in progress for this message_id",
+                        "error_code": "NoSuchUpload",
+                    },
+                    "message_id": "1",
+                }
+
+                connection.close()
+                assert await server.runner.ws_read(connection) is None
+
+        async it "treats binary frames that aren't for an upload as messages", make_wrapper, Handler:
+            async with make_wrapper(Handler) as server:
+                connection = await server.runner.ws_connect(
+                    skip_hook=True, path="/v1/ws_no_server_time"
+                )
+
+                message = json.dumps({"path": "/one", "body": {}, "message_id": "2"}).encode()
+                await connection.write_message(message, binary=True)
+                assert await server.runner.ws_read(connection) == {
+                    "reply": {"upload": None},
+                    "message_id": "2",
+                }
+
+                await server.runner.ws_write(
+                    connection, {"path": "/one", "body": {}, "message_id": "1", "upload": True}
+                )
+                await connection.write_message(message, binary=True)
+                assert await server.runner.ws_read(connection) == {
+                    "reply": {"upload": None},
+                    "message_id": "2",
+                }
+
+                await connection.write_message(upload_frame("1", b"hi"), binary=True)
+                assert await server.runner.ws_read(connection) == {
+                    "reply": {"progress": 2},
+                    "message_id": "1",
+                }
+
+                await connection.write_message(upload_frame("1", b""), binary=True)
+                assert await server.runner.ws_read(connection) == {
+                    "reply": {"upload": "hi", "size": 2},
+                    "message_id": "1",
+                }
+
+                await connection.write_message(upload_frame("1", b"more"), binary=True)
+                reply = await server.runner.ws_read(connection)
+                assert reply["reply"]["error"].startswith("Message wasn't valid json")
+
+                connection.close()
+                assert await server.runner.ws_read(connection) is None
+
+        async it "fails uploads that are too big", make_wrapper, Handler:
+            async with make_wrapper(Handler) as server:
+                connection = await server.runner.ws_connect(
+                    skip_hook=True, path="/v1/ws_no_server_time"
+                )
+
+                await server.runner.ws_write(
+                    connection, {"path": "/one", "body": {}, "message_id": "1", "upload": True}
+                )
+                await connection.write_message(upload_frame("1", b"x" * 11), binary=True)
+                assert await server.runner.ws_read(connection) == {
+                    "reply": {"too_big": True},
+                    "message_id": "1",
+                }
+
+                connection.close()
+                assert await server.runner.ws_read(connection) is None
+
+        async it "takes upload messages with a binary subprotocol", make_wrapper, Handler:
+            pytest.importorskip("msgpack")
+            encoder = MsgpackEncoder()
+
+            async with make_wrapper(Handler) as server:
+                connection = await server.runner.ws_connect(
+                    skip_hook=True,
+                    path="/v1/ws_no_server_time",
+                    subprotocols=["whirlwind.msgpack"],
+                )
+
+                async def write(msg):
+                    await connection.write_message(encoder.dumpb(msg, repr), binary=True)
+
+                await write({"path": "/one", "body": {}, "message_id": "1", "upload": True})
+                await write({"path": "__upload__", "body": b"hi", "message_id": "1"})
+                await write({"path": "__upload__", "body": None, "message_id": "1"})
+
+                replies = [encoder.loads(await connection.read_message()) for _ in range(2)]
+                assert replies == [
+                    {"reply": {"progress": 2}, "message_id": "1"},
+                    {"reply": {"upload": "hi", "size": 2}, "message_id": "1"},
+                ]
+
+                connection.close()
+                assert await server.runner.ws_read(connection) is None
@@ -1,17 +1,21 @@
 # coding: spec
 
-from whirlwind.request_handlers.command import WSHandler, CommandHandler
+from whirlwind.request_handlers.command import WSHandler, CommandHandler, BatchMixin
 from whirlwind.server import Server, wait_for_futures
-from whirlwind.request_handlers.base import reprer
+from whirlwind.request_handlers.base import reprer, Finished
 from whirlwind import test_helpers as thp
-from whirlwind.commander import Command
-from whirlwind.store import NoSuchPath
+from whirlwind.commander import Command, Commander
+from whirlwind.store import NoSuchPath, Store
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+from delfick_project.norms import dictobj, sb
 
 from functools import partial
 from unittest import mock
 import asynctest
 import asyncio
 import pytest
+import json
 import time
 
 
@@ -152,3 +156,226 @@ describe "WSHandler and CommandHandler":
                         "available": ["/v1/somewhere"],
                     }
                 )
+
+describe "CommandHandler with ndjson":
+
+    def make_commander(self, seen):
+        commander = mock.Mock(name="commander")
+
+        class Executor:
+            def __init__(s, progress_cb, request_handler, **extra):
+                s.progress_cb = progress_cb
+
+            async def execute(s, path, body, extra_options=None, allow_ws_only=False):
+                s.progress_cb("information", thing=Thing())
+                # The client has to see the progress before we can finish
+                await seen
+                if body["command"] == "fail":
+                    raise Finished(status=418, error="teapot")
+                return {"success": True}
+
+        commander.executor.side_effect = Executor
+        return commander
+
+    async def put(self, server, asserter, seen, body):
+        chunks = []
+
+        def got(chunk):
+            chunks.append(chunk)
+            if not seen.done():
+                seen.set_result(True)
+
+        await server.runner.assertHTTP(
+            asserter,
+            "/v1/somewhere",
+            "PUT",
+            {
+                "body": json.dumps(body).encode(),
+                "headers": {"Accept": "application/x-ndjson"},
+                "streaming_callback": got,
+            },
+        )
+
+        return [json.loads(line) for line in b"".join(chunks).decode().strip().split("\n")]
+
+    async it "writes progress as it happens and the reply last", make_wrapper, asserter:
+        seen = asyncio.Future()
+
+        async with make_wrapper(self.make_commander(seen)) as server:
+            lines = await self.put(server, asserter, seen, {"command": "one"})
+
+        assert lines == [
+            {"progress": {"info": "information", "thing": {"special": "<|<THING>|>"}}},
+            {"reply": {"success": True}},
+        ]
+
+    async it "puts the status of errors in the reply", make_wrapper, asserter:
+        seen = asyncio.Future()
+
+        async with make_wrapper(self.make_commander(seen)) as server:
+            lines = await self.put(server, asserter, seen, {"command": "fail"})
+
+        assert lines == [
+            {"progress": {"info": "information", "thing": {"special": "<|<THING>|>"}}},
+            {"reply": {"status": 418, "error": "teapot"}},
+        ]
+
+    async it "doesn't stream without the Accept header", make_wrapper, asserter:
+        seen = asyncio.Future()
+        seen.set_result(True)
+
+        async with make_wrapper(self.make_commander(seen)) as server:
+            await server.runner.assertPUT(
+                asserter, "/v1/somewhere", {"command": "one"}, json_output={"success": True},
+            )
+
+describe "Batches":
+
+    @pytest.fixture()
+    def commander(self):
+        store = Store(default_path="/v1/somewhere", formatter=MergedOptionStringFormatter)
+
+        @store.command("echo")
+        class Echo(store.Command):
+            progress_cb = store.injected("progress_cb")
+
+            value = dictobj.Field(sb.integer_spec, wrapper=sb.required)
+
+            async def execute(self):
+                self.progress_cb("echoing", value=self.value)
+                return {"value": self.value}
+
+        @store.command("fail")
+        class Fail(store.Command):
+            async def execute(self):
+                raise Finished(status=418, error="teapot")
+
+        @store.command("interactive")
+        class Interactive(store.Command):
+            async def execute(self, messages):
+                async for message in messages:
+                    pass
+
+        return Commander(store)
+
+    async it "runs many commands from one PUT", make_wrapper, asserter, commander:
+        async with make_wrapper(commander) as server:
+            await server.runner.assertPUT(
+                asserter,
+                "/v1/somewhere",
+                {
+                    "batch": [
+                        {"command": "echo", "args": {"value": 1}},
+                        {"command": "fail"},
+                        {"command": "echo", "args": {"value": 2}},
+                    ]
+                },
+                json_output={
+                    "batch": [
+                        {"status": 200, "result": {"value": 1}},
+                        {"status": 418, "error": "teapot"},
+                        {"status": 200, "result": {"value": 2}},
+                    ]
+                },
+            )
+
+            await server.runner.assertPUT(
+                asserter,
+                "/v1/somewhere",
+                {"batch": "nope"},
+                status=400,
+                json_output={
+                    "status": 400,
+                    "error": "Batch must be a list of commands",
+                    "error_code": "InvalidBatch",
+                },
+            )
+
+    async it "runs many commands from one websocket message", make_wrapper, asserter, commander:
+        async with make_wrapper(commander) as server:
+            async with server.runner.ws_stream(asserter) as stream:
+                await stream.start(
+                    "/v1/somewhere",
+                    {
+                        "batch": [
+                            {"command": "echo", "args": {"value": 1}},
+                            {"command": "echo", "args": {"value": 2}},
+                        ]
+                    },
+                )
+                await stream.check_reply(
+                    {"progress": {"info": "echoing", "value": 1, "batch_index": 0}}
+                )
+                await stream.check_reply(
+                    {"progress": {"info": "echoing", "value": 2, "batch_index": 1}}
+                )
+                await stream.check_reply(
+                    {
+                        "batch": [
+                            {"status": 200, "result": {"value": 1}},
+                            {"status": 200, "result": {"value": 2}},
+                        ]
+                    }
+                )
+
+    async it "doesn't run interactive commands in a batch", make_wrapper, asserter, commander:
+        async with make_wrapper(commander) as server:
+            async with server.runner.ws_stream(asserter) as stream:
+                await stream.start(
+                    "/v1/somewhere",
+                    {
+                        "batch": [
+                            {"command": "interactive"},
+                            {"command": "interactive"},
+                            {"command": "echo", "args": {"value": 1}},
+                        ]
+                    },
+                )
+                await stream.check_reply(
+                    {"progress": {"info": "echoing", "value": 1, "batch_index": 2}}
+                )
+
+                error = {
+                    "status": 400,
+                    "error": "Interactive commands can't be part of a batch",
+                    "error_code": "InteractiveInBatch",
+                    "wanted": "interactive",
+                }
+                await stream.check_reply(
+                    {"batch": [error, error, {"status": 200, "result": {"value": 1}}]}
+                )
+
+    async it "limits how many commands are in a batch", make_wrapper, asserter, commander:
+        async with make_wrapper(commander) as server:
+            await server.runner.assertPUT(
+                asserter,
+                "/v1/somewhere",
+                {"batch": [{"command": "echo", "args": {"value": i}} for i in range(101)]},
+                status=400,
+                json_output={
+                    "status": 400,
+                    "error": "Batch has too many commands",
+                    "error_code": "BatchTooBig",
+                    "max_size": 100,
+                },
+            )
+
+    async it "limits how many commands run at once":
+        running = []
+        most = []
+
+        class Handler(BatchMixin):
+            batch_parallelism = 2
+
+        async def execute(item, progress_cb):
+            running.append(item)
+            most.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(item)
+            return item["n"]
+
+        result = await Handler().execute_batch(
+            {"batch": [{"n": i} for i in range(5)]}, mock.Mock(name="progress_cb"), execute
+        )
+        assert result == {"batch": [{"status": 200, "result": i} for i in range(5)]}
+        assert max(most) == 2
@@ -9,6 +9,7 @@ from delfick_project.option_merge.formatter import MergedOptionStringFormatter
 from delfick_project.errors import DelfickError
 from delfick_project.norms import dictobj, sb
 from unittest import mock
+import asyncio
 import pytest
 import time
 import uuid
@@ -133,6 +134,26 @@ class Echo3(Echo):
     pass
 
 
+@store.command("interactive_with_slow_child")
+class InteractiveWithSlowChild(store.Command):
+    progress_cb = store.injected("progress_cb")
+
+    async def execute(self, messages):
+        self.progress_cb("started")
+        async for message in messages:
+            try:
+                await message.process()
+            except asyncio.CancelledError:
+                self.progress_cb("child cancelled")
+                break
+
+
+@store.command("slow", parent=InteractiveWithSlowChild)
+class Slow(store.Command):
+    async def execute(self):
+        await asyncio.sleep(10)
+
+
 class MessageFromExc(MessageFromExc):
     def process(self, exc_type, exc, tb):
         if hasattr(exc, "as_dict"):
@@ -344,3 +365,26 @@ describe "Interactive commands":
                 message_id=[message_id, child_message_id],
             )
             await stream.check_reply({"error_code": "Exception", "error": "SAD"})
+
+    async it "can cancel a child of an interactive command", runner, asserter:
+        async with runner.ws_stream(asserter) as stream:
+            await stream.start("/v1", {"command": "interactive_with_slow_child"})
+            message_id = stream.message_id
+            await stream.check_reply({"progress": {"info": "started"}})
+
+            child_message_id = str(uuid.uuid1())
+            await stream.start(
+                "/v1", {"command": "slow"}, message_id=[message_id, child_message_id]
+            )
+            await asyncio.sleep(0.05)
+
+            await stream.start(
+                "__cancel__", {"message_id": [message_id, child_message_id]}, message_id="cancel"
+            )
+            await stream.check_reply({"cancelled": True}, message_id="cancel")
+            await stream.check_reply(
+                {"status": 499, "error": "Cancelled by client", "error_code": "Cancelled"},
+                message_id=[message_id, child_message_id],
+            )
+            await stream.check_reply({"progress": {"info": "child cancelled"}})
+            await stream.check_reply({"done": True})
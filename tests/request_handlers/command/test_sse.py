@@ -0,0 +1,218 @@
+# coding: spec
+
+from whirlwind.request_handlers.command import SSEHandler, EventStream, EventStreams
+from whirlwind.request_handlers.base import Finished
+
+from urllib.parse import urlencode
+from unittest import mock
+import asyncio
+import pytest
+import json
+
+
+def parse_events(body):
+    events = []
+    for block in body.decode().strip().split("\n\n"):
+        lines = block.split("\n")
+        if lines == [": heartbeat"]:
+            events.append("heartbeat")
+            continue
+
+        event = dict(line.split(": ", 1) for line in lines)
+        events.append((event["id"], event["event"], json.loads(event["data"])))
+    return events
+
+
+@pytest.fixture()
+def commander():
+    commander = mock.Mock(name="commander")
+
+    class Executor:
+        def __init__(s, progress_cb, request_handler, **extra):
+            s.progress_cb = progress_cb
+
+        async def execute(s, path, body, extra_options=None, allow_ws_only=False):
+            assert path == "/v1/events"
+            s.progress_cb("information", one=1)
+            await asyncio.sleep(body.get("sleep", 0))
+            s.progress_cb("more")
+            if body["command"] == "fail":
+                raise Finished(status=418, error="teapot")
+            return {"success": True}
+
+    commander.executor.side_effect = Executor
+    return commander
+
+
+@pytest.fixture()
+def make_wrapper(server_wrapper, commander):
+    def make_wrapper(Handler=SSEHandler, streams=None):
+        streams = streams or EventStreams()
+
+        def tornado_routes(server):
+            return [("/v1/events", Handler, {"commander": commander, "streams": streams})]
+
+        return server_wrapper(None, tornado_routes)
+
+    return make_wrapper
+
+
+describe "SSEHandler":
+
+    async def get(self, server, asserter, body=None, headers=None, status=200):
+        path = "/v1/events"
+        if body is not None:
+            path = f"{path}?{urlencode({'body': json.dumps(body)})}"
+        return await server.runner.assertHTTP(
+            asserter, path, "GET", {"headers": headers or {}}, status=status
+        )
+
+    async it "sends progress and then the reply as events", make_wrapper, asserter:
+        async with make_wrapper() as server:
+            events = parse_events(await self.get(server, asserter, {"command": "one"}))
+
+        assert [e[1:] for e in events] == [
+            ("progress", {"progress": {"info": "information", "one": 1}}),
+            ("progress", {"progress": {"info": "more"}}),
+            ("reply", {"success": True}),
+        ]
+
+        ids = [e[0] for e in events]
+        assert [i.split(":")[1] for i in ids] == ["1", "2", "3"]
+        assert len(set(i.split(":")[0] for i in ids)) == 1
+
+    async it "takes the body from a POST", make_wrapper, asserter:
+        async with make_wrapper() as server:
+            body = await server.runner.assertHTTP(
+                asserter, "/v1/events", "POST", {"body": json.dumps({"command": "fail"})}
+            )
+
+        assert [e[1:] for e in parse_events(body)][-1] == (
+            "reply",
+            {"status": 418, "error": "teapot"},
+        )
+
+    async it "sends heartbeats while waiting", make_wrapper, asserter:
+
+        class Handler(SSEHandler):
+            heartbeat_interval = 0.02
+
+        async with make_wrapper(Handler) as server:
+            events = parse_events(
+                await self.get(server, asserter, {"command": "one", "sleep": 0.1})
+            )
+
+        assert "heartbeat" in events
+        assert [e[1] for e in events if e != "heartbeat"] == ["progress", "progress", "reply"]
+
+    async it "resumes from the Last-Event-ID", make_wrapper, asserter:
+        async with make_wrapper() as server:
+            events = parse_events(await self.get(server, asserter, {"command": "one"}))
+
+            resumed = parse_events(
+                await self.get(server, asserter, headers={"Last-Event-ID": events[0][0]})
+            )
+            assert resumed == events[1:]
+
+            await self.get(server, asserter, headers={"Last-Event-ID": events[-1][0]}, status=204)
+
+            body = await self.get(server, asserter, headers={"Last-Event-ID": "nope:1"}, status=404)
+            assert json.loads(body.decode())["error_code"] == "NoSuchEventStream"
+
+describe "EventStreams":
+
+    async it "cancels a command nobody is listening to after keep_for":
+        streams = EventStreams(keep_for=0.01)
+        started = asyncio.Future()
+
+        async def run(stream):
+            started.set_result(True)
+            await asyncio.sleep(10)
+
+        stream = streams.start(run)
+        await started
+        streams.joined(stream)
+        streams.left(stream)
+
+        with pytest.raises(asyncio.CancelledError):
+            await stream.task
+
+        await asyncio.sleep(0.05)
+        assert stream.done
+        assert streams.find(f"{stream.id}:0") == (None, None)
+
+    async it "keeps a command that is resumed in time":
+        streams = EventStreams(keep_for=0.05)
+        started = asyncio.Future()
+
+        async def run(stream):
+            started.set_result(True)
+            await asyncio.sleep(0.1)
+            stream.add("reply", "{}")
+
+        stream = streams.start(run)
+        await started
+        streams.joined(stream)
+        streams.left(stream)
+        streams.joined(stream)
+
+        await stream.task
+        assert streams.find(f"{stream.id}:0") == (stream, 0)
+        assert [item async for item in stream.follow(0, 1)] == [(1, "reply", "{}")]
+
+describe "EventStream":
+
+    async it "doesn't lose events added while the client is writing":
+        stream = EventStream("one", 100)
+        stream.add("progress", "1")
+
+        got = []
+
+        async def consume():
+            async for item in stream.follow(0, 10):
+                got.append(item)
+                if len(got) == 1:
+                    # A slow write, during which more happens
+                    await asyncio.sleep(0.05)
+
+        async def produce():
+            await asyncio.sleep(0.01)
+            stream.add("progress", "2")
+
+            # Progress that arrives after the slow write isn't held till the heartbeat
+            await asyncio.sleep(0.1)
+            assert got[-1] == (2, "progress", "2")
+
+            stream.add("progress", "3")
+            await asyncio.sleep(0.01)
+            assert got[-1] == (3, "progress", "3")
+
+            stream.add("reply", "{}")
+            stream.finish()
+
+        await asyncio.wait_for(asyncio.gather(consume(), produce()), timeout=2)
+        assert got == [
+            (1, "progress", "1"),
+            (2, "progress", "2"),
+            (3, "progress", "3"),
+            (4, "reply", "{}"),
+        ]
+
+    async it "sends the reply if the command finishes during a write":
+        stream = EventStream("one", 100)
+        stream.add("progress", "1")
+
+        got = []
+
+        async def consume():
+            async for item in stream.follow(0, 10):
+                got.append(item)
+                await asyncio.sleep(0.05)
+
+        async def produce():
+            await asyncio.sleep(0.01)
+            stream.add("reply", "{}")
+            stream.finish()
+
+        await asyncio.wait_for(asyncio.gather(consume(), produce()), timeout=2)
+        assert got == [(1, "progress", "1"), (2, "reply", "{}")]
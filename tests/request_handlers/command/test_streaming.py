@@ -0,0 +1,140 @@
+# coding: spec
+
+from whirlwind.request_handlers.command import StreamingCommandHandler
+
+from unittest import mock
+import pytest
+import json
+
+boundary = "XyZ"
+headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def make_body(*parts):
+    body = []
+    for disposition, data in parts:
+        body.append(
+            f"--{boundary}\r\nContent-Disposition: form-data; {disposition}\r\n\r\n".encode()
+            + data
+            + b"\r\n"
+        )
+    body.append(f"--{boundary}--\r\n".encode())
+    return b"".join(body)
+
+
+@pytest.fixture()
+def commander():
+    commander = mock.Mock(name="commander")
+
+    class Executor:
+        def __init__(s, progress_cb, request_handler, **extra):
+            s.files = extra.get("files")
+            s.request_handler = request_handler
+
+        async def execute(s, path, body, extra_options=None, allow_ws_only=False):
+            if s.files is None:
+                return {"body": body, "files": None}
+
+            files = {
+                name: [(f.filename, f.file.read().decode()) for f in fs]
+                for name, fs in s.files.items()
+            }
+            arguments = {
+                name: [v.decode() for v in vs]
+                for name, vs in s.request_handler.request.body_arguments.items()
+            }
+            return {"body": body, "files": files, "arguments": arguments}
+
+    commander.executor.side_effect = Executor
+    return commander
+
+
+@pytest.fixture()
+def make_wrapper(server_wrapper, commander):
+    def make_wrapper(**options):
+        Handler = type("Handler", (StreamingCommandHandler,), options)
+
+        def tornado_routes(server):
+            return [("/v1/somewhere", Handler, {"commander": commander})]
+
+        return server_wrapper(None, tornado_routes)
+
+    return make_wrapper
+
+
+describe "StreamingCommandHandler":
+
+    async def put(self, server, asserter, body, headers=None, status=200):
+        response = await server.runner.assertHTTP(
+            asserter,
+            "/v1/somewhere",
+            "PUT",
+            {"body": body, "headers": headers or {}},
+            status=status,
+        )
+        return json.loads(response.decode())
+
+    async it "takes a normal json body", make_wrapper, asserter:
+        async with make_wrapper() as server:
+            reply = await self.put(server, asserter, json.dumps({"command": "one"}).encode())
+            assert reply == {"body": {"command": "one"}, "files": None}
+
+    async it "gives commands the files from a multipart body", make_wrapper, asserter:
+        body = make_body(
+            ('name="attachment"; filename="thing.txt"', b"hello there\n" * 1000),
+            ('name="__body__"; filename="blob"', b'{"command": "attachments/add"}'),
+            ('name="other"', b"stuff"),
+        )
+
+        async with make_wrapper(upload_spool_size=100) as server:
+            reply = await self.put(server, asserter, body, headers=headers)
+
+        assert reply == {
+            "body": {"command": "attachments/add"},
+            "files": {
+                "attachment": [["thing.txt", "hello there\n" * 1000]],
+                "__body__": [["blob", '{"command": "attachments/add"}']],
+            },
+            "arguments": {"other": ["stuff"]},
+        }
+
+    async it "complains if the body is too big", make_wrapper, asserter:
+        body = make_body(('name="__body__"', b'{"command": "one"}'))
+
+        async with make_wrapper(upload_max_size=10) as server:
+            reply = await self.put(server, asserter, body, headers=headers, status=413)
+            assert reply == {
+                "status": 413,
+                "error": "Upload is bigger than the maximum of 10 bytes",
+                "error_code": "UploadTooBig",
+            }
+
+    async it "leaves the size of other bodies to tornado", make_wrapper, asserter:
+        async with make_wrapper(upload_max_size=10) as server:
+            reply = await self.put(server, asserter, json.dumps({"command": "one"}).encode())
+            assert reply == {"body": {"command": "one"}, "files": None}
+
+    async it "complains if a part that isn't a file is too big", make_wrapper, asserter:
+        body = make_body(
+            ('name="attachment"; filename="thing.txt"', b"x" * 100),
+            ('name="__body__"', b'{"command": "one"}'),
+        )
+
+        async with make_wrapper(upload_field_max_size=18) as server:
+            reply = await self.put(server, asserter, body, headers=headers)
+            assert reply["body"] == {"command": "one"}
+
+        async with make_wrapper(upload_field_max_size=10) as server:
+            reply = await self.put(server, asserter, body, headers=headers, status=413)
+            assert reply == {
+                "status": 413,
+                "error": "Upload is bigger than the maximum of 10 bytes",
+                "error_code": "UploadTooBig",
+            }
+
+    async it "complains if the multipart body is invalid", make_wrapper, asserter:
+        body = make_body(('name="__body__"', b'{"command": "one"}'))[:-10]
+
+        async with make_wrapper() as server:
+            reply = await self.put(server, asserter, body, headers=headers, status=400)
+            assert reply["error_code"] == "BadMultipart"
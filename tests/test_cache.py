@@ -0,0 +1,371 @@
+# coding: spec
+
+from whirlwind.cache import CachePolicy, CommandCache, UnknownEviction, Uncacheable, freeze
+from whirlwind.store import Store, CantCacheInteractive
+from whirlwind.commander import Commander
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+from delfick_project.norms import dictobj, sb
+from unittest import mock
+import asyncio
+import pytest
+import time
+
+describe "CachePolicy":
+    it "complains about unknown eviction policies":
+        with pytest.raises(UnknownEviction):
+            CachePolicy(eviction="fifo")
+
+describe "freeze":
+    it "keeps values of different types apart":
+        values = [True, 1, 1.0, [1], (1,), {"a": 1}, {"a": True}, [[1]], [(1,)]]
+        frozen = [freeze(value) for value in values]
+        assert len(set(frozen)) == len(values)
+
+        for value, f in zip(values, frozen):
+            hash(f)
+            assert freeze(value) == f
+
+    it "complains about values that can't be a key":
+        with pytest.raises(Uncacheable):
+            freeze({"a": [set()]})
+
+describe "CommandCache":
+
+    def make_cache(self, **kwargs):
+        class Kls(dictobj.Spec):
+            one = dictobj.Field(sb.any_spec)
+
+        return CommandCache(CachePolicy(**kwargs), Kls)
+
+    it "evicts the least recently used result":
+        cache = self.make_cache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        assert cache.get("a") == (True, 1)
+        cache.set("c", 3)
+
+        assert list(cache.entries) == ["a", "c"]
+        assert cache.stats()["evictions"] == 1
+
+    it "evicts the least frequently used result":
+        cache = self.make_cache(max_entries=2, eviction="lfu")
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        cache.get("b")
+        cache.get("a")
+        cache.get("b")
+        cache.set("c", 3)
+
+        assert sorted(cache.entries) == ["b", "c"]
+
+    it "expires results":
+        cache = self.make_cache(ttl=10)
+        now = time.monotonic()
+
+        with mock.patch("time.monotonic", return_value=now):
+            cache.set("a", 1)
+
+        with mock.patch("time.monotonic", return_value=now + 9):
+            assert cache.get("a") == (True, 1)
+
+        with mock.patch("time.monotonic", return_value=now + 10):
+            assert cache.get("a") == (False, None)
+
+        assert cache.stats() == {
+            "hits": 1,
+            "misses": 1,
+            "entries": 0,
+            "evictions": 0,
+            "expirations": 1,
+            "stored_bytes": 0,
+        }
+
+    it "keeps under the maximum bytes":
+        cache = self.make_cache(max_bytes=10, size_of=len)
+        cache.set("a", "aaaa")
+        cache.set("b", "bbbb")
+        assert cache.stats()["stored_bytes"] == 8
+
+        cache.set("c", "cccc")
+        assert list(cache.entries) == ["b", "c"]
+        assert cache.stats()["stored_bytes"] == 8
+
+        cache.set("d", "d" * 11)
+        assert list(cache.entries) == ["b", "c"]
+
+describe "Caching commands":
+
+    @pytest.fixture()
+    def V(self):
+        store = Store(formatter=MergedOptionStringFormatter)
+        called = []
+
+        @store.command("thing", cache=CachePolicy(max_entries=10))
+        class Thing(store.Command):
+            progress_cb = store.injected("progress_cb")
+
+            one = dictobj.Field(sb.integer_spec, wrapper=sb.required)
+            two = dictobj.Field(sb.dictionary_spec, default={})
+
+            async def execute(self):
+                called.append((self.one, self.two))
+                return {"one": self.one, "two": self.two}
+
+        @store.command("items", cache=CachePolicy())
+        class Items(store.Command):
+            async def execute(self):
+                called.append("items")
+
+                async def items():
+                    for i in range(3):
+                        yield i
+
+                return items()
+
+        @store.command("fails", cache=CachePolicy())
+        class Fails(store.Command):
+            async def execute(self):
+                called.append("fails")
+                raise ValueError("NOPE")
+
+        class V:
+            def __init__(s):
+                s.store = store
+                s.called = called
+                s.commander = Commander(store)
+
+            async def execute(s, command, args=None):
+                executor = s.commander.executor(mock.Mock(name="progress_cb"), mock.Mock())
+                return await executor.execute("/v1", {"command": command, "args": args or {}})
+
+        return V()
+
+    async it "shares results between calls with the same arguments", V:
+        assert await V.execute("thing", {"one": 1}) == {"one": 1, "two": {}}
+        assert await V.execute("thing", {"one": 1}) == {"one": 1, "two": {}}
+        assert await V.execute("thing", {"one": 1, "two": {"a": [1]}}) == {
+            "one": 1,
+            "two": {"a": [1]},
+        }
+        assert await V.execute("thing", {"one": 1, "two": {"a": [1]}}) == {
+            "one": 1,
+            "two": {"a": [1]},
+        }
+
+        assert V.called == [(1, {}), (1, {"a": [1]})]
+        assert V.store.cache_stats() == {
+            "/v1": {
+                "thing": {
+                    "hits": 2,
+                    "misses": 2,
+                    "entries": 2,
+                    "evictions": 0,
+                    "expirations": 0,
+                    "stored_bytes": 0,
+                },
+                "items": mock.ANY,
+                "fails": mock.ANY,
+            }
+        }
+
+    async it "caches the items from async iterators", V:
+        assert await V.execute("items") == [0, 1, 2]
+        assert await V.execute("items") == [0, 1, 2]
+        assert V.called == ["items"]
+
+    async it "doesn't cache errors", V:
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                await V.execute("fails")
+        assert V.called == ["fails", "fails"]
+
+    async it "can invalidate results", V:
+        await V.execute("thing", {"one": 1})
+        await V.execute("thing", {"one": 2})
+        await V.execute("thing", {"one": 3})
+
+        V.store.invalidate("thing", one=2)
+        await V.execute("thing", {"one": 1})
+        await V.execute("thing", {"one": 2})
+        assert V.called == [(1, {}), (2, {}), (3, {}), (2, {})]
+
+        V.store.invalidate()
+        await V.execute("thing", {"one": 3})
+        assert V.called[-1] == (3, {})
+        assert len(V.called) == 5
+
+    async it "doesn't share results between values of different types", V:
+        assert await V.execute("thing", {"one": 1, "two": {"a": 1}}) == {
+            "one": 1,
+            "two": {"a": 1},
+        }
+        assert await V.execute("thing", {"one": 1, "two": {"a": True}}) == {
+            "one": 1,
+            "two": {"a": True},
+        }
+        assert await V.execute("thing", {"one": 1, "two": {"a": 1.0}}) == {
+            "one": 1,
+            "two": {"a": 1.0},
+        }
+        assert V.called == [(1, {"a": 1}), (1, {"a": True}), (1, {"a": 1.0})]
+
+        V.store.invalidate("thing", two={"a": True})
+        await V.execute("thing", {"one": 1, "two": {"a": 1}})
+        await V.execute("thing", {"one": 1, "two": {"a": True}})
+        assert V.called[3:] == [(1, {"a": True})]
+
+    it "can't cache interactive commands":
+        store = Store()
+
+        with pytest.raises(CantCacheInteractive):
+
+            @store.command("interactive", cache=CachePolicy())
+            class Interactive(store.Command):
+                async def execute(self, messages):
+                    pass
+
+
+describe "Coalescing commands":
+
+    @pytest.fixture()
+    def V(self):
+        store = Store(formatter=MergedOptionStringFormatter)
+
+        class V:
+            started = 0
+            release = asyncio.Event()
+            request_futures = []
+
+            def __init__(s):
+                s.store = store
+                s.commander = Commander(store)
+
+            async def execute(s, command, args=None, progress_cb=None):
+                progress_cb = progress_cb or mock.Mock(name="progress_cb")
+                executor = s.commander.executor(progress_cb, mock.Mock())
+                return await executor.execute("/v1", {"command": command, "args": args or {}})
+
+        v = V()
+
+        @store.command("slow", coalesce=True)
+        class Slow(store.Command):
+            progress_cb = store.injected("progress_cb")
+
+            one = dictobj.Field(sb.integer_spec, wrapper=sb.required)
+
+            async def execute(self):
+                v.started += 1
+                self.progress_cb("started", one=self.one)
+                await v.release.wait()
+                return {"one": self.one}
+
+        @store.command("items", coalesce=True)
+        class Items(store.Command):
+            async def execute(self):
+                v.started += 1
+
+                async def items():
+                    await v.release.wait()
+                    for i in range(3):
+                        yield i
+
+                return items()
+
+        @store.command("watched", coalesce=True)
+        class Watched(store.Command):
+            request_future = store.injected("request_future")
+
+            async def execute(self):
+                v.request_futures.append(self.request_future)
+                await v.release.wait()
+                return {"cancelled": self.request_future.cancelled()}
+
+        return v
+
+    async it "shares one execution between identical calls", V:
+        cb1 = mock.Mock(name="cb1")
+        cb2 = mock.Mock(name="cb2")
+        cb3 = mock.Mock(name="cb3")
+
+        t1 = asyncio.ensure_future(V.execute("slow", {"one": 1}, cb1))
+        t2 = asyncio.ensure_future(V.execute("slow", {"one": 1}, cb2))
+        t3 = asyncio.ensure_future(V.execute("slow", {"one": 2}, cb3))
+        await asyncio.sleep(0.01)
+
+        assert V.started == 2
+        cb1.assert_called_once_with("started", stack_extra=1, one=1)
+        cb2.assert_called_once_with("started", stack_extra=1, one=1)
+        cb3.assert_called_once_with("started", stack_extra=1, one=2)
+
+        V.release.set()
+        assert await t1 == {"one": 1}
+        assert await t2 == {"one": 1}
+        assert await t3 == {"one": 2}
+
+        flights = V.store.paths["/v1"]["slow"]["coalesce"]
+        assert flights.stats() == {"started": 2, "joined": 1, "in_flight": 0}
+
+        assert await V.execute("slow", {"one": 1}) == {"one": 1}
+        assert V.started == 3
+
+    async it "gives every caller the items from async iterators", V:
+        t1 = asyncio.ensure_future(V.execute("items"))
+        t2 = asyncio.ensure_future(V.execute("items"))
+        await asyncio.sleep(0.01)
+
+        V.release.set()
+        assert await t1 == [0, 1, 2]
+        assert await t2 == [0, 1, 2]
+        assert V.started == 1
+
+    async it "only cancels the execution when every caller is cancelled", V:
+        t1 = asyncio.ensure_future(V.execute("slow", {"one": 1}))
+        t2 = asyncio.ensure_future(V.execute("slow", {"one": 1}))
+        await asyncio.sleep(0.01)
+
+        [flight] = V.store.paths["/v1"]["slow"]["coalesce"].flights.values()
+
+        t1.cancel()
+        await asyncio.sleep(0.01)
+        assert not flight.task.done()
+
+        t2.cancel()
+        await asyncio.sleep(0.01)
+        assert flight.task.cancelled()
+        assert V.store.paths["/v1"]["slow"]["coalesce"].flights == {}
+
+    async it "gives the execution a request_future of its own", V:
+        t1 = asyncio.ensure_future(V.execute("watched"))
+        t2 = asyncio.ensure_future(V.execute("watched"))
+        await asyncio.sleep(0.01)
+
+        t1.cancel()
+        await asyncio.sleep(0.01)
+
+        request_future = V.request_futures[0]
+        assert not request_future.cancelled()
+
+        V.release.set()
+        assert await t2 == {"cancelled": False}
+        assert request_future.cancelled()
+        assert len(V.request_futures) == 1
+
+    async it "doesn't change the command of the first caller", V:
+        flights = V.store.paths["/v1"]["slow"]["coalesce"]
+        progress_cb = mock.Mock(name="progress_cb")
+        command = V.store.paths["/v1"]["slow"]["kls"](one=1, progress_cb=progress_cb)
+
+        executed = []
+
+        async def execute(command):
+            executed.append(command)
+            return {"one": command.one}
+
+        assert await flights.run(("one", 1), command, progress_cb, execute) == {"one": 1}
+        assert command.progress_cb is progress_cb
+        assert executed[0] is not command
+        assert executed[0].one == 1
+        assert executed[0].progress_cb is not progress_cb
@@ -198,6 +198,31 @@ describe "Commander":
         assert thing.store is store2
         assert store is not store2
 
+    async it "layers commander, executor and execute options in that order":
+        other1 = mock.Mock(name="other")
+        other2 = mock.Mock(name="other2")
+        other3 = mock.Mock(name="other3")
+        progress_cb = mock.Mock(name="progress_cb")
+        request_handler = mock.Mock(name="request_handler")
+        commander = Commander(store, other=other1)
+
+        executor = commander.executor(progress_cb, request_handler)
+        thing, _ = await executor.execute("/v1", {"command": "thing", "args": {"value": "a"}})
+        assert thing.other is other1
+
+        executor = commander.executor(progress_cb, request_handler, other=other2)
+        thing, _ = await executor.execute("/v1", {"command": "thing", "args": {"value": "b"}})
+        assert thing.other is other2
+
+        thing, _ = await executor.execute(
+            "/v1", {"command": "thing", "args": {"value": "c"}}, {"other": other3}
+        )
+        assert thing.other is other3
+
+        thing, _ = await executor.execute("/v1", {"command": "thing", "args": {"value": "d"}})
+        assert thing.other is other2
+        assert thing.commander is commander
+
     async it "can inject values that are dictobj's":
 
         class Other(dictobj):
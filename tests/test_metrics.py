@@ -0,0 +1,297 @@
+# coding: spec
+
+from whirlwind.metrics import Metrics, Histogram, hdr_bounds
+from whirlwind.request_handlers.command import WSHandler
+from whirlwind.server import Server, wait_for_futures
+from whirlwind import test_helpers as thp
+from whirlwind.commander import Commander
+from whirlwind.store import Store
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+from delfick_project.norms import dictobj, sb
+from unittest import mock
+import asyncio
+import pytest
+import time
+
+store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+
+
+@store.command("good")
+class Good(store.Command):
+    async def execute(self):
+        return {"good": True}
+
+
+@store.command("bad")
+class Bad(store.Command):
+    async def execute(self):
+        raise ValueError("NOPE")
+
+
+@store.command("sleep")
+class Sleep(store.Command):
+    async def execute(self):
+        await asyncio.sleep(10)
+
+
+@store.command("stream")
+class Stream(store.Command):
+    request_future = store.injected("request_future")
+
+    async def execute(self):
+        async def items():
+            for i in range(2):
+                yield {"i": i, "cancelled": self.request_future.cancelled()}
+
+        return items()
+
+
+@store.command("needs_value")
+class NeedsValue(store.Command):
+    value = dictobj.Field(sb.string_spec, wrapper=sb.required)
+
+    async def execute(self):
+        return {"value": self.value}
+
+
+describe "hdr_bounds":
+    it "splits every power of two into linear buckets":
+        assert hdr_bounds(1, 8, 2) == (1, 1.5, 2, 3, 4, 6, 8)
+        assert hdr_bounds(1, 4, 4) == (1, 1.25, 1.5, 1.75, 2, 2.5, 3, 3.5, 4)
+
+describe "Histogram":
+    it "counts values into buckets with inclusive upper bounds":
+        histogram = Histogram((1, 2, 4))
+        for value in (0.5, 1, 1.5, 3, 4, 10):
+            histogram.observe(value)
+
+        assert histogram.counts == [2, 1, 2, 1]
+        assert histogram.count == 6
+        assert histogram.sum == 20
+
+describe "Metrics":
+    async it "records commands executed by the commander":
+        metrics = Metrics()
+        commander = Commander(store)
+        commander.metrics = metrics
+
+        executor = commander.executor(mock.Mock(name="progress_cb"), mock.Mock(name="handler"))
+
+        assert await executor.execute("/v1", {"command": "good"}) == {"good": True}
+        assert await executor.execute("/v1", {"command": "good"}) == {"good": True}
+
+        with pytest.raises(ValueError):
+            await executor.execute("/v1", {"command": "bad"})
+
+        with pytest.raises(Exception):
+            await executor.execute("/v1", {"command": "needs_value"})
+
+        good = metrics.commands["/v1"]["good"]
+        assert good.total == 2
+        assert good.in_flight == 0
+        assert good.errors == {}
+        assert good.durations.count == 2
+
+        bad = metrics.commands["/v1"]["bad"]
+        assert bad.total == 1
+        assert bad.errors == {"ValueError": 1}
+
+        needs_value = metrics.commands["/v1"]["needs_value"]
+        assert needs_value.errors == {"BadSpecValue": 1}
+
+    async it "doesn't record commands and paths the store doesn't know about":
+        metrics = Metrics()
+        commander = Commander(store)
+        commander.metrics = metrics
+
+        executor = commander.executor(mock.Mock(name="progress_cb"), mock.Mock(name="handler"))
+
+        for i in range(3):
+            with pytest.raises(Exception):
+                await executor.execute("/v1", {"command": f"made_up_{i}"})
+            with pytest.raises(Exception):
+                await executor.execute(f"/made_up_{i}", {"command": "good"})
+        with pytest.raises(Exception):
+            await executor.execute("/v1", {"command": ["not", "a", "name"]})
+
+        assert sorted(metrics.commands) == ["/v1", "<unknown>"]
+        assert list(metrics.commands["/v1"]) == ["<unknown>"]
+        assert metrics.commands["/v1"]["<unknown>"].total == 4
+        assert list(metrics.commands["<unknown>"]) == ["<unknown>"]
+        assert metrics.commands["<unknown>"]["<unknown>"].total == 3
+
+    async it "records streamed commands once their items are used up":
+        metrics = Metrics()
+        commander = Commander(store)
+        commander.metrics = metrics
+
+        executor = commander.executor(mock.Mock(name="progress_cb"), mock.Mock(name="handler"))
+
+        result = await executor.execute("/v1", {"command": "stream"})
+        stats = metrics.commands["/v1"]["stream"]
+        assert stats.in_flight == 1
+
+        items = [item async for item in result]
+        assert items == [{"i": 0, "cancelled": False}, {"i": 1, "cancelled": False}]
+        assert stats.in_flight == 0
+        assert stats.durations.count == 1
+
+        result = await executor.execute("/v1", {"command": "stream"})
+        async for item in result:
+            break
+        await result.aclose()
+        assert stats.in_flight == 0
+        assert stats.errors == {}
+        assert stats.durations.count == 2
+
+    async it "knows how many commands are in flight":
+        metrics = Metrics()
+
+        stats, start = metrics.command_started("/v1", "thing")
+        assert stats.in_flight == 1
+
+        stats2, start2 = metrics.command_started("/v1", "thing")
+        assert stats2 is stats
+        assert stats.in_flight == 2
+
+        stats.finished(start, error_code="Cancelled")
+        assert stats.in_flight == 1
+        assert stats.errors == {"Cancelled": 1}
+
+    it "only records so many different labels":
+        metrics = Metrics(max_labels=2)
+
+        for path in ("/one", "/two", "/three", "/four"):
+            for command in ("a", "b", "c"):
+                stats, start = metrics.command_started(path, command)
+                stats.finished(start)
+            stats, start = metrics.message_started(path)
+            stats.finished(start)
+            metrics.disconnected(path)
+
+        assert list(metrics.commands) == ["/one", "/two", "<other>"]
+        for by_command in metrics.commands.values():
+            assert list(by_command) == ["a", "b", "<other>"]
+        assert metrics.commands["<other>"]["<other>"].total == 2
+
+        assert list(metrics.messages) == ["/one", "/two", "<other>"]
+        assert metrics.messages["<other>"].total == 2
+        assert metrics.disconnects == {"/one": 1, "/two": 1, "<other>": 2}
+
+    it "renders in the prometheus text format":
+        metrics = Metrics(lowest=0.5, highest=1, sub_buckets=1)
+
+        stats, start = metrics.command_started("/v1", 'say "hi"')
+        with mock.patch("time.perf_counter", return_value=start + 0.75):
+            stats.finished(start, error_code="ValueError")
+
+        stats, start = metrics.message_started("/v1/ws")
+        with mock.patch("time.perf_counter", return_value=start + 0.25):
+            stats.finished(start)
+
+        labels = 'path="/v1",command="say \\"hi\\""'
+        rendered = metrics.render().split("\n")
+
+        assert f"whirlwind_commands_total{{{labels}}} 1" in rendered
+        assert f"whirlwind_commands_in_flight{{{labels}}} 0" in rendered
+        assert f'whirlwind_command_errors_total{{{labels},error_code="ValueError"}} 1' in rendered
+        assert f'whirlwind_command_duration_seconds_bucket{{{labels},le="0.5"}} 0' in rendered
+        assert f'whirlwind_command_duration_seconds_bucket{{{labels},le="1"}} 1' in rendered
+        assert f'whirlwind_command_duration_seconds_bucket{{{labels},le="+Inf"}} 1' in rendered
+        assert f"whirlwind_command_duration_seconds_count{{{labels}}} 1" in rendered
+        assert "# TYPE whirlwind_command_duration_seconds histogram" in rendered
+
+        assert 'whirlwind_ws_messages_total{path="/v1/ws"} 1' in rendered
+        assert 'whirlwind_ws_message_duration_seconds_bucket{path="/v1/ws",le="0.5"} 1' in rendered
+
+describe "Serving metrics":
+
+    async it "mounts the metrics route and records websocket messages", asserter:
+        metrics = Metrics()
+
+        class S(Server):
+            async def setup(s):
+                s.wsconnections = {}
+                s.commander = Commander(store)
+                s.commander.metrics = metrics
+
+            async def cleanup(s):
+                await wait_for_futures(s.wsconnections)
+
+            def tornado_routes(s):
+                return [
+                    (
+                        "/v1/ws",
+                        WSHandler,
+                        {
+                            "commander": s.commander,
+                            "server_time": time.time(),
+                            "wsconnections": s.wsconnections,
+                        },
+                    )
+                ]
+
+        final_future = asyncio.Future()
+        server = S(final_future, metrics=metrics)
+
+        async with thp.ServerRunner(final_future, thp.free_port(), server, None) as runner:
+            async with runner.ws_stream(asserter) as stream:
+                await stream.start("/v1", {"command": "good"})
+                await stream.check_reply({"good": True})
+
+                await stream.start("/v1", {"command": "bad"})
+                await stream.check_reply(mock.ANY)
+
+                await stream.start("/made_up", {"command": "good"})
+                await stream.check_reply(mock.ANY)
+
+            output = (await runner.assertGET(asserter, "/metrics")).decode().split("\n")
+
+        assert 'whirlwind_commands_total{path="/v1",command="good"} 1' in output
+        assert 'whirlwind_ws_messages_total{path="/v1"} 2' in output
+        assert 'whirlwind_ws_messages_in_flight{path="/v1"} 0' in output
+        assert 'whirlwind_ws_message_errors_total{path="/v1",error_code="ValueError"} 1' in output
+        assert 'whirlwind_ws_messages_total{path="<unknown>"} 1' in output
+        assert "/made_up" not in "\n".join(output)
+
+        assert metrics.messages["/v1"].in_flight == 0
+
+    async it "records messages cancelled because the connection closed", asserter:
+        metrics = Metrics()
+
+        class S(Server):
+            async def setup(s):
+                s.wsconnections = {}
+                s.commander = Commander(store)
+
+            async def cleanup(s):
+                await wait_for_futures(s.wsconnections)
+
+            def tornado_routes(s):
+                return [
+                    (
+                        "/v1/ws",
+                        WSHandler,
+                        {
+                            "commander": s.commander,
+                            "server_time": None,
+                            "wsconnections": s.wsconnections,
+                        },
+                    )
+                ]
+
+        final_future = asyncio.Future()
+        server = S(final_future, metrics=metrics)
+
+        async with thp.ServerRunner(final_future, thp.free_port(), server, None) as runner:
+            connection = await runner.ws_connect(skip_hook=True)
+            await runner.ws_write(
+                connection, {"path": "/v1", "body": {"command": "sleep"}, "message_id": "one"}
+            )
+            await asyncio.sleep(0.05)
+            connection.close()
+            assert await runner.ws_read(connection) is None
+            await asyncio.sleep(0.05)
+
+        assert metrics.messages["/v1"].errors == {"CancelledOnClose": 1}
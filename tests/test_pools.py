@@ -0,0 +1,183 @@
+# coding: spec
+
+from whirlwind.pools import Pools, PoolRunner, UnknownExecutor
+from whirlwind import pools as pools_module
+from whirlwind.store import Store, CantPoolInteractive
+from whirlwind.commander import Commander
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+from delfick_project.norms import dictobj, sb
+from unittest import mock
+import threading
+import pickle
+import asyncio
+import pytest
+import time
+import os
+
+store = Store(formatter=MergedOptionStringFormatter)
+
+
+@store.command("where", executor="thread")
+class Where(store.Command):
+    progress_cb = store.injected("progress_cb")
+
+    value = dictobj.Field(sb.integer_spec, wrapper=sb.required)
+
+    async def execute(self):
+        self.progress_cb("running", thread=threading.current_thread().name)
+        return {"value": self.value, "thread": threading.current_thread().name}
+
+
+@store.command("block", executor="thread")
+class Block(store.Command):
+    async def execute(self):
+        while True:
+            await asyncio.sleep(0.01)
+
+
+@store.command("pid", executor="process")
+class Pid(store.Command):
+    progress_cb = store.injected("progress_cb")
+    request_handler = store.injected("request_handler")
+
+    value = dictobj.Field(sb.integer_spec, wrapper=sb.required)
+
+    async def execute(self):
+        assert self.request_handler is None
+        self.progress_cb("running", value=self.value)
+        return {"value": self.value, "pid": os.getpid()}
+
+
+@store.command("wait_forever", executor="process")
+class WaitForever(store.Command):
+    path = dictobj.Field(sb.string_spec, wrapper=sb.required)
+
+    async def execute(self):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            with open(self.path, "w") as fle:
+                fle.write("cancelled")
+            raise
+
+
+async def execute(command, args=None, progress_cb=None):
+    executor = Commander(store).executor(progress_cb or mock.Mock(name="progress_cb"), mock.Mock())
+    return await executor.execute("/v1", {"command": command, "args": args or {}})
+
+
+describe "PoolRunner":
+    it "complains about unknown executors":
+        with pytest.raises(UnknownExecutor):
+            PoolRunner("elsewhere", Where)
+
+    it "doesn't run interactive commands in a pool":
+        other = Store()
+
+        with pytest.raises(CantPoolInteractive):
+
+            @other.command("interactive", executor="thread")
+            class Interactive(other.Command):
+                async def execute(self, messages):
+                    pass
+
+    async it "runs commands in a thread":
+        progress_cb = mock.Mock(name="progress_cb")
+        result = await execute("where", {"value": 1}, progress_cb)
+
+        assert result["value"] == 1
+        assert result["thread"].startswith("whirlwind-command")
+        progress_cb.assert_called_once_with("running", thread=result["thread"])
+
+    async it "cancels commands in a thread":
+        pools = Pools(threads=1)
+        runner = PoolRunner("thread", Block, pools=pools)
+
+        try:
+            task = asyncio.ensure_future(runner.run(Block()))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+            # The thread is free again once the command was cancelled
+            fut = pools.thread_pool().submit(lambda: True)
+            assert await asyncio.wrap_future(fut)
+        finally:
+            pools.shutdown()
+
+    async it "runs commands in a process", tmp_path:
+        progress_cb = mock.Mock(name="progress_cb")
+        result = await execute("pid", {"value": 2}, progress_cb)
+
+        assert result["value"] == 2
+        assert result["pid"] != os.getpid()
+        progress_cb.assert_called_once_with("running", value=2)
+
+        path = str(tmp_path / "cancelled")
+        task = asyncio.ensure_future(execute("wait_forever", {"path": path}))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        start = time.time()
+        while not os.path.exists(path) and time.time() - start < 5:
+            await asyncio.sleep(0.05)
+
+        with open(path) as fle:
+            assert fle.read() == "cancelled"
+
+    async it "complains about commands that can't be pickled":
+        other = Store()
+
+        @other.command("local", executor="process")
+        class Local(other.Command):
+            async def execute(self):
+                return True
+
+        pools = Pools(processes=1)
+        runner = PoolRunner("process", Local, pools=pools)
+
+        try:
+            with pytest.raises((pickle.PicklingError, AttributeError)):
+                await asyncio.wait_for(runner.run(Local()), timeout=5)
+        finally:
+            pools.shutdown()
+
+    it "uses whatever default_pools is when it runs":
+        runner = PoolRunner("thread", Where)
+        assert runner.pools is pools_module.default_pools
+
+        pools = Pools()
+        with mock.patch.object(pools_module, "default_pools", pools):
+            assert runner.pools is pools
+
+        assert PoolRunner("thread", Where, pools=pools).pools is pools
+
+    async it "starts the manager away from the event loop":
+        pools = Pools(processes=1)
+        made_on = []
+        manager = pools.manager
+
+        def make_manager():
+            made_on.append(threading.current_thread().name)
+            return manager()
+
+        progress_cb = mock.Mock(name="progress_cb")
+        command = dict.__new__(Pid)
+        command.value = 3
+        command.progress_cb = progress_cb
+        command.request_handler = None
+
+        try:
+            with mock.patch.object(pools, "manager", make_manager):
+                runner = PoolRunner("process", Pid, pools=pools)
+                results = await asyncio.gather(runner.run(command), runner.run(command))
+
+            assert [r["value"] for r in results] == [3, 3]
+            assert made_on == ["whirlwind-process_0"]
+            assert progress_cb.mock_calls == [mock.call("running", value=3)] * 2
+        finally:
+            pools.shutdown()
@@ -1,11 +1,26 @@
 # coding: spec
 
-from whirlwind.server import wait_for_futures, Server
+from whirlwind.request_handlers.base import Simple, SimpleWebSocketBase
+from whirlwind.server import (
+    wait_for_futures,
+    WorkerSupervisor,
+    UnixListener,
+    TCPListener,
+    Server,
+)
 from whirlwind import test_helpers as thp
 
+from tornado.httpclient import AsyncHTTPClient
+from tornado.web import RequestHandler
 from unittest import mock
 import asynctest
 import asyncio
+import signal
+import socket
+import pytest
+import json
+import time
+import os
 
 describe "wait_for_futures":
 
@@ -43,6 +58,21 @@ describe "wait_for_futures":
         for fut in futures.values():
             assert fut.done()
 
+    async it "cancels futures that are still going after the timeout":
+        quick = asyncio.Future()
+        asyncio.get_event_loop().call_later(0.05, quick.set_result, True)
+
+        slow1 = asyncio.Future()
+        slow2 = asyncio.Future()
+
+        start = time.time()
+        await wait_for_futures([quick, slow1, slow2], timeout=0.2)
+        assert time.time() - start < 0.5
+
+        assert quick.result() is True
+        assert slow1.cancelled()
+        assert slow2.cancelled()
+
 describe "setup":
 
     class assertSetupWorks:
@@ -132,3 +162,340 @@ describe "setup":
         async with self.assertSetupWorks(self, None, c, d=d) as (routes, setup, FakeApplication):
             setup.assert_called_once_with(c, d=d)
             FakeApplication.assert_called_once_with(routes)
+
+describe "listeners":
+
+    @pytest.fixture()
+    def S(self):
+        class Handler(Simple):
+            async def do_get(s):
+                sock = s.request.connection.stream.socket
+                nodelay = None
+                if sock.family != socket.AF_UNIX:
+                    nodelay = bool(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+                return {"protocol": s.request.protocol, "nodelay": nodelay}
+
+        class WSH(SimpleWebSocketBase):
+            async def process_message(s, path, body, message_id, message_key, progress_cb):
+                return {"echo": body}
+
+        class S(Server):
+            async def setup(s):
+                s.wsconnections = {}
+
+            async def cleanup(s):
+                await wait_for_futures(s.wsconnections)
+
+            def tornado_routes(s):
+                return [
+                    ("/info", Handler),
+                    ("/v1/ws", WSH, {"server_time": 1.0, "wsconnections": s.wsconnections}),
+                ]
+
+        return S
+
+    async it "serves one application from tcp and unix sockets", S, tmp_path:
+        port = thp.free_port()
+        path = str(tmp_path / "whirlwind.sock")
+
+        tcp = TCPListener("127.0.0.1", port, nodelay=True, backlog=10)
+        unix = UnixListener(path)
+
+        final_future = asyncio.Future()
+        t = thp.async_as_background(S(final_future).serve(listeners=[tcp, unix]))
+
+        try:
+            start = time.time()
+            while time.time() - start < 5:
+                if thp.port_connected(port) and thp.port_connected(path):
+                    break
+                await asyncio.sleep(0.01)
+
+            response = await AsyncHTTPClient().fetch(f"http://127.0.0.1:{port}/info")
+            assert json.loads(response.body.decode()) == {"protocol": "http", "nodelay": True}
+
+            client = AsyncHTTPClient(
+                force_instance=True, resolver=thp.UnixResolver(socket_path=path)
+            )
+            try:
+                response = await client.fetch("http://localhost/info")
+                assert json.loads(response.body.decode()) == {"protocol": "http", "nodelay": None}
+            finally:
+                client.close()
+        finally:
+            final_future.cancel()
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+
+        assert not thp.port_connected(port)
+        assert not os.path.exists(path)
+
+    async it "closes what it bound if a later listener fails", S, tmp_path:
+        path = str(tmp_path / "whirlwind.sock")
+
+        taken = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        taken.bind(("127.0.0.1", 0))
+        taken.listen(1)
+        port = taken.getsockname()[1]
+
+        unix = UnixListener(path)
+        bound = []
+        original = unix.bind
+
+        def bind():
+            bound.extend(original())
+            return bound
+
+        unix.bind = bind
+        server = S(asyncio.Future())
+        server.setup = asynctest.mock.CoroutineMock(name="setup")
+
+        try:
+            with pytest.raises(OSError):
+                await server.serve(listeners=[unix, TCPListener("127.0.0.1", port)])
+        finally:
+            taken.close()
+
+        assert len(server.setup.mock_calls) == 0
+        assert [sock.fileno() for sock in bound] == [-1]
+        assert not os.path.exists(path)
+
+    async it "can set socket options on the tcp socket":
+        listener = TCPListener(
+            "127.0.0.1",
+            thp.free_port(),
+            nodelay=True,
+            socket_options=[(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)],
+        )
+        sockets = listener.bind()
+        try:
+            for sock in sockets:
+                assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+                assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        finally:
+            for sock in sockets:
+                sock.close()
+
+    async it "lets the ServerRunner use a unix socket", S, tmp_path, asserter:
+        path = str(tmp_path / "runner.sock")
+        final_future = asyncio.Future()
+
+        async with thp.ServerRunner(final_future, path, S(final_future), None) as runner:
+            assert runner.unix_socket == path
+            await runner.assertGET(
+                asserter, "/info", json_output={"protocol": "http", "nodelay": None}
+            )
+
+            async with runner.ws_stream(asserter) as stream:
+                await stream.start("/one", {"two": 3})
+                await stream.check_reply({"echo": {"two": 3}})
+
+        assert not os.path.exists(path)
+
+describe "draining":
+
+    @pytest.fixture()
+    def V(self):
+        class V:
+            release = asyncio.Future()
+            cleaned = asyncio.Future()
+            ws_cancelled = asyncio.Future()
+
+            class SlowHandler(Simple):
+                async def do_get(s):
+                    await V.release
+                    return {"released": True}
+
+            class WSHandler(SimpleWebSocketBase):
+                async def process_message(s, path, body, message_id, message_key, progress_cb):
+                    if body == "forever":
+                        try:
+                            await asyncio.Future()
+                        except asyncio.CancelledError:
+                            V.ws_cancelled.set_result(True)
+                            raise
+                    await V.release
+                    return {"released": body}
+
+            class S(Server):
+                async def setup(s):
+                    s.wsconnections = {}
+
+                async def cleanup(s):
+                    V.cleaned.set_result(True)
+
+                def tornado_routes(s):
+                    return [
+                        ("/slow", V.SlowHandler),
+                        (
+                            "/v1/ws",
+                            V.WSHandler,
+                            {"server_time": None, "wsconnections": s.wsconnections},
+                        ),
+                    ]
+
+        return V
+
+    async it "lets in flight requests finish before cleanup", V:
+        final_future = asyncio.Future()
+        runner = thp.ServerRunner(
+            final_future, thp.free_port(), V.S(final_future, drain_timeout=5), None
+        )
+        await runner.start()
+
+        try:
+            url = f"http://127.0.0.1:{runner.port}/slow"
+            request = asyncio.ensure_future(AsyncHTTPClient().fetch(url))
+
+            connection = await runner.ws_connect(skip_hook=True)
+            await runner.ws_write(connection, {"path": "/", "body": "one", "message_id": "1"})
+            await asyncio.sleep(0.05)
+
+            closer = thp.async_as_background(runner.close(None, None, None))
+
+            closing = await runner.ws_read(connection)
+            assert closing == {
+                "reply": {"closing": "server shutting down"},
+                "message_id": "__server_closing__",
+            }
+
+            await runner.ws_write(connection, {"path": "/", "body": "two", "message_id": "2"})
+            assert await runner.ws_read(connection) == {
+                "reply": {
+                    "status": 503,
+                    "error": "Server is shutting down",
+                    "error_code": "ServerShuttingDown",
+                },
+                "message_id": "2",
+            }
+
+            assert not V.cleaned.done()
+            V.release.set_result(True)
+
+            response = await request
+            assert response.code == 200
+            assert json.loads(response.body.decode()) == {"released": True}
+
+            assert await runner.ws_read(connection) == {
+                "reply": {"released": "one"},
+                "message_id": "1",
+            }
+
+            await closer
+            assert V.cleaned.done()
+        finally:
+            await runner.closer()
+
+    async it "cancels whatever is left after the drain timeout", V:
+        final_future = asyncio.Future()
+        runner = thp.ServerRunner(
+            final_future, thp.free_port(), V.S(final_future, drain_timeout=0.1), None
+        )
+        await runner.start()
+
+        try:
+            connection = await runner.ws_connect(skip_hook=True)
+            await runner.ws_write(connection, {"path": "/", "body": "forever", "message_id": "1"})
+            await asyncio.sleep(0.05)
+
+            await runner.close(None, None, None)
+            assert V.ws_cancelled.done()
+            assert V.cleaned.done()
+
+            assert await runner.ws_read(connection) == {
+                "reply": {"closing": "server shutting down"},
+                "message_id": "__server_closing__",
+            }
+            assert await runner.ws_read(connection) == {
+                "reply": {
+                    "status": 503,
+                    "error": "Server is shutting down",
+                    "error_code": "ServerShuttingDown",
+                },
+                "message_id": "1",
+            }
+        finally:
+            await runner.closer()
+
+describe "workers":
+
+    @pytest.fixture()
+    def record_dir(self, tmp_path):
+        return tmp_path
+
+    def started_pids(self, record_dir):
+        return sorted(int(p.name.split("-")[1]) for p in record_dir.glob("setup-*"))
+
+    def cleaned_pids(self, record_dir):
+        return sorted(int(p.name.split("-")[1]) for p in record_dir.glob("cleanup-*"))
+
+    async def wait_for(self, check, timeout=5):
+        start = time.time()
+        while time.time() - start < timeout:
+            if check():
+                return
+            await asyncio.sleep(0.05)
+        assert False, "Timed out waiting for check"
+
+    it "backs off restarting workers that keep dying":
+        server = Server(
+            asyncio.Future(), num_workers=1, worker_restart_delay=1, worker_restart_max_delay=10
+        )
+        supervisor = WorkerSupervisor(server, [], 1, (), {})
+
+        now = 100
+        with mock.patch("time.time", lambda: now):
+            supervisor.started[0] = now
+            assert [supervisor.restart_delay(0) for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+
+            # A worker that ran for a while starts with a short delay again
+            now = 111
+            assert supervisor.restart_delay(0) == 1
+            supervisor.started[0] = now
+            assert supervisor.restart_delay(0) == 2
+
+    async it "forks workers that each run setup and cleanup and restarts ones that die", record_dir:
+
+        class PidHandler(RequestHandler):
+            def get(s):
+                s.write(str(os.getpid()))
+
+        class S(Server):
+            async def setup(s, directory):
+                s.directory = directory
+                (directory / f"setup-{os.getpid()}").touch()
+
+            async def cleanup(s):
+                (s.directory / f"cleanup-{os.getpid()}").touch()
+
+            def tornado_routes(s):
+                return [("/pid", PidHandler)]
+
+        port = thp.free_port()
+        final_future = asyncio.Future()
+        server = S(final_future, num_workers=2, worker_restart_delay=0.01)
+        t = thp.async_as_background(server.serve("127.0.0.1", port, record_dir))
+
+        try:
+            await self.wait_for(lambda: len(self.started_pids(record_dir)) == 2)
+            first, second = self.started_pids(record_dir)
+
+            response = await AsyncHTTPClient().fetch(f"http://127.0.0.1:{port}/pid")
+            assert int(response.body.decode()) in (first, second)
+
+            os.kill(first, signal.SIGKILL)
+            await self.wait_for(lambda: len(self.started_pids(record_dir)) == 3)
+
+            running = [pid for pid in self.started_pids(record_dir) if pid != first]
+            assert second in running
+        finally:
+            final_future.cancel()
+            try:
+                await asyncio.wait_for(t, timeout=15)
+            except asyncio.CancelledError:
+                pass
+
+        assert self.cleaned_pids(record_dir) == running
+        assert not thp.port_connected(port)
@@ -0,0 +1,134 @@
+# coding: spec
+
+from whirlwind.validators import CompiledFieldSpec
+from whirlwind.store import Store
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+from delfick_project.norms import dictobj, sb, Meta, BadSpec
+from unittest import mock
+import pytest
+
+store = Store(formatter=MergedOptionStringFormatter)
+
+
+class Thing(store.Command):
+    finder = store.injected("finder")
+
+    name = dictobj.Field(sb.string_spec, wrapper=sb.required)
+    count = dictobj.Field(sb.integer_spec, default=1)
+    ratio = dictobj.NullableField(sb.float_spec)
+    on = dictobj.Field(sb.boolean, default=False)
+    extra = dictobj.Field(sb.dictionary_spec)
+    anything = dictobj.Field(sb.any_spec)
+    choice = dictobj.Field(sb.string_choice_spec(["a", "b"]), default="a")
+
+
+@pytest.fixture()
+def meta():
+    return Meta({"finder": mock.Mock(name="finder")}, []).at("args")
+
+
+describe "CompiledFieldSpec":
+
+    def assertSame(self, meta, val):
+        generic = Thing.FieldSpec(formatter=MergedOptionStringFormatter)
+        compiled = CompiledFieldSpec(Thing, formatter=MergedOptionStringFormatter)
+
+        try:
+            want = generic.normalise(meta, val)
+        except BadSpec as error:
+            with pytest.raises(BadSpec) as got:
+                compiled.normalise(meta, val)
+            assert got.value == error
+            return error
+
+        got = compiled.normalise(meta, val)
+        assert isinstance(got, Thing)
+        assert got == want
+        assert got.finder is meta.everything["finder"]
+        return got
+
+    it "makes the same objects as the FieldSpec", meta:
+        for val in (
+            {"name": "one"},
+            {"name": "one", "count": 3, "ratio": 0.5, "on": True, "choice": "b"},
+            {"name": "one", "ratio": None, "extra": {"a": 1}, "anything": [1]},
+            {"name": "one", "count": "20", "ratio": 1},
+        ):
+            self.assertSame(meta, val)
+
+        assert self.assertSame(meta, {"name": "one", "count": "20"}).count == 20
+
+    it "has the same errors as the FieldSpec", meta:
+        for val in (
+            {},
+            {"name": 1},
+            {"name": "one", "count": True, "on": "yes"},
+            {"name": "one", "ratio": True},
+            {"name": "one", "choice": "c"},
+            {"name": "one", "extra": []},
+            [],
+            "stuff",
+        ):
+            self.assertSame(meta, val)
+
+    it "leaves complaining about invalid classes till it's used":
+
+        class Other(store.Command):
+            finder = store.injected("finder")
+
+        compiled = CompiledFieldSpec(Other)
+        with pytest.raises(BadSpec, match="Need a formatter to be defined"):
+            compiled.empty_normalise()
+
+    it "is used by the store unless asked not to":
+        s = Store()
+
+        @s.command("one")
+        class One(s.Command):
+            pass
+
+        @s.command("two", compiled=False)
+        class Two(s.Command):
+            pass
+
+        assert isinstance(s.paths["/v1"]["one"]["spec"], CompiledFieldSpec)
+        assert not isinstance(s.paths["/v1"]["two"]["spec"], CompiledFieldSpec)
+
+    it "can be registered before lazy field specs can be made", meta:
+        s = Store(formatter=MergedOptionStringFormatter)
+
+        @s.command("lazy")
+        class Lazy(s.Command):
+            later = dictobj.Field(lambda: Later.FieldSpec(), wrapper=sb.required)
+
+        spec = s.paths["/v1"]["lazy"]["spec"]
+        with pytest.raises(NameError):
+            spec.normalise(meta, {"later": {"name": "one"}})
+
+        class Later(dictobj.Spec):
+            name = dictobj.Field(sb.string_spec, wrapper=sb.required)
+
+        got = spec.normalise(meta, {"later": {"name": "one"}})
+        assert isinstance(got, Lazy)
+        assert got.later.name == "one"
+
+    it "normalises every field once even when another field is invalid", meta:
+        called = []
+
+        class counted_spec(sb.Spec):
+            def normalise(self, meta, val):
+                called.append(val)
+                return val
+
+        class Counted(store.Command):
+            counted = dictobj.Field(counted_spec)
+            name = dictobj.Field(sb.string_spec, wrapper=sb.required)
+
+        compiled = CompiledFieldSpec(Counted, formatter=MergedOptionStringFormatter)
+        assert compiled.normalise(meta, {"counted": 1, "name": "one"}).counted == 1
+        assert called == [1]
+
+        with pytest.raises(BadSpec):
+            compiled.normalise(meta, {"counted": 2, "name": 3})
+        assert called == [1, 2]
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Compare the cost of turning a request into a command with the generic specs
+and with the compiled ones the store uses now.
+
+Run it with whirlwind installed::
+
+    python tools/benchmark_command_spec.py
+"""
+from whirlwind.store import Store
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+from delfick_project.norms import dictobj, sb, Meta
+import timeit
+
+
+def make_store():
+    store = Store(formatter=MergedOptionStringFormatter)
+
+    for compiled in (True, False):
+
+        @store.command(f"small_{compiled}", compiled=compiled)
+        class Small(store.Command):
+            matcher = dictobj.Field(sb.dictionary_spec, wrapper=sb.required)
+            power = dictobj.NullableField(sb.string_spec)
+            duration = dictobj.Field(sb.integer_spec, default=1)
+            keep_brightness = dictobj.Field(sb.boolean, default=False)
+
+        @store.command(f"injected_{compiled}", compiled=compiled)
+        class Injected(Small):
+            finder = store.injected("finder")
+
+    return store
+
+
+def generic(store, meta, val):
+    """What command_spec did for every request before the compiled specs"""
+    path_spec = sb.set_options(
+        path=sb.required(sb.string_spec()), allow_ws_only=sb.defaulted(sb.boolean(), False)
+    )
+    body_spec = sb.set_options(
+        body=sb.required(
+            sb.set_options(args=sb.dictionary_spec(), command=sb.required(sb.string_spec()))
+        )
+    )
+
+    path = path_spec.normalise(meta, val)["path"]
+    body = body_spec.normalise(meta, val)["body"]
+    info = store.paths[path][body["command"]]
+    return info["spec"].normalise(meta.at("body").at("args"), body["args"])
+
+
+def main(number=20000):
+    store = make_store()
+    meta = Meta({"finder": object()}, [])
+
+    args = {"matcher": {"label": "kitchen"}, "power": "on", "duration": 2}
+
+    def request(name, compiled):
+        return {"path": "/v1", "body": {"command": f"{name}_{compiled}", "args": args}}
+
+    print(f"{'command':<10}{'generic':>12}{'compiled':>12}")
+    for name in ("small", "injected"):
+        compiled = request(name, True)
+        uncompiled = request(name, False)
+
+        made = store.command_spec.make_command(meta, compiled, None)[0]
+        assert made == generic(store, meta, uncompiled)
+
+        took = [
+            timeit.timeit(lambda: generic(store, meta, uncompiled), number=number),
+            timeit.timeit(
+                lambda: store.command_spec.make_command(meta, compiled, None), number=number
+            ),
+        ]
+
+        print(
+            f"{name:<10}"
+            + "".join(f"{t / number * 1e6:>10.1f}us" for t in took)
+            + f"{took[0] / took[1]:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
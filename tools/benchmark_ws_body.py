@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Compare the cost of parsing websocket messages with 10k element bodies using
+the old recursive ``json_spec`` and the ``json_value_spec`` that replaced it.
+
+Run it with whirlwind installed::
+
+    python tools/benchmark_ws_body.py
+"""
+from whirlwind.request_handlers.base import SimpleWebSocketBase, json_spec
+
+from delfick_project.norms import sb, dictobj, Meta
+import timeit
+import json
+
+recursive_json_spec = sb.match_spec(
+    (bool, sb.any_spec()),
+    (int, sb.any_spec()),
+    (float, sb.any_spec()),
+    (str, sb.any_spec()),
+    (bytes, sb.any_spec()),
+    (list, lambda: sb.listof(recursive_json_spec)),
+    (type(None), sb.any_spec()),
+    fallback=lambda: sb.dictof(sb.string_spec(), recursive_json_spec),
+)
+
+
+class RecursiveWSMessage(dictobj.Spec):
+    path = dictobj.Field(sb.string_spec, wrapper=sb.required)
+    message_id = dictobj.Field(sb.string_spec, wrapper=sb.required)
+    body = dictobj.Field(recursive_json_spec, wrapper=sb.required)
+
+
+bodies = {
+    "10k ints": list(range(10000)),
+    "10k dicts": [{"serial": f"d073d5{i:06d}", "power": i % 2 == 0} for i in range(10000)],
+    "10k keys": {f"key{i}": [i, str(i)] for i in range(10000)},
+}
+
+specs = {
+    "recursive": RecursiveWSMessage.FieldSpec(),
+    "iterative": SimpleWebSocketBase.message_spec,
+}
+
+
+def parse(spec, message):
+    return spec.normalise(Meta.empty(), json.loads(message))
+
+
+def main(number=5):
+    assert SimpleWebSocketBase.WSMessage.fields["body"].spec is json_spec
+
+    print(f"{'body':<12}{'json.loads':>14}" + "".join(f"{name:>14}" for name in specs))
+    for name, body in bodies.items():
+        message = json.dumps({"path": "/v1/lifx/command", "message_id": "1", "body": body})
+
+        loads = timeit.timeit(lambda: json.loads(message), number=number) / number
+        times = [
+            timeit.timeit(lambda: parse(spec, message), number=number) / number
+            for spec in specs.values()
+        ]
+
+        print(f"{name:<12}{loads * 1000:>12.2f}ms" + "".join(f"{t * 1000:>12.2f}ms" for t in times))
+
+
+if __name__ == "__main__":
+    main()
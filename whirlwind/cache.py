@@ -0,0 +1,339 @@
+"""
+Caching and sharing of results for store commands that only read data.
+
+.. code-block:: python
+
+    from whirlwind.cache import CachePolicy
+
+    @store.command("status", cache=CachePolicy(ttl=1, max_entries=100))
+    class Status(store.Command):
+        device = dictobj.Field(sb.string_spec, wrapper=sb.required)
+
+        async def execute(self):
+            ...
+
+Calls to a cached command with the same arguments share one result until that
+result is older than ``ttl`` seconds or is evicted. Injected fields are not
+part of the key, so everything that determines the result must be an argument.
+
+Cached results are given to every caller as is, so they must not be changed
+after they are returned. Commands that return an async iterator have its items
+gathered into a list that is cached and shared instead.
+
+Commands registered with ``coalesce=True`` share one execution between calls
+with the same arguments that happen at the same time. Every caller gets the
+result and the progress messages from that execution. The execution is only
+cancelled once every caller has gone away. It has a ``request_future`` of its
+own, but other injected values, like ``request_handler``, come from the first
+caller.
+
+.. autoclass:: CachePolicy
+
+.. autoclass:: CommandCache
+    :members: invalidate, stats
+
+.. autoclass:: CommandFlights
+    :members: stats
+"""
+from collections import OrderedDict
+import asyncio
+import json
+import time
+
+
+class UnknownEviction(Exception):
+    def __init__(self, eviction):
+        self.eviction = eviction
+        super().__init__(f"Unknown cache eviction policy {eviction!r}, choose 'lru' or 'lfu'")
+
+
+class Uncacheable(Exception):
+    pass
+
+
+def freeze(value):
+    """
+    Turn a value into something we can use as part of a dictionary key
+
+    Every value is kept with its type so that values that are equal but of
+    different types, like ``True``, ``1`` and ``1.0`` or a list and a tuple,
+    don't get the same key.
+    """
+    if isinstance(value, dict):
+        return (type(value), tuple(sorted((k, freeze(v)) for k, v in value.items())))
+    elif isinstance(value, (list, tuple)):
+        return (type(value), tuple(freeze(v) for v in value))
+
+    try:
+        hash(value)
+    except TypeError:
+        raise Uncacheable()
+    return (type(value), value)
+
+
+def json_size(value):
+    return len(json.dumps(value, default=repr))
+
+
+class CachePolicy:
+    """
+    How to cache the results of a command
+
+    ttl
+        How many seconds a result may be used for. None means until it's evicted
+
+    max_entries
+        How many different results to keep
+
+    max_bytes
+        Roughly how many bytes of results to keep, measured by ``size_of``
+
+    eviction
+        Either ``"lru"`` to evict the result used the longest time ago or
+        ``"lfu"`` to evict the result that has been used the least
+
+    size_of
+        A function that returns how many bytes a result takes up. This defaults
+        to the length of the result as json.
+    """
+
+    def __init__(self, *, ttl=None, max_entries=1000, max_bytes=None, eviction="lru", size_of=None):
+        if eviction not in ("lru", "lfu"):
+            raise UnknownEviction(eviction)
+
+        self.ttl = ttl
+        self.eviction = eviction
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size_of = size_of or json_size
+
+
+class Entry:
+    __slots__ = ("result", "expires", "size", "uses")
+
+    def __init__(self, result, expires, size):
+        self.uses = 0
+        self.size = size
+        self.result = result
+        self.expires = expires
+
+
+class CommandKey:
+    """Knows how to make a key from the fields of a command that aren't injected"""
+
+    def __init__(self, kls):
+        self.injected = {}
+        self.keyed_on = []
+        for name, field in kls.fields.items():
+            if isinstance(field, tuple):
+                field = field[1]
+            if getattr(field, "injected_path", None) is not None:
+                self.injected[name] = field.injected_path
+            else:
+                self.keyed_on.append(name)
+        self.keyed_on.sort()
+
+    def key_for(self, command):
+        """Return the key for this command or None if its arguments can't be a key"""
+        try:
+            return tuple((name, freeze(getattr(command, name))) for name in self.keyed_on)
+        except Uncacheable:
+            return None
+
+
+class CommandCache(CommandKey):
+    """
+    The cached results for one command.
+
+    Use ``store.cache_for(name, path=path)`` to get this object for a command.
+    """
+
+    def __init__(self, policy, kls):
+        super().__init__(kls)
+        self.policy = policy
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stored_bytes = 0
+
+    def get(self, key):
+        """Return ``(found, result)`` for this key"""
+        entry = self.entries.get(key)
+
+        if entry is not None and entry.expires is not None and entry.expires <= time.monotonic():
+            self.remove(key)
+            self.expirations += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        entry.uses += 1
+        if self.policy.eviction == "lru":
+            self.entries.move_to_end(key)
+        return True, entry.result
+
+    def set(self, key, result):
+        policy = self.policy
+
+        size = 0
+        if policy.max_bytes is not None:
+            size = policy.size_of(result)
+            if size > policy.max_bytes:
+                return
+
+        expires = None
+        if policy.ttl is not None:
+            expires = time.monotonic() + policy.ttl
+
+        if key in self.entries:
+            self.remove(key)
+
+        while self.entries and (
+            len(self.entries) >= policy.max_entries
+            or (policy.max_bytes is not None and self.stored_bytes + size > policy.max_bytes)
+        ):
+            self.evict()
+
+        self.entries[key] = Entry(result, expires, size)
+        self.stored_bytes += size
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.stored_bytes -= entry.size
+
+    def evict(self):
+        if self.policy.eviction == "lru":
+            key = next(iter(self.entries))
+        else:
+            # Ties go to the entry that was added first
+            key = min(self.entries, key=lambda k: self.entries[k].uses)
+
+        self.remove(key)
+        self.evictions += 1
+
+    def invalidate(self, **args):
+        """
+        Forget cached results
+
+        With no arguments everything is forgotten, otherwise only results for
+        calls that had these values for these arguments are forgotten.
+        """
+        if not args:
+            self.entries.clear()
+            self.stored_bytes = 0
+            return
+
+        try:
+            wanted = {name: freeze(value) for name, value in args.items()}
+        except Uncacheable:
+            return
+
+        for key in list(self.entries):
+            values = dict(key)
+            if all(name in values and values[name] == value for name, value in wanted.items()):
+                self.remove(key)
+
+    def stats(self):
+        """
+        Return a dictionary of statistics about this cache
+
+        ``stored_bytes`` is only counted when the policy has ``max_bytes``.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "stored_bytes": self.stored_bytes,
+        }
+
+
+class Flight:
+    """
+    One execution of a command and the progress callbacks waiting on it
+
+    The execution has a ``request_future`` of its own that is cancelled when
+    the execution is finished, rather than the one from the first caller.
+    """
+
+    def __init__(self):
+        self.task = None
+        self.progress_cbs = []
+        self.request_future = asyncio.Future()
+
+    def progress_cb(self, message, stack_extra=0, **kwargs):
+        for progress_cb in list(self.progress_cbs):
+            progress_cb(message, stack_extra=stack_extra + 1, **kwargs)
+
+
+class CommandFlights(CommandKey):
+    """
+    The executions in progress for one command registered with ``coalesce=True``
+    """
+
+    def __init__(self, kls):
+        super().__init__(kls)
+        self.name = kls.__name__
+        self.flights = {}
+
+        self.started = 0
+        self.joined = 0
+
+    async def run(self, key, command, progress_cb, execute):
+        """
+        Return the result of ``execute(command)`` or of the execution already
+        in progress for this key.
+        """
+        flight = self.flights.get(key)
+
+        if flight is None:
+            flight = self.start(key, command, execute)
+        else:
+            self.joined += 1
+
+        flight.progress_cbs.append(progress_cb)
+
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.progress_cbs.remove(progress_cb)
+            if not flight.progress_cbs and not flight.task.done():
+                flight.task.cancel()
+
+    def start(self, key, command, execute):
+        from whirlwind.store import create_task
+
+        flight = self.flights[key] = Flight()
+        self.started += 1
+
+        # The execution gets a copy of the command so progress goes to every
+        # caller and the first caller leaving doesn't cancel its request_future
+        command = command.clone()
+        for name, path in self.injected.items():
+            if path == "progress_cb":
+                setattr(command, name, flight.progress_cb)
+            elif path == "request_future":
+                setattr(command, name, flight.request_future)
+
+        flight.task = create_task(execute(command), name=f"<coalesced: {self.name}>")
+        flight.task.add_done_callback(lambda res: self.finished(key, flight, res))
+        return flight
+
+    def finished(self, key, flight, result):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+        flight.request_future.cancel()
+        if not result.cancelled():
+            result.exception()
+
+    def stats(self):
+        """Return a dictionary of statistics about these executions"""
+        return {"started": self.started, "joined": self.joined, "in_flight": len(self.flights)}
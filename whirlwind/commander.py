@@ -13,16 +13,23 @@ class Command(dictobj.Spec):
 class Commander:
     """
     Entry point for creating an executor to execute commands with
+
+    Set ``metrics`` to a ``whirlwind.metrics.Metrics`` object to record how
+    long each command takes.
     """
 
+    metrics = None
+
     _merged_options_formattable = True
 
     def __init__(self, store, **options):
         self.store = store
 
-        everything = MergedOptions.using(options, {"commander": self}, dont_prefix=[dictobj])
+        # The options for the commander don't change, so they are merged once
+        # and each request layers a small dictionary on top of them
+        self.everything = MergedOptions.using(options, {"commander": self}, dont_prefix=[dictobj])
 
-        self.meta = Meta(everything, [])
+        self.meta = Meta(self.everything, [])
 
     def process_reply(self, msg, exc_info):
         """Hook for every reply and progress message sent to the client"""
@@ -40,6 +47,14 @@ class Executor:
         self.extra_options = extra_options
         self.request_handler = request_handler
 
+        self.context = {
+            "store": commander.store,
+            "executor": self,
+            "progress_cb": progress_cb,
+            "request_handler": request_handler,
+            **extra_options,
+        }
+
     async def execute(self, path, body, extra_options=None, allow_ws_only=False):
         """
         Responsible for creating a command and calling execute on it.
@@ -66,31 +81,99 @@ class Executor:
 
         extra options
             Anything provided as extra_options to this function
+
+        If the command returns an async iterator then we return one that gives
+        the same items and only cancel the ``request_future``, and only record
+        the command as finished, once that is used up or closed.
         """
-        request_future = asyncio.Future()
-        request_future._merged_options_formattable = True
+        execution = Execution(self.commander.metrics, self.commander.store, path, body)
 
         try:
-            everything = MergedOptions.using(
-                self.commander.meta.everything,
-                {
-                    "path": path,
-                    "store": self.commander.store,
-                    "executor": self,
-                    "progress_cb": self.progress_cb,
-                    "request_future": request_future,
-                    "request_handler": self.request_handler,
-                },
-                self.extra_options,
-                extra_options or {},
-                dont_prefix=[dictobj],
+            result = await self.execute_command(
+                path, body, extra_options, allow_ws_only, execution.request_future
             )
+        except BaseException as error:
+            execution.finished(error)
+            raise
+
+        if hasattr(result, "__aiter__"):
+            return execution.stream(result)
+
+        execution.finished()
+        return result
+
+    async def execute_command(self, path, body, extra_options, allow_ws_only, request_future):
+        context = {"path": path, "request_future": request_future}
+        context.update(self.context)
+
+        everything = MergedOptions.using(
+            self.commander.everything, context, extra_options, dont_prefix=[dictobj]
+        )
+
+        meta = Meta(everything, []).at("<input>")
+        execute = self.commander.store.command_spec.normalise(
+            meta, {"path": path, "body": body, "allow_ws_only": allow_ws_only}
+        )
+
+        return await execute()
 
-            meta = Meta(everything, self.commander.meta.path).at("<input>")
-            execute = self.commander.store.command_spec.normalise(
-                meta, {"path": path, "body": body, "allow_ws_only": allow_ws_only}
-            )
 
-            return await execute()
+def command_labels(store, path, command):
+    """
+    Return the path and command to record in metrics, with ``<unknown>`` for
+    anything the store doesn't have so clients can't make up new labels
+    """
+    commands = store.paths.get(path) if type(path) is str else None
+    if commands is None:
+        return "<unknown>", "<unknown>"
+
+    if type(command) is str:
+        if command in commands:
+            return path, command
+
+        # Commands for interactive commands are registered under their parent
+        if any(name.endswith(f":{command}") for name in commands):
+            return path, command
+
+    return path, "<unknown>"
+
+
+class Execution:
+    """
+    The ``request_future`` and metrics for one command, which are finished
+    together when the command is done
+    """
+
+    def __init__(self, metrics, store, path, body):
+        self.request_future = asyncio.Future()
+        self.request_future._merged_options_formattable = True
+
+        self.stats = None
+        if metrics is not None:
+            command = body.get("command") if type(body) is dict else None
+            self.stats, self.start = metrics.command_started(*command_labels(store, path, command))
+
+    def finished(self, error=None):
+        self.request_future.cancel()
+
+        if self.stats is not None:
+            error_code = None
+            if isinstance(error, asyncio.CancelledError):
+                error_code = "Cancelled"
+            elif isinstance(error, Exception):
+                error_code = error.__class__.__name__
+            self.stats.finished(self.start, error_code=error_code)
+
+    async def stream(self, result):
+        """Yield the items from result and finish once it's used up or closed"""
+        error = None
+        try:
+            async for item in result:
+                yield item
+        except BaseException as e:
+            error = e
+            raise
         finally:
-            request_future.cancel()
+            if hasattr(result, "aclose"):
+                await result.aclose()
+            self.finished(error)
@@ -0,0 +1,229 @@
+"""
+Optional collection of metrics about the commands and websocket messages a
+server is processing, served in the Prometheus text format.
+
+.. autoclass:: Metrics
+    :members: route, command_started, message_started, disconnected, render
+
+.. autoclass:: MetricsHandler
+"""
+from tornado.web import RequestHandler
+from bisect import bisect_left
+import time
+
+
+def hdr_bounds(lowest, highest, sub_buckets):
+    """
+    Return the upper bounds for log-linear buckets between lowest and highest
+
+    Like a HDR histogram, every power of two above ``lowest`` is split into
+    ``sub_buckets`` linear buckets so the relative error is the same at every
+    magnitude.
+    """
+    bounds = []
+    base = lowest
+    while base < highest:
+        step = base / sub_buckets
+        for i in range(sub_buckets):
+            bounds.append(base + step * i)
+        base *= 2
+    bounds.append(base)
+    return tuple(bounds)
+
+
+class Histogram:
+    """A histogram of durations that counts values against shared bucket bounds"""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.sum = 0.0
+        self.count = 0
+        self.bounds = bounds
+        # The last slot counts values above our highest bound
+        self.counts = [0] * (len(bounds) + 1)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Stats:
+    """Counts, errors and durations for one command or websocket path"""
+
+    __slots__ = ("total", "in_flight", "errors", "durations")
+
+    def __init__(self, bounds):
+        self.total = 0
+        self.errors = {}
+        self.in_flight = 0
+        self.durations = Histogram(bounds)
+
+    def started(self):
+        self.total += 1
+        self.in_flight += 1
+        return time.perf_counter()
+
+    def finished(self, start, error_code=None):
+        self.in_flight -= 1
+        self.durations.observe(time.perf_counter() - start)
+        if error_code is not None:
+            self.errors[error_code] = self.errors.get(error_code, 0) + 1
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_bound(bound):
+    return f"{bound:.9g}"
+
+
+class Metrics:
+    """
+    Holds metrics for commands and websocket messages.
+
+    Give this to ``whirlwind.server.Server`` as ``metrics`` and the server will
+    serve them from ``metrics_path`` and make them available to the request
+    handlers. Set it as ``metrics`` on your ``Commander`` to time each command.
+
+    Durations are recorded in buckets between ``lowest`` and ``highest`` seconds
+    with ``sub_buckets`` buckets for every power of two.
+
+    Everything here happens on the event loop, so there are no locks and the
+    only objects made on the hot path are for the first time we see a command.
+
+    Paths and commands come from clients, so only ``max_labels`` different
+    paths, and commands for each path, are recorded. Anything after that is
+    recorded as ``<other>``.
+    """
+
+    def __init__(
+        self, *, lowest=0.00001, highest=60, sub_buckets=4, prefix="whirlwind", max_labels=100
+    ):
+        self.prefix = prefix
+        self.max_labels = max_labels
+        self.bounds = hdr_bounds(lowest, highest, sub_buckets)
+
+        self.commands = {}
+        self.messages = {}
+        self.disconnects = {}
+
+    def route(self, path="/metrics"):
+        """Return a tornado route for serving these metrics"""
+        return (path, MetricsHandler, {"metrics": self})
+
+    def label(self, found, value):
+        """Return value or ``<other>`` if found already has too many labels"""
+        if value in found or len(found) < self.max_labels:
+            return value
+        return "<other>"
+
+    def command_stats(self, path, command):
+        path = self.label(self.commands, path)
+        by_command = self.commands.get(path)
+        if by_command is None:
+            by_command = self.commands[path] = {}
+
+        command = self.label(by_command, command)
+        stats = by_command.get(command)
+        if stats is None:
+            stats = by_command[command] = Stats(self.bounds)
+        return stats
+
+    def message_stats(self, path):
+        path = self.label(self.messages, path)
+        stats = self.messages.get(path)
+        if stats is None:
+            stats = self.messages[path] = Stats(self.bounds)
+        return stats
+
+    def command_started(self, path, command):
+        """
+        Record that we started this command and return ``(stats, start)``
+
+        Call ``stats.finished(start, error_code=None)`` when the command is done.
+        """
+        stats = self.command_stats(path, command)
+        return stats, stats.started()
+
+    def message_started(self, path):
+        """Like ``command_started`` but for a websocket message to this path"""
+        stats = self.message_stats(path)
+        return stats, stats.started()
+
+    def disconnected(self, path):
+        """Record that a HTTP request was cancelled because the client went away"""
+        path = self.label(self.disconnects, path)
+        self.disconnects[path] = self.disconnects.get(path, 0) + 1
+
+    def render(self):
+        """Return our metrics in the Prometheus text format"""
+        lines = []
+
+        commands = []
+        for path, by_command in sorted(self.commands.items()):
+            for command, stats in sorted(by_command.items()):
+                labels = f'path="{escape_label(path)}",command="{escape_label(command)}"'
+                commands.append((labels, stats))
+        self.render_stats(lines, "command", "store commands", commands)
+
+        messages = []
+        for path, stats in sorted(self.messages.items()):
+            messages.append((f'path="{escape_label(path)}"', stats))
+        self.render_stats(lines, "ws_message", "websocket messages", messages)
+
+        name = f"{self.prefix}_http_cancelled_on_disconnect_total"
+        lines.append(
+            f"# HELP {name} The number of HTTP requests cancelled because the client went away"
+        )
+        lines.append(f"# TYPE {name} counter")
+        for path, count in sorted(self.disconnects.items()):
+            lines.append(f'{name}{{path="{escape_label(path)}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+    def render_stats(self, lines, kind, description, found):
+        name = f"{self.prefix}_{kind}"
+
+        lines.append(f"# HELP {name}s_total The number of {description} started")
+        lines.append(f"# TYPE {name}s_total counter")
+        for labels, stats in found:
+            lines.append(f"{name}s_total{{{labels}}} {stats.total}")
+
+        lines.append(f"# HELP {name}s_in_flight The number of {description} in progress")
+        lines.append(f"# TYPE {name}s_in_flight gauge")
+        for labels, stats in found:
+            lines.append(f"{name}s_in_flight{{{labels}}} {stats.in_flight}")
+
+        lines.append(f"# HELP {name}_errors_total The number of {description} that failed")
+        lines.append(f"# TYPE {name}_errors_total counter")
+        for labels, stats in found:
+            for error_code, count in sorted(stats.errors.items()):
+                code = escape_label(error_code)
+                lines.append(f'{name}_errors_total{{{labels},error_code="{code}"}} {count}')
+
+        lines.append(f"# HELP {name}_duration_seconds How long {description} took")
+        lines.append(f"# TYPE {name}_duration_seconds histogram")
+        for labels, stats in found:
+            histogram = stats.durations
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                le = format_bound(bound)
+                lines.append(f'{name}_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'{name}_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_duration_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{name}_duration_seconds_count{{{labels}}} {histogram.count}")
+
+
+class MetricsHandler(RequestHandler):
+    """Serves the metrics given to it in the Prometheus text format"""
+
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(self.metrics.render())
@@ -0,0 +1,380 @@
+"""
+Running store commands away from the event loop.
+
+.. code-block:: python
+
+    @store.command("crunch", executor="process")
+    class Crunch(store.Command):
+        progress_cb = store.injected("progress_cb")
+
+        numbers = dictobj.Field(sb.listof(sb.integer_spec()))
+
+        async def execute(self):
+            self.progress_cb("starting")
+            return {"total": expensive(self.numbers)}
+
+Commands given ``executor="thread"`` have their ``execute`` run in an event
+loop of its own on a thread from a thread pool. Calls to ``progress_cb`` are
+passed back to the server's event loop, but every other injected value is used
+from that thread as is.
+
+Commands given ``executor="process"`` are sent to a process pool. Only the
+fields that aren't injected are sent to the process and ``progress_cb`` is
+the only injected field available there. Everything else that is injected is
+None. The command class, its arguments, progress messages and the result must
+all be picklable.
+
+If the request is cancelled then the command's ``execute`` is cancelled in
+the thread or process that is running it.
+
+Both kinds of pool are made the first time they are needed and are sized
+from ``default_pools``. Give ``pool`` to ``store.command`` to use your own
+``concurrent.futures`` executor instead.
+
+Commands in a process send progress back over a queue from a
+``multiprocessing.Manager``. Starting the manager and talking to it blocks, so
+that is done on a thread, and one thread reads the progress from every command.
+
+.. autoclass:: Pools
+"""
+from whirlwind.cache import CommandKey
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import multiprocessing
+import threading
+import pickle
+import asyncio
+import uuid
+
+
+class UnknownExecutor(Exception):
+    def __init__(self, executor):
+        self.executor = executor
+        super().__init__(f"Unknown command executor {executor!r}, choose 'thread' or 'process'")
+
+
+class Pools:
+    """
+    Makes the pools used to run commands.
+
+    ``threads`` and ``processes`` are the number of workers for each pool, with
+    None meaning the ``concurrent.futures`` default.
+
+    Call ``shutdown`` when the server is finished with the pools.
+    """
+
+    def __init__(self, *, threads=None, processes=None):
+        self.threads = threads
+        self.processes = processes
+
+        self._lock = threading.Lock()
+        self._manager = None
+        self._channel = None
+        self._thread_pool = None
+        self._process_pool = None
+        self._channel_pool = None
+
+    def thread_pool(self):
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(
+                max_workers=self.threads, thread_name_prefix="whirlwind-command"
+            )
+        return self._thread_pool
+
+    def process_pool(self):
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.processes)
+        return self._process_pool
+
+    def manager(self):
+        if self._manager is None:
+            self._manager = multiprocessing.Manager()
+        return self._manager
+
+    async def channel(self):
+        """
+        Return the ``ProcessChannel`` for commands in the process pool, making
+        it and the manager on a thread the first time
+        """
+        with self._lock:
+            if self._channel is None:
+                self._channel_pool = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="whirlwind-process"
+                )
+                self._channel = self._channel_pool.submit(
+                    lambda: ProcessChannel(self.manager(), self._channel_pool)
+                )
+            channel = self._channel
+        return await asyncio.wrap_future(channel)
+
+    def shutdown(self, wait=True):
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=wait)
+            self._thread_pool = None
+
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=wait)
+            self._process_pool = None
+
+        if self._channel is not None:
+            if self._channel.exception() is None:
+                self._channel.result().stop()
+            self._channel_pool.shutdown(wait=wait)
+            self._channel = None
+            self._channel_pool = None
+
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+
+default_pools = Pools()
+
+
+class ProcessChannel:
+    """
+    The queue commands in the process pool send progress on and the dictionary
+    used to cancel them, both from a manager.
+
+    Progress is read on a thread of its own and given to the progress callbacks
+    on the event loop of the command. The last thing a command sends is None so
+    we know when all of its progress has been given out.
+    """
+
+    def __init__(self, manager, executor):
+        self.executor = executor
+        self.queue = manager.Queue()
+        self.cancelled = manager.dict()
+
+        self.listeners = {}
+        self.reader = threading.Thread(target=self.read, name="whirlwind-progress", daemon=True)
+        self.reader.start()
+
+    def listen(self, ident, progress_cbs):
+        """Return a future that is resolved when the command has sent everything"""
+        loop = asyncio.get_event_loop()
+        finished = loop.create_future()
+        self.listeners[ident] = (loop, progress_cbs, finished)
+        return finished
+
+    def forget(self, ident):
+        self.listeners.pop(ident, None)
+
+    def cancel(self, ident):
+        """Tell the command to stop if it is still running"""
+        if ident in self.listeners:
+            self.executor.submit(self.cancelled.__setitem__, ident, True)
+
+    def read(self):
+        while True:
+            try:
+                item = self.queue.get()
+            except (EOFError, OSError):
+                # The manager has gone away
+                return
+
+            if item is None:
+                return
+
+            ident, message, kwargs = item
+            if message is None:
+                self.finished(ident)
+                continue
+
+            listener = self.listeners.get(ident)
+            if listener is not None:
+                loop, progress_cbs, _ = listener
+                for progress_cb in progress_cbs:
+                    loop.call_soon_threadsafe(partial(progress_cb, message, **kwargs))
+
+    def finished(self, ident):
+        listener = self.listeners.pop(ident, None)
+        if listener is not None:
+            loop, _, finished = listener
+            loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(True))
+
+    def stop(self):
+        self.queue.put(None)
+        self.reader.join()
+
+
+class Canceller:
+    """Cancels a task on another event loop, even if it hasn't started yet"""
+
+    def __init__(self):
+        self.task = None
+        self.loop = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def started(self, task, loop):
+        with self.lock:
+            self.task = task
+            self.loop = loop
+            if self.cancelled:
+                task.cancel()
+
+    def finished(self):
+        with self.lock:
+            self.task = None
+            self.loop = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.task is not None:
+                self.loop.call_soon_threadsafe(self.task.cancel)
+
+
+def run_command(command, canceller):
+    """Run the command in a new event loop on this thread"""
+    loop = asyncio.new_event_loop()
+    try:
+        task = loop.create_task(command.execute())
+        canceller.started(task, loop)
+        try:
+            return loop.run_until_complete(task)
+        finally:
+            canceller.finished()
+    finally:
+        loop.close()
+
+
+def make_command(kls, values, progress_cb, progress_names):
+    command = dict.__new__(kls)
+
+    for name in kls.fields:
+        if name in values:
+            setattr(command, name, values[name])
+        elif name in progress_names:
+            setattr(command, name, progress_cb)
+        else:
+            setattr(command, name, None)
+
+    return command
+
+
+def run_in_process(payload, progress_names, ident, queue, cancelled):
+    """
+    Make the command from its pickled class and values and run it in this
+    process. We always finish by telling the server we've sent everything.
+    """
+
+    def progress_cb(message, stack_extra=0, **kwargs):
+        queue.put((ident, message, kwargs))
+
+    done = threading.Event()
+    canceller = Canceller()
+
+    def watch():
+        while not done.wait(0.1):
+            if cancelled.get(ident):
+                canceller.cancel()
+                return
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+
+    try:
+        kls, values = pickle.loads(payload)
+        command = make_command(kls, values, progress_cb, progress_names)
+        return run_command(command, canceller)
+    finally:
+        done.set()
+        watcher.join()
+        cancelled.pop(ident, None)
+        queue.put((ident, None, None))
+
+
+class PoolRunner(CommandKey):
+    """Knows how to run a command in a thread or process pool"""
+
+    def __init__(self, executor, kls, pool=None, pools=None):
+        if executor not in ("thread", "process"):
+            raise UnknownExecutor(executor)
+
+        super().__init__(kls)
+        self.kls = kls
+        self.pool = pool
+        self._pools = pools
+        self.executor = executor
+
+        self.progress_names = [
+            name for name, path in self.injected.items() if path == "progress_cb"
+        ]
+
+    @property
+    def pools(self):
+        """The pools we were given or whatever ``default_pools`` is now"""
+        return default_pools if self._pools is None else self._pools
+
+    async def run(self, command):
+        if self.executor == "thread":
+            return await self.run_in_thread(command)
+        else:
+            return await self.run_in_process(command)
+
+    async def run_in_thread(self, command):
+        loop = asyncio.get_event_loop()
+
+        def threadsafe(progress_cb):
+            def progress(*args, **kwargs):
+                loop.call_soon_threadsafe(partial(progress_cb, *args, **kwargs))
+
+            return progress
+
+        for name in self.progress_names:
+            setattr(command, name, threadsafe(getattr(command, name)))
+
+        canceller = Canceller()
+        pool = self.pool or self.pools.thread_pool()
+
+        try:
+            return await loop.run_in_executor(pool, run_command, command, canceller)
+        except asyncio.CancelledError:
+            canceller.cancel()
+            raise
+
+    async def run_in_process(self, command):
+        pools = self.pools
+        channel = await pools.channel()
+        pool = self.pool or pools.process_pool()
+
+        # Pickle the command here so that if it can't be pickled we know
+        # before there is anything to wait for from the process
+        values = {name: getattr(command, name) for name in self.keyed_on}
+        payload = pickle.dumps((self.kls, values))
+
+        ident = str(uuid.uuid4())
+        finished = channel.listen(ident, [getattr(command, name) for name in self.progress_names])
+
+        try:
+            future = pool.submit(
+                run_in_process,
+                payload,
+                self.progress_names,
+                ident,
+                channel.queue,
+                channel.cancelled,
+            )
+        except Exception:
+            channel.forget(ident)
+            raise
+
+        wait = True
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            wait = False
+            channel.cancel(ident)
+            raise
+        except BrokenProcessPool:
+            wait = False
+            channel.forget(ident)
+            raise
+        finally:
+            # Make sure all the progress is given out before the result
+            if wait:
+                await asyncio.shield(finished)
@@ -1,12 +1,22 @@
-from whirlwind.store import create_task
+from whirlwind.request_handlers.encoding import (
+    JsonEncoder,
+    CborEncoder,
+    MsgpackEncoder,
+    MissingEncoderLibrary,
+    default_offload,
+)
+from whirlwind.request_handlers.uploads import Upload, parse_upload_frame
+from whirlwind.store import create_task, current_task
 
-from delfick_project.norms import sb, dictobj, Meta
+from delfick_project.norms import sb, dictobj, Meta, BadSpecValue
 from tornado.web import RequestHandler, HTTPError
+from tornado.iostream import StreamClosedError
 from tornado import websocket
+from functools import partial
 import binascii
 import logging
+import sys
 import asyncio
-import json
 import uuid
 
 log = logging.getLogger("whirlwind.request_handlers.base")
@@ -27,6 +37,31 @@ def reprer(o):
     return repr(o)
 
 
+binary_types = (bytes, bytearray, memoryview)
+
+
+def split_binary(obj, parts):
+    """
+    Return obj with every bytes like value replaced by ``{"__binary__": <index>}``
+    where index is the position of that value in ``parts``
+    """
+    if isinstance(obj, binary_types):
+        parts.append(obj)
+        return {"__binary__": len(parts) - 1}
+    elif type(obj) is dict:
+        return {k: split_binary(v, parts) for k, v in obj.items()}
+    elif type(obj) in (list, tuple):
+        return [split_binary(v, parts) for v in obj]
+    return obj
+
+
+def as_bytes(data):
+    """Tornado only writes bytes, so a bytearray or memoryview has to be copied"""
+    if type(data) is bytes:
+        return data
+    return bytes(data)
+
+
 class MessageFromExc:
     def __init__(self, *, log_exceptions=True):
         self.log_exceptions = log_exceptions
@@ -58,20 +93,44 @@ class AsyncCatcher(object):
         pass
 
     async def __aexit__(self, exc_type, exc, tb):
+        if self.info.get("streamed"):
+            # stream_msg has already dealt with the response
+            return True
+
         if exc is None:
-            self.complete(self.info.get("result"), status=200)
+            result = self.info.get("result")
+            if self.final is None and self.should_stream(result):
+                await self.request.stream_msg(result)
+            elif self.final is None and self.should_offload(result):
+                await self.request.send_offloaded(result)
+            else:
+                self.complete(result, status=200)
             return
 
+        if exc_type is asyncio.CancelledError and getattr(self.request, "disconnected", False):
+            # There is nobody left to tell
+            return True
+
         msg = self.request.message_from_exc(exc_type, exc, tb)
         self.complete(msg, status=500, exc_info=(exc_type, exc, tb))
 
         # And don't reraise the exception
         return True
 
+    def should_stream(self, msg):
+        should_stream = getattr(self.request, "should_stream", None)
+        return should_stream is not None and should_stream(msg)
+
+    def should_offload(self, msg):
+        offload = getattr(self.request, "offload", None)
+        return (
+            offload is not None and not self.request._finished and offload.should_offload_reply(msg)
+        )
+
     def send_msg(self, msg, status=200, exc_info=None):
         if self.request._finished and not hasattr(self.request, "ws_connection"):
             if type(msg) is dict:
-                msg = json.dumps(msg, default=self.request.reprer, sort_keys=True, indent="    ")
+                msg = self.request.encoder.dumps(msg, self.request.reprer)
                 self.request.hook("request_already_finished", msg)
             return
 
@@ -85,14 +144,9 @@ class AsyncCatcher(object):
 
     def complete(self, msg, status=200, exc_info=None):
         if type(msg) is dict:
-            result = json.loads(json.dumps(msg, default=self.request.reprer, indent="    "))
-        else:
-            result = msg
-
-        if type(result) is dict:
-            status = result.get("status", status)
+            status = msg.get("status", status)
 
-        self.send_msg(result, status=status, exc_info=exc_info)
+        self.send_msg(msg, status=status, exc_info=exc_info)
 
 
 class RequestsMixin:
@@ -103,6 +157,12 @@ class RequestsMixin:
 
     _merged_options_formattable = True
 
+    encoder = JsonEncoder()
+    offload = default_offload
+
+    stream_threshold = 1000
+    stream_chunk_size = 64 * 1024
+
     def hook(self, func, *args, **kwargs):
         if hasattr(self, func):
             return getattr(self, func)(*args, **kwargs)
@@ -136,6 +196,22 @@ class RequestsMixin:
     def message_from_exc(self, value):
         self._message_from_exc = value
 
+    @property
+    def in_flight(self):
+        """
+        The ``whirlwind.server.InFlight`` object from the application settings
+        or None if we aren't being served by a ``whirlwind.server.Server``
+        """
+        return self.settings.get("whirlwind_in_flight")
+
+    @property
+    def metrics(self):
+        """
+        The ``whirlwind.metrics.Metrics`` object from the application settings
+        or None if the server isn't collecting metrics
+        """
+        return self.settings.get("whirlwind_metrics")
+
     def async_catcher(self, info, final=None):
         return AsyncCatcher(self, info, final=final)
 
@@ -147,21 +223,181 @@ class RequestsMixin:
         to be the body instead of the request body
         """
         if body is None:
-            if "__body__" in self.request.files:
-                body = self.request.files["__body__"][0]["body"].decode()
-            else:
-                body = self.request.body.decode()
+            body = self.raw_body()
+
+        return self.decode_body(body, self.encoder.loads)
+
+    async def json_body(self, body=None):
+        """
+        The same as ``body_as_json`` but bodies of ``self.offload.threshold``
+        bytes or more are decoded on the offload thread pool
+        """
+        if body is None:
+            body = self.raw_body()
+
+        if type(body) is str and self.offload.should_offload_body(body):
+            return await self.offload.run(self.decode_body, body, self.encoder.loads)
 
+        return self.decode_body(body, self.encoder.loads)
+
+    def raw_body(self):
+        if "__body__" in self.request.files:
+            return self.request.files["__body__"][0]["body"].decode()
+        else:
+            return self.request.body.decode()
+
+    def decode_body(self, body, loads):
         try:
             if type(body) is str:
-                body = json.loads(body)
+                body = loads(body)
         except (TypeError, ValueError) as error:
             log.error("Failed to load body as json\t%s", body)
             raise Finished(status=400, reason="Failed to load body as json", error=error)
 
         return body
 
-    def send_msg(self, msg, status=200, exc_info=None):
+    def should_stream(self, msg):
+        """
+        Return whether this result should be written with ``stream_msg``
+
+        This is any async iterator and any list or tuple with more than
+        ``stream_threshold`` items. Setting ``stream_threshold`` to None means
+        only async iterators are streamed.
+        """
+        if hasattr(msg, "__aiter__"):
+            return True
+        if type(msg) not in (list, tuple) or self.stream_threshold is None:
+            return False
+        return len(msg) > self.stream_threshold
+
+    async def stream_msg(self, msg, status=200):
+        """
+        Write a list or the items from an async iterator as a json list without
+        holding the whole reply in memory.
+
+        Each item is encoded on its own with ``self.encoder`` and the response
+        is flushed every ``stream_chunk_size`` characters.
+
+        If encoding or the async iterator fails before anything is flushed then
+        an error is sent as normal. After that it's too late to send an error,
+        so the error is logged and the connection is closed so the client
+        doesn't mistake what it has for a complete reply. The connection is
+        also closed if we are cancelled.
+        """
+        self.hook("process_reply", msg, exc_info=None)
+
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+
+        try:
+            await self.write_parts(self.encoded_parts(msg))
+        except StreamClosedError:
+            return
+        except asyncio.CancelledError:
+            self.request.connection.close()
+            raise
+        except Exception:
+            exc_info = sys.exc_info()
+            if self._headers_written:
+                log.error(f"Failed to stream reply\tpath={self.request.path}", exc_info=exc_info)
+                self.request.connection.close()
+            else:
+                self.send_msg(self.message_from_exc(*exc_info), status=500, exc_info=exc_info)
+            return
+        finally:
+            if hasattr(msg, "aclose"):
+                await msg.aclose()
+
+        self.finish()
+
+    async def encoded_parts(self, msg):
+        """Yield the json for msg a piece at a time"""
+        if hasattr(msg, "__aiter__"):
+            async for part in self.encoder.aiterencode(msg, self.reprer):
+                yield part
+        else:
+            for part in self.encoder.iterencode(msg, self.reprer):
+                yield part
+
+    async def write_parts(self, parts):
+        """Write these parts of the response, flushing every ``stream_chunk_size`` characters"""
+        pending = []
+        pending_size = 0
+
+        async for part in parts:
+            pending.append(part)
+            pending_size += len(part)
+            if pending_size >= self.stream_chunk_size:
+                self.write("".join(pending).encode())
+                pending.clear()
+                pending_size = 0
+                await self.flush()
+
+        if pending:
+            self.write("".join(pending).encode())
+
+    async def send_offloaded(self, msg, status=200):
+        """Encode msg on the offload thread pool and then send it with ``send_msg``"""
+        if self.multipart_for(msg) is not None:
+            # The bytes are sent as they are rather than encoded with the rest
+            self.send_msg(msg, status)
+            return
+
+        encoded = await self.offload.run(self.encoder.dumpb, msg, self.reprer)
+        self.send_msg(msg, status, encoded=encoded)
+
+    @property
+    def accepts_multipart(self):
+        return "multipart/mixed" in self.request.headers.get("Accept", "")
+
+    def multipart_for(self, msg):
+        """
+        Return ``(structure, parts)`` for ``send_multipart`` if ``msg`` should
+        be sent as ``multipart/mixed``, otherwise return None
+        """
+        if type(msg) not in (dict, list) or not self.accepts_multipart:
+            return None
+
+        parts = []
+        structure = split_binary(msg, parts)
+        if not parts:
+            return None
+        return structure, parts
+
+    def send_multipart(self, structure, parts):
+        """
+        Write a ``multipart/mixed`` response where the first part is the json
+        for ``structure`` and the rest are the binary ``parts`` it refers to with
+        ``{"__binary__": <index>}``. Each binary part has a ``Content-ID`` of its
+        index.
+
+        We set a Content-Length so each part can be written as it is rather than
+        copied into a chunk.
+        """
+        boundary = uuid.uuid4().hex
+
+        pieces = [
+            f"--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n".encode(),
+            self.encoder.dumpb(structure, self.reprer),
+        ]
+        for index, part in enumerate(parts):
+            pieces.append(
+                f"\r\n--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+                f"Content-ID: {index}\r\n\r\n".encode()
+            )
+            pieces.append(as_bytes(part))
+        pieces.append(f"\r\n--{boundary}--\r\n".encode())
+
+        self.set_header("Content-Type", f"multipart/mixed; boundary={boundary}")
+        self.set_header("Content-Length", sum(len(piece) for piece in pieces))
+
+        for piece in pieces:
+            self.write(piece)
+            # A flush per piece means the big parts aren't joined with the rest
+            self.flush().add_done_callback(lambda fut: fut.cancelled() or fut.exception())
+        self.finish()
+
+    def send_msg(self, msg, status=200, exc_info=None, encoded=None):
         """
         This determines what content-type and exact body to write to the response
 
@@ -174,7 +410,13 @@ class RequestsMixin:
 
         If ``msg`` is None, we close without a body.
 
-        * If ``msg`` is a ``dict`` or ``list``, we write it as a json object.
+        * If ``msg`` is ``bytes``, a ``bytearray`` or a ``memoryview`` we write
+          it as ``application/octet-stream``
+        * If ``msg`` is a ``dict`` or ``list`` and the request accepts
+          ``multipart/mixed`` then we use ``send_multipart`` if there are bytes
+          in ``msg``
+        * If ``msg`` is a ``dict`` or ``list``, we write it as a json object
+          using ``self.encoder``, or write ``encoded`` if we were given it.
         * If ``msg`` starts with ``<html>`` or ``<!DOCTYPE html>`` we treat it
           as html content
         * Otherwise we write ``msg`` as ``text/plain``
@@ -198,10 +440,34 @@ class RequestsMixin:
             self.finish()
             return
 
-        if type(msg) in (dict, list):
-            self.set_header("Content-Type", "application/json; charset=UTF-8")
-            self.write(json.dumps(msg, default=self.reprer, sort_keys=True, indent="    "))
-        elif msg.lstrip().startswith("<html>") or msg.lstrip().startswith("<!DOCTYPE html>"):
+        if isinstance(msg, binary_types):
+            self.set_header("Content-Type", "application/octet-stream")
+            self.write(as_bytes(msg))
+            self.finish()
+        elif type(msg) in (dict, list):
+            self.send_json(msg, encoded=encoded)
+        else:
+            self.send_text(msg)
+
+    def send_json(self, msg, encoded=None):
+        """
+        Write msg as json, or as ``multipart/mixed`` if it has bytes and the
+        request accepts that. We don't look for bytes if msg is already encoded.
+        """
+        multipart = self.multipart_for(msg) if encoded is None else None
+        if multipart is not None:
+            self.send_multipart(*multipart)
+            return
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        if encoded is None:
+            encoded = self.encoder.dumpb(msg, self.reprer)
+        self.write(encoded)
+        self.finish()
+
+    def send_text(self, msg):
+        """Write msg as html if it looks like html and as plain text otherwise"""
+        if msg.lstrip().startswith("<html>") or msg.lstrip().startswith("<!DOCTYPE html>"):
             self.write(msg)
         else:
             self.set_header("Content-Type", "text/plain; charset=UTF-8")
@@ -232,57 +498,192 @@ class Simple(RequestsMixin, RequestHandler):
     """
 
     log_exceptions = True
+    cancel_on_disconnect = True
+
+    disconnected = False
+    request_task = None
 
     async def get(self, *args, **kwargs):
         if not hasattr(self, "do_get"):
             raise HTTPError(405)
-
-        info = {"result": None}
-        async with self.async_catcher(info):
-            info["result"] = await self.do_get(*args, **kwargs)
+        await self.run_request(self.do_get, *args, **kwargs)
 
     async def put(self, *args, **kwargs):
         if not hasattr(self, "do_put"):
             raise HTTPError(405)
-
-        info = {"result": None}
-        async with self.async_catcher(info):
-            info["result"] = await self.do_put(*args, **kwargs)
+        await self.run_request(self.do_put, *args, **kwargs)
 
     async def post(self, *args, **kwargs):
         if not hasattr(self, "do_post"):
             raise HTTPError(405)
-
-        info = {"result": None}
-        async with self.async_catcher(info):
-            info["result"] = await self.do_post(*args, **kwargs)
+        await self.run_request(self.do_post, *args, **kwargs)
 
     async def patch(self, *args, **kwargs):
         if not hasattr(self, "do_patch"):
             raise HTTPError(405)
-
-        info = {"result": None}
-        async with self.async_catcher(info):
-            info["result"] = await self.do_patch(*args, **kwargs)
+        await self.run_request(self.do_patch, *args, **kwargs)
 
     async def delete(self, *args, **kwargs):
         if not hasattr(self, "do_delete"):
             raise HTTPError(405)
+        await self.run_request(self.do_delete, *args, **kwargs)
+
+    async def run_request(self, func, *args, **kwargs):
+        """
+        Call ``func`` and send back the result using ``self.async_catcher``
+
+        If the server is tracking in flight requests then ``func`` is run as
+        an in flight task so the server can wait for it when shutting down.
+
+        If the client disconnects before ``func`` is finished then ``func`` is
+        cancelled, unless ``cancel_on_disconnect`` is False.
 
+        A result that is streamed is part of the request, so it is cancelled
+        and waited for in the same way.
+        """
         info = {"result": None}
         async with self.async_catcher(info):
-            info["result"] = await self.do_delete(*args, **kwargs)
+            in_flight = self.in_flight
+            if in_flight is None:
+                coro = self.respond(info, func, *args, **kwargs)
+            else:
+                coro = in_flight.run(self.respond(info, func, *args, **kwargs))
 
+            self.request_task = create_task(coro, name=f"<request: {self.request.path}>")
+            await self.request_task
 
-json_spec = sb.match_spec(
-    (bool, sb.any_spec()),
-    (int, sb.any_spec()),
-    (float, sb.any_spec()),
-    (str, sb.any_spec()),
-    (list, lambda: sb.listof(json_spec)),
-    (type(None), sb.any_spec()),
-    fallback=lambda: sb.dictof(sb.string_spec(), json_spec),
-)
+    async def respond(self, info, func, *args, **kwargs):
+        """
+        Put the result of ``func`` in info for the ``async_catcher`` or stream
+        it now so that streaming is part of the request
+        """
+        result = await func(*args, **kwargs)
+        if self.should_stream(result):
+            info["streamed"] = True
+            await self.stream_msg(result)
+        else:
+            info["result"] = result
+
+    def on_connection_close(self):
+        """Cancel the request if the client went away before we finished it"""
+        super().on_connection_close()
+
+        task = self.request_task
+        if task is None or task.done() or not self.cancel_on_disconnect:
+            return
+
+        self.disconnected = True
+        task.cancel()
+
+        log.info(f"Cancelled request because the client disconnected\tpath={self.request.path}")
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.disconnected(self.request.path)
+        self.hook("request_cancelled_on_disconnect")
+
+
+class json_value_spec(sb.Spec):
+    """
+    Make sure a value is made of only json types. Binary websocket subprotocols
+    can also carry bytes.
+
+    Rather than using a spec for every item, this checks the value with a loop
+    over a stack of containers and returns it as is. So it takes linear time,
+    doesn't recurse for nested values and doesn't make a ``Meta`` for every
+    item. Only when something is wrong, or a container is seen more than once,
+    is the value walked again to find where.
+
+    Values from the cbor subprotocol can share containers and even contain
+    themselves. Sharing is fine, but a value that contains itself is an error.
+    """
+
+    scalars = (bool, int, float, str, bytes, type(None))
+    exact_scalars = frozenset(scalars)
+
+    def normalise_filled(self, meta, val):
+        if not self.is_json(val):
+            self.find_invalid(meta, val)
+        return val
+
+    def is_json(self, val):
+        """Return whether this is json without any container seen twice"""
+        scalars = self.scalars
+        exact = self.exact_scalars
+
+        seen = set()
+        stack = [val]
+        while stack:
+            val = stack.pop()
+            if isinstance(val, scalars):
+                continue
+
+            if id(val) in seen:
+                return False
+            seen.add(id(val))
+
+            items = self.items(val)
+            if items is None:
+                return False
+            stack.extend(item for item in items if type(item) not in exact)
+
+        return True
+
+    def items(self, val):
+        """Return the items in a list or dictionary of json or None"""
+        if type(val) is list or isinstance(val, list):
+            return val
+        elif isinstance(val, dict) and all(type(key) is str for key in val):
+            return val.values()
+        return None
+
+    def find_invalid(self, meta, val):
+        """Raise an error saying where the first thing that isn't json is"""
+        # path is the keys to the container at the top of the stack and
+        # active is the ids of the containers on the stack
+        path = []
+        active = [id(val)]
+        checked = set()
+        stack = [self.children(meta, path, val)]
+
+        while stack:
+            is_dict, items = stack[-1]
+            for key, item in items:
+                if is_dict and not isinstance(key, str):
+                    raise self.invalid(meta, path, "Expected a string", key, key=key)
+
+                if isinstance(item, self.scalars) or id(item) in checked:
+                    continue
+
+                if id(item) in active:
+                    raise self.invalid(meta, path + [key], "Value contains itself", item)
+
+                path.append(key)
+                active.append(id(item))
+                stack.append(self.children(meta, path, item))
+                break
+            else:
+                stack.pop()
+                checked.add(active.pop())
+                if path:
+                    path.pop()
+
+    def children(self, meta, path, val):
+        if isinstance(val, list):
+            return False, enumerate(val)
+        elif isinstance(val, dict):
+            return True, iter(val.items())
+        raise self.invalid(meta, path, "Expected a json value", val)
+
+    def invalid(self, meta, path, message, val, key=sb.NotSpecified):
+        for k in path:
+            meta = meta.indexed_at(k) if type(k) is int else meta.at(k)
+        if key is not sb.NotSpecified:
+            meta = meta.at(key)
+        return BadSpecValue(message, meta=meta, got=type(val))
+
+
+json_spec = json_value_spec()
 
 
 class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
@@ -297,12 +698,69 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
 
     It will respond with messages of the form ``{"reply": <reply>, "message_id": <message_id>}``
 
+    Replies that are ``bytes``, a ``bytearray`` or a ``memoryview`` are sent as
+    ``{"message_id": <message_id>, "binary": <length>}`` followed by a binary
+    frame with the data.
+
     It treats path of ``__tick__`` as special and respond with ``{"reply": {"ok": "thankyou"}, "message_id": "__tick__"}``
 
+    A path of ``__cancel__`` with a body of ``{"message_id": <message_id>}`` cancels the message
+    with that ``message_id`` if it's still being processed. The reply to that message becomes
+    ``{"status": 499, "error": "Cancelled by client", "error_code": "Cancelled"}`` and the reply to
+    the ``__cancel__`` message is ``{"cancelled": <bool>}``
+
+    When the server is shutting down it sends ``{"reply": {"closing": "server shutting down"}, "message_id": "__server_closing__"}``
+    and refuses new messages. Messages that are cancelled because they didn't
+    finish in time get a ``ServerShuttingDown`` reply with a status of 503.
+
     It relies on the client side closing the connection when it's finished.
+
+    When the connection closes, any messages still being processed are cancelled
+    after ``close_grace_period`` seconds, without a reply or an error in the
+    logs. Set ``close_grace_period`` to None to let them finish instead.
+
+    Clients that ask for the ``whirlwind.batched`` subprotocol get frames that
+    are a json list of replies. Replies are collected for ``batch_window``
+    seconds, or until the end of this iteration of the event loop if that is 0,
+    or until there are ``batch_max_replies`` of them, and then sent as one
+    frame. ``flush_stats`` on the handler counts the frames and replies sent to
+    the connection.
+
+    Clients may instead ask for the ``whirlwind.msgpack`` or ``whirlwind.cbor``
+    subprotocols from ``wire_protocols`` to send and receive messages of the
+    same shape as binary frames. Those replies aren't batched.
+
+    Messages with ``"upload": true`` are given the binary data the client sends
+    after them as an ``Upload`` from ``self.upload_for(message_key)``. See
+    ``whirlwind.request_handlers.uploads``. Binary frames on a JSON connection
+    are only treated as upload data if they are for an upload in progress and
+    are otherwise treated as a message like any other.
+
+    Set ``compression_level`` to use permessage-deflate compression with
+    clients that support it. ``compression_mem_level`` is how much memory zlib
+    uses for compression and frames smaller than ``compression_min_size``
+    characters are sent without compression.
     """
 
     log_exceptions = True
+    close_grace_period = 0
+    disconnected = False
+
+    batched_subprotocol = "whirlwind.batched"
+    batch_window = 0
+    batch_max_replies = 500
+
+    batching = False
+
+    wire = None
+    wire_protocols = {"whirlwind.msgpack": MsgpackEncoder, "whirlwind.cbor": CborEncoder}
+
+    upload_max_size = 100 * 1024 * 1024
+    upload_spool_size = 1024 * 1024
+
+    compression_level = None
+    compression_mem_level = 8
+    compression_min_size = 1024
 
     def initialize(self, server_time, wsconnections):
         self.server_time = server_time
@@ -320,41 +778,231 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
     class Closing(object):
         pass
 
+    def get_compression_options(self):
+        if self.compression_level is None:
+            return None
+        return {
+            "compression_level": self.compression_level,
+            "mem_level": self.compression_mem_level,
+        }
+
+    def select_subprotocol(self, subprotocols):
+        for subprotocol in subprotocols:
+            if subprotocol == self.batched_subprotocol:
+                self.batching = True
+                return subprotocol
+
+            if subprotocol in self.wire_protocols:
+                try:
+                    self.wire = self.wire_protocols[subprotocol]()
+                except MissingEncoderLibrary:
+                    continue
+                return subprotocol
+
+        return None
+
     def open(self):
         self.key = str(uuid.uuid1())
         self.connection_future = asyncio.Future()
+
+        self.pending_replies = []
+        self.pending_flush = None
+        self.flush_stats = {
+            "frames": 0,
+            "replies": 0,
+            "bytes": 0,
+            "largest_batch": 0,
+            "compressed": 0,
+        }
+
+        self.tasks = {}
+        self.message_keys = {}
+        self.cancelled_on_close = set()
+        self.cancelled_by_client = set()
+
+        self.uploads = {}
+        self.upload_keys = {}
+
+        in_flight = self.in_flight
+        if in_flight is not None:
+            in_flight.add_websocket(self)
+
         if self.server_time is not None:
             self.reply(self.server_time, message_id="__server_time__")
         self.hook("websocket_opened")
 
-    def reply(self, msg, message_id=None, exc_info=None):
+    def server_closing(self):
+        """Called when the server is shutting down and will soon close this connection"""
+        self.reply({"closing": "server shutting down"}, message_id="__server_closing__")
+
+    def reply(self, msg, message_id=None, exc_info=None, encoded=None):
         if msg is None:
             msg = {"done": True}
 
         # I bypass tornado converting the dictionary so that non jsonable things can be repr'd
         if hasattr(msg, "as_dict"):
             msg = msg.as_dict()
-        reply = {"reply": msg, "message_id": message_id}
-        reply = json.dumps(reply, default=self.reprer).replace("</", "<\\/")
 
-        if message_id not in ("__tick__", "__server_time__"):
+        if self.wire is None and isinstance(msg, binary_types):
+            self.reply_binary(msg, message_id, exc_info=exc_info)
+            return
+
+        reply = encoded
+        if reply is None:
+            reply = self.encode_reply(msg, message_id)
+
+        if message_id not in ("__tick__", "__server_time__", "__server_closing__"):
             self.hook("process_reply", msg, exc_info=exc_info)
 
         if self.ws_connection:
-            self.write_message(reply)
+            self.send_reply(reply)
+
+    def reply_binary(self, data, message_id, exc_info=None):
+        """
+        Send ``{"message_id": <message_id>, "binary": <number of bytes>}`` and
+        then the data in a binary frame of its own
+
+        With the batched subprotocol that message is in a list like every other
+        frame we send.
+        """
+        self.hook("process_reply", data, exc_info=exc_info)
+
+        if not self.ws_connection:
+            return
+
+        data = as_bytes(data)
+        header = self.encoder.dumps(
+            {"message_id": message_id, "binary": len(data)}, self.reprer, pretty=False
+        )
+
+        if self.batching:
+            # The binary frame must come straight after the message about it
+            self.flush_replies()
+            header = f"[{header}]"
+
+        self.write_frame(header, 1)
+        self.write_frame(data, 0)
+
+    def send_reply(self, reply):
+        """Write this encoded reply now or add it to the next batched frame"""
+        if not self.batching:
+            self.write_frame(reply, 1)
+            return
+
+        self.pending_replies.append(reply)
+
+        if len(self.pending_replies) >= self.batch_max_replies:
+            self.flush_replies()
+        elif self.pending_flush is None:
+            loop = asyncio.get_event_loop()
+            if self.batch_window > 0:
+                self.pending_flush = loop.call_later(self.batch_window, self.flush_replies)
+            else:
+                self.pending_flush = loop.call_soon(self.flush_replies)
+
+    def flush_replies(self):
+        """Send the replies waiting to be batched as one frame"""
+        if self.pending_flush is not None:
+            self.pending_flush.cancel()
+            self.pending_flush = None
+
+        if not self.pending_replies:
+            return
+
+        replies = self.pending_replies
+        self.pending_replies = []
+
+        if self.ws_connection:
+            self.write_frame("[" + ",".join(replies) + "]", len(replies))
+
+    def write_frame(self, frame, count):
+        stats = self.flush_stats
+        stats["frames"] += 1
+        stats["replies"] += count
+        stats["bytes"] += len(frame)
+        stats["largest_batch"] = max(stats["largest_batch"], count)
+
+        # Tornado compresses every message once compression is agreed, but
+        # permessage-deflate lets us send small ones as they are. We do that
+        # by taking away the private _compressor of tornado's protocol while
+        # we write, so if tornado doesn't have one it compresses everything
+        protocol = self.ws_connection
+        compressor = getattr(protocol, "_compressor", None)
+        binary = type(frame) is bytes
+        if compressor is None:
+            self.write_message(frame, binary=binary)
+        elif len(frame) < self.compression_min_size:
+            protocol._compressor = None
+            try:
+                self.write_message(frame, binary=binary)
+            finally:
+                protocol._compressor = compressor
+        else:
+            stats["compressed"] += 1
+            self.write_message(frame, binary=binary)
+
+    def close(self, code=None, reason=None):
+        if self.batching:
+            self.flush_replies()
+        super().close(code=code, reason=reason)
+
+    def encode_reply(self, msg, message_id):
+        """Return the json, or bytes for a binary subprotocol, for this reply"""
+        if self.wire is not None:
+            return self.wire.dumpb({"reply": msg, "message_id": message_id}, self.reprer)
+
+        reply = self.encoder.dumps(
+            {"reply": msg, "message_id": message_id}, self.reprer, pretty=False
+        )
+        if "</" in reply:
+            reply = reply.replace("</", "<\\/")
+        return reply
 
     def on_message(self, message):
         self.hook("websocket_message", message)
+
+        if self.wire is None and isinstance(message, bytes) and self.uploads:
+            frame = self.pending_upload_frame(message)
+            if frame is not None:
+                self.upload_chunk(*frame)
+                return
+
+        if self.offload.should_offload_body(message):
+            return self.on_big_message(message)
+
+        try:
+            parsed = self.loads_message(message)
+        except (TypeError, ValueError) as error:
+            self.reply({"error": "Message wasn't valid json\t{0}".format(str(error))})
+            return
+
+        self.on_parsed_message(parsed)
+
+    def loads_message(self, message):
+        if self.wire is not None:
+            return self.wire.loads(message)
+        return self.encoder.loads(message)
+
+    async def on_big_message(self, message):
+        """Decode this message on the offload thread pool before we process it"""
         try:
-            parsed = json.loads(message)
+            parsed = await self.offload.run(self.loads_message, message)
         except (TypeError, ValueError) as error:
             self.reply({"error": "Message wasn't valid json\t{0}".format(str(error))})
             return
 
+        self.on_parsed_message(parsed)
+
+    def on_parsed_message(self, parsed):
         if type(parsed) is dict and "path" in parsed and parsed["path"] == "__tick__":
             parsed["message_id"] = "__tick__"
             parsed["body"] = "__tick__"
 
+        wants_upload = False
+        if type(parsed) is dict and "upload" in parsed:
+            parsed = dict(parsed)
+            wants_upload = parsed.pop("upload") is True
+
         try:
             msg = self.message_spec.normalise(Meta.empty(), parsed)
         except Exception as error:
@@ -366,57 +1014,263 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
                 error = str(error)
 
             self.reply({"error_code": "InvalidMessage", "error": error})
+            return
+
+        if self.handled_straight_away(msg):
+            return
+
+        message_key = str(uuid.uuid4())
+        if wants_upload and not self.start_upload(msg.message_id, message_key):
+            return
+
+        self.start_message(msg, message_key)
+
+    def handled_straight_away(self, msg):
+        """Reply to messages that don't need a task and say if this was one of them"""
+        path = msg.path
+        message_id = msg.message_id
+
+        if path == "__tick__":
+            self.reply({"ok": "thankyou"}, message_id=message_id)
+        elif path == "__cancel__":
+            self.cancel_message(msg.body, message_id)
+        elif path == "__upload__":
+            self.upload_chunk(message_id, msg.body)
+        elif self.in_flight is not None and self.in_flight.draining:
+            self.reply(
+                {
+                    "status": 503,
+                    "error": "Server is shutting down",
+                    "error_code": "ServerShuttingDown",
+                },
+                message_id=message_id,
+            )
         else:
-            path = msg.path
-            body = msg.body
-            message_id = msg.message_id
-            message_key = str(uuid.uuid4())
+            return False
 
-            if path == "__tick__":
-                self.reply({"ok": "thankyou"}, message_id=message_id)
-                return
+        return True
 
-            def on_processed(final, exc_info=None):
-                if final is self.Closing:
-                    self.reply({"closing": "goodbye"}, message_id=message_id)
-                    self.close()
-                else:
-                    self.reply(final, message_id=message_id, exc_info=exc_info)
+    def start_upload(self, message_id, message_key):
+        """Make an upload for this message, or reply and return False if there already is one"""
+        if message_id in self.uploads:
+            self.reply(
+                {
+                    "status": 409,
+                    "error": "There is already an upload for this message_id",
+                    "error_code": "UploadInProgress",
+                },
+                message_id=message_id,
+            )
+            return False
 
-                try:
-                    self.message_done(msg, final, message_key, exc_info=exc_info)
-                except Exception as error:
-                    log.exception(error)
+        upload = Upload(max_size=self.upload_max_size, spool_size=self.upload_spool_size)
+        self.uploads[message_id] = upload
+        self.upload_keys[message_key] = upload
+        return True
 
-            async def doit():
-                info = {}
+    def start_message(self, msg, message_key):
+        """Process this message in a task of its own"""
+        message_id = msg.message_id
+        outcome = {"exc_info": None, "encoded": None, "stats": None}
 
-                def progress_cb(progress, **kwargs):
-                    for m in self.transform_progress(msg, progress, **kwargs):
-                        self.reply(m, message_id=message_id)
+        metrics = self.metrics
+        if metrics is not None:
+            outcome["stats"] = metrics.message_started(self.metrics_path(msg.path))
 
-                async with self.async_catcher(info, on_processed):
-                    result = await self.process_message(
-                        path, body, message_id, message_key, progress_cb
+        t = create_task(
+            self.run_message(msg, message_key, outcome), name=f"<process_command: {msg.body}>"
+        )
+        t.add_done_callback(partial(self.message_task_done, msg, message_key, outcome))
+        self.wsconnections[message_key] = t
+        self.tasks[message_key] = t
+        self.message_keys[message_id] = message_key
+
+        in_flight = self.in_flight
+        if in_flight is not None:
+            in_flight.add_task(t)
+
+    def metrics_path(self, path):
+        """
+        Return the path to record a message to this path against in metrics
+
+        The path comes from the client, so override this to only record the
+        paths you know about.
+        """
+        return path
+
+    async def run_message(self, msg, message_key, outcome):
+        info = {}
+        message_id = msg.message_id
+
+        def progress_cb(progress, **kwargs):
+            for m in self.transform_progress(msg, progress, **kwargs):
+                self.reply(m, message_id=message_id)
+
+        on_processed = partial(self.message_processed, msg, message_key, outcome)
+
+        async with self.async_catcher(info, on_processed):
+            try:
+                result = await self.process_message(
+                    msg.path, msg.body, message_id, message_key, progress_cb
+                )
+
+                if isinstance(result, asyncio.Future) or hasattr(result, "__await__"):
+                    result = await result
+
+                if hasattr(result, "__aiter__"):
+                    # A websocket reply is one message, so gather the items
+                    result = [item async for item in result]
+            except asyncio.CancelledError:
+                if message_key in self.cancelled_by_client:
+                    raise Finished(status=499, error="Cancelled by client", error_code="Cancelled")
+
+                in_flight = self.in_flight
+                if in_flight is not None and in_flight.draining and not self.disconnected:
+                    raise Finished(
+                        status=503, error="Server is shutting down", error_code="ServerShuttingDown"
                     )
+                raise
+
+            if self.offload.should_offload_reply(result):
+                encoded = await self.offload.run(self.encode_reply, result, message_id)
+                outcome["encoded"] = (result, encoded)
 
-                    if isinstance(result, asyncio.Future) or hasattr(result, "__await__"):
-                        result = await result
+            info["result"] = result
 
-                    info["result"] = result
+    def message_processed(self, msg, message_key, outcome, final, exc_info=None):
+        """Send the reply for this message"""
+        message_id = msg.message_id
+        outcome["exc_info"] = exc_info
 
-            def done(res):
-                if message_key in self.wsconnections:
-                    del self.wsconnections[message_key]
+        if final is self.Closing:
+            self.reply({"closing": "goodbye"}, message_id=message_id)
+            self.close()
+        else:
+            encoded = None
+            if outcome["encoded"] is not None and outcome["encoded"][0] is final:
+                encoded = outcome["encoded"][1]
+            self.reply(final, message_id=message_id, exc_info=exc_info, encoded=encoded)
+
+        try:
+            self.message_done(msg, final, message_key, exc_info=exc_info)
+        except Exception as error:
+            log.exception(error)
+
+    def message_task_done(self, msg, message_key, outcome, res):
+        """Forget about this message and record how it went"""
+        message_id = msg.message_id
+
+        self.wsconnections.pop(message_key, None)
+        self.tasks.pop(message_key, None)
+        if self.message_keys.get(message_id) == message_key:
+            del self.message_keys[message_id]
+
+        upload = self.upload_keys.pop(message_key, None)
+        if upload is not None:
+            if self.uploads.get(message_id) is upload:
+                del self.uploads[message_id]
+            upload.close()
+
+        error_code = self.message_error_code(message_key, outcome, res)
 
-                if not res.cancelled():
-                    exc = res.exception()
-                    if exc and self.log_exceptions:
-                        log.exception(exc, exc_info=(type(exc), exc, exc.__traceback__))
+        if outcome["stats"] is not None:
+            stats, start = outcome["stats"]
+            stats.finished(start, error_code=error_code)
 
-            t = create_task(doit(), name=f"<process_command: {body}>")
-            t.add_done_callback(done)
-            self.wsconnections[message_key] = t
+    def message_error_code(self, message_key, outcome, res):
+        """Return the error code to record for this finished message, if any"""
+        error_code = None
+
+        if res.cancelled():
+            error_code = "Cancelled"
+        else:
+            exc = res.exception()
+            if exc:
+                error_code = exc.__class__.__name__
+                if self.log_exceptions:
+                    log.exception(exc, exc_info=(type(exc), exc, exc.__traceback__))
+            elif outcome["exc_info"]:
+                error_code = outcome["exc_info"][0].__name__
+
+        if message_key in self.cancelled_on_close:
+            self.cancelled_on_close.discard(message_key)
+            error_code = "CancelledOnClose"
+
+        if message_key in self.cancelled_by_client:
+            self.cancelled_by_client.discard(message_key)
+            error_code = "CancelledByClient"
+
+        return error_code
+
+    def upload_for(self, message_key):
+        """Return the ``Upload`` for this message or None if it didn't have one"""
+        return self.upload_keys.get(message_key)
+
+    def pending_upload_frame(self, frame):
+        """Return ``(message_id, data)`` if this frame is for an upload in progress"""
+        try:
+            message_id, data = parse_upload_frame(frame)
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+        if message_id in self.uploads:
+            return message_id, data
+
+    def upload_chunk(self, message_id, data):
+        """Add this data to the upload for this message_id, or finish it if there is no data"""
+        upload = self.uploads.get(message_id)
+        if upload is None:
+            self.reply(
+                {
+                    "status": 404,
+                    "error": "No upload in progress for this message_id",
+                    "error_code": "NoSuchUpload",
+                },
+                message_id=message_id,
+            )
+            return
+
+        if not data:
+            upload.finish()
+        elif isinstance(data, binary_types):
+            upload.add(data)
+        else:
+            self.reply(
+                {
+                    "status": 400,
+                    "error": "Upload data must be bytes",
+                    "error_code": "InvalidUpload",
+                },
+                message_id=message_id,
+            )
+
+    def cancel_message(self, body, message_id):
+        """Cancel the message with the ``message_id`` in this body"""
+        wanted = body.get("message_id") if type(body) is dict else None
+        if type(wanted) is list:
+            wanted = tuple(wanted)
+
+        task = None
+        message_key = None
+        if isinstance(wanted, (str, tuple)):
+            message_key = self.message_keys.get(wanted)
+            task = self.tasks.get(message_key)
+
+        if task is None or task.done():
+            self.reply(
+                {
+                    "cancelled": False,
+                    "error": "No such message in progress",
+                    "error_code": "NoSuchMessage",
+                    "wanted": wanted,
+                },
+                message_id=message_id,
+            )
+            return
+
+        self.cancelled_by_client.add(message_key)
+        task.cancel()
+        self.reply({"cancelled": True}, message_id=message_id)
 
     def message_done(self, request, final, message_key, exc_info=None):
         """
@@ -478,4 +1332,44 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
 
     def on_close(self):
         """Hook for when a websocket connection closes"""
+        self.disconnected = True
         self.connection_future.cancel()
+
+        if self.pending_flush is not None:
+            self.pending_flush.cancel()
+            self.pending_flush = None
+        self.pending_replies = []
+
+        for upload in self.uploads.values():
+            upload.close()
+
+        in_flight = self.in_flight
+        if in_flight is not None:
+            in_flight.remove_websocket(self)
+
+        grace = self.close_grace_period
+        if grace is not None and self.tasks:
+            if grace <= 0:
+                self.cancel_tasks()
+            else:
+                asyncio.get_event_loop().call_later(grace, self.cancel_tasks)
+
+    def cancel_tasks(self):
+        """
+        Cancel the messages from this connection that are still being processed
+
+        The ``websocket_tasks_cancelled`` hook is called with how many were
+        cancelled and they are recorded in metrics with a ``CancelledOnClose``
+        error code.
+        """
+        current = current_task()
+
+        cancelled = 0
+        for message_key, t in list(self.tasks.items()):
+            if t is not current and not t.done():
+                self.cancelled_on_close.add(message_key)
+                t.cancel()
+                cancelled += 1
+
+        if cancelled:
+            self.hook("websocket_tasks_cancelled", cancelled)
@@ -1,8 +1,17 @@
+from whirlwind.request_handlers.multipart import MultipartParser, BadMultipart, multipart_boundary
 from whirlwind.request_handlers.base import Simple, SimpleWebSocketBase, Finished
-from whirlwind.store import NoSuchPath
+from whirlwind.request_handlers.uploads import UploadTooBig
+from whirlwind.store import NoSuchPath, create_task, is_interactive
 
+from tornado.iostream import StreamClosedError
+from tornado.web import stream_request_body
+from collections import deque
+from functools import partial
 import logging
 import inspect
+import asyncio
+import uuid
+import sys
 
 log = logging.getLogger("whirlwind.request_handlers.command")
 
@@ -61,36 +70,299 @@ class ProcessReplyMixin:
             log.exception(error)
 
 
-class CommandHandler(Simple, ProcessReplyMixin):
+class BatchMixin:
+    """
+    Lets a handler run many commands from one ``{"batch": [<body>, ...]}`` body
+
+    At most ``batch_parallelism`` of the commands are run at the same time and
+    the reply is ``{"batch": [<reply>, ...]}`` in the same order as the
+    commands. Each reply is either ``{"status": 200, "result": <result>}`` or the
+    error for that command, which also has a ``status``.
+
+    Progress messages from a command in the batch have a ``batch_index``.
+
+    A batch may have at most ``batch_max_size`` commands.
+    """
+
+    batch_parallelism = 10
+    batch_max_size = 100
+
+    def is_batch(self, body):
+        return type(body) is dict and "batch" in body and "command" not in body
+
+    async def execute_batch(self, body, progress_cb, execute):
+        items = body["batch"]
+        if type(items) is not list or any(type(item) is not dict for item in items):
+            raise Finished(
+                status=400, error="Batch must be a list of commands", error_code="InvalidBatch"
+            )
+
+        if len(items) > self.batch_max_size:
+            raise Finished(
+                status=400,
+                error="Batch has too many commands",
+                error_code="BatchTooBig",
+                max_size=self.batch_max_size,
+            )
+
+        semaphore = asyncio.Semaphore(max(1, self.batch_parallelism))
+
+        async def run(index, item):
+            def item_progress_cb(message, stack_extra=0, **kwargs):
+                progress_cb(message, stack_extra=stack_extra + 1, batch_index=index, **kwargs)
+
+            async with semaphore:
+                try:
+                    result = await execute(item, item_progress_cb)
+                    if hasattr(result, "__aiter__"):
+                        result = [r async for r in result]
+                    return {"status": 200, "result": result}
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    msg = self.message_from_exc(*sys.exc_info())
+                    if type(msg) is not dict or "status" not in msg:
+                        msg = {"status": 500, "error": msg}
+                    return msg
+
+        return {"batch": await asyncio.gather(*[run(i, item) for i, item in enumerate(items)])}
+
+
+async def execute_on_path(executor, path, body, **kwargs):
+    try:
+        return await executor.execute(path, body, **kwargs)
+    except NoSuchPath as error:
+        raise Finished(
+            status=404,
+            wanted=error.wanted,
+            available=error.available,
+            error="Specified path is invalid",
+        )
+
+
+class CommandHandler(Simple, ProcessReplyMixin, BatchMixin):
+    """
+    Executes commands from the body of PUT requests
+
+    If the request has ``application/x-ndjson`` in its Accept header then the
+    response is newline delimited json. Each progress message is written and
+    flushed as ``{"progress": <info>}`` as soon as it happens, and the last
+    line is ``{"reply": <result>}``. Once a line has been sent the status of
+    the response can't change, so the status of an error is only in its reply.
+    """
+
     progress_maker = ProgressMessageMaker
+    ndjson_content_type = "application/x-ndjson"
 
     def initialize(self, commander):
         self.commander = commander
 
+    @property
+    def ndjson(self):
+        """Whether the client asked for progress as newline delimited json"""
+        return self.ndjson_content_type in self.request.headers.get("Accept", "")
+
+    def ndjson_line(self, msg):
+        return self.encoder.dumpb(msg, self.reprer, pretty=False) + b"\n"
+
+    def write_line(self, msg):
+        """Write this progress line to the client straight away"""
+        if self._finished:
+            return
+
+        self.set_header("Content-Type", f"{self.ndjson_content_type}; charset=UTF-8")
+        self.write(self.ndjson_line(msg))
+
+        # Progress callbacks aren't async, so we don't wait for the flush and
+        # a client that went away is dealt with by on_connection_close
+        self.flush().add_done_callback(lambda fut: fut.cancelled() or fut.exception())
+
+    def should_stream(self, msg):
+        if self.ndjson:
+            return False
+        return super().should_stream(msg)
+
+    async def send_offloaded(self, msg, status=200):
+        if not self.ndjson:
+            return await super().send_offloaded(msg, status=status)
+
+        encoded = await self.offload.run(self.ndjson_line, {"reply": msg})
+        self.send_msg(msg, status, encoded=encoded)
+
+    def executor(self, progress_cb):
+        """Return the executor from the commander for running a command"""
+        return self.commander.executor(progress_cb, self)
+
+    def send_msg(self, msg, status=200, exc_info=None, encoded=None):
+        if not self.ndjson:
+            return super().send_msg(msg, status, exc_info=exc_info, encoded=encoded)
+
+        if hasattr(msg, "exc_info") and exc_info is None:
+            exc_info = msg.exc_info
+
+        if hasattr(msg, "as_dict"):
+            msg = msg.as_dict()
+
+        self.hook("process_reply", msg, exc_info=exc_info)
+
+        if not self._headers_written:
+            if type(msg) is dict:
+                status = msg.get("status", status)
+            self.set_status(status)
+            self.set_header("Content-Type", f"{self.ndjson_content_type}; charset=UTF-8")
+
+        if encoded is None:
+            encoded = self.ndjson_line({"reply": msg})
+        self.write(encoded)
+        self.finish()
+
     async def do_put(self):
-        j = self.body_as_json()
+        j = await self.json_body()
+        ndjson = self.ndjson
 
         def progress_cb(message, stack_extra=0, **kwargs):
             maker = self.progress_maker(1 + stack_extra)
             info = maker(j, message, **kwargs)
             self.process_reply(info)
+            if ndjson:
+                self.write_line({"progress": info})
 
         path = self.request.path
         while path and path.endswith("/"):
             path = path[:-1]
 
+        if self.is_batch(j):
+
+            async def execute(body, progress_cb):
+                return await execute_on_path(self.executor(progress_cb), path, body)
+
+            return await self.execute_batch(j, progress_cb, execute)
+
+        result = await execute_on_path(self.executor(progress_cb), path, j)
+
+        if ndjson and hasattr(result, "__aiter__"):
+            # The reply is one line, so gather the items
+            result = [item async for item in result]
+
+        return result
+
+
+@stream_request_body
+class StreamingCommandHandler(CommandHandler):
+    """
+    A ``CommandHandler`` that parses the body as it arrives
+
+    The files in a ``multipart/form-data`` body are written to temporary files
+    once they are bigger than ``upload_spool_size`` bytes instead of being held
+    in memory. Commands get them as ``store.injected("files")``, which is a
+    dictionary of name to a list of
+    ``whirlwind.request_handlers.multipart.FormFile``. The body of the command
+    comes from the ``__body__`` part.
+
+    A multipart body bigger than ``upload_max_size`` bytes, or a part without a
+    filename bigger than ``upload_field_max_size`` bytes, gets a 413 and an
+    invalid multipart body gets a 400. Other bodies are held in memory, so they
+    keep the ``max_body_size`` tornado was given.
+    """
+
+    upload_max_size = 1024 * 1024 * 1024
+    upload_spool_size = 1024 * 1024
+    upload_field_max_size = 1024 * 1024
+
+    def prepare(self):
+        self.parser = None
+        self.body_chunks = []
+        self.body_error = None
+
+        boundary = multipart_boundary(self.request.headers.get("Content-Type", ""))
+        if boundary is None:
+            return
+
+        if self.upload_max_size is not None:
+            length = self.request.headers.get("Content-Length")
+            if length is not None and length.isdigit() and int(length) > self.upload_max_size:
+                self.send_msg(self.too_big(UploadTooBig(self.upload_max_size)), status=413)
+                return
+
+            self.request.connection.set_max_body_size(self.upload_max_size)
+
+        self.parser = MultipartParser(
+            boundary,
+            max_size=self.upload_max_size,
+            spool_size=self.upload_spool_size,
+            max_field_size=self.upload_field_max_size,
+        )
+
+    def too_big(self, error):
+        return {"status": 413, "error": str(error), "error_code": "UploadTooBig"}
+
+    def data_received(self, chunk):
+        if self.body_error is not None:
+            return
+
+        if self.parser is None:
+            self.body_chunks.append(chunk)
+            return
+
         try:
-            return await self.commander.executor(progress_cb, self).execute(path, j)
-        except NoSuchPath as error:
-            raise Finished(
-                status=404,
-                wanted=error.wanted,
-                available=error.available,
-                error="Specified path is invalid",
-            )
+            self.parser.feed(chunk)
+        except (UploadTooBig, BadMultipart) as error:
+            self.body_error = error
+
+    def finish_body(self):
+        """Complain about a body that was too big or invalid"""
+        try:
+            if self.body_error is not None:
+                raise self.body_error
+            if self.parser is not None:
+                self.parser.finish()
+        except UploadTooBig as error:
+            raise Finished(**self.too_big(error))
+        except BadMultipart as error:
+            raise Finished(status=400, error=str(error), error_code="BadMultipart")
+
+        if self.parser is not None:
+            for name, values in self.parser.arguments.items():
+                self.request.body_arguments.setdefault(name, []).extend(values)
+                self.request.arguments.setdefault(name, []).extend(values)
+
+    def raw_body(self):
+        if self.parser is None:
+            return b"".join(self.body_chunks).decode()
+
+        if "__body__" in self.parser.files:
+            return self.parser.files["__body__"][0].read().decode()
+        elif "__body__" in self.parser.arguments:
+            return self.parser.arguments["__body__"][0].decode()
+        else:
+            return ""
+
+    def executor(self, progress_cb):
+        if self.parser is None:
+            return super().executor(progress_cb)
+        return self.commander.executor(progress_cb, self, files=self.parser.files)
+
+    async def do_put(self):
+        self.finish_body()
+        return await super().do_put()
+
+    def close_files(self):
+        if self.parser is not None:
+            self.parser.close()
+
+    def on_finish(self):
+        super().on_finish()
+        self.close_files()
+
+    def on_connection_close(self):
+        super().on_connection_close()
 
+        # Once the command has started it's closed by on_finish
+        if self.request_task is None:
+            self.close_files()
 
-class WSHandler(SimpleWebSocketBase, ProcessReplyMixin):
+
+class WSHandler(SimpleWebSocketBase, ProcessReplyMixin, BatchMixin):
     progress_maker = ProgressMessageMaker
 
     def initialize(self, server_time, wsconnections, commander):
@@ -101,16 +373,262 @@ class WSHandler(SimpleWebSocketBase, ProcessReplyMixin):
         maker = self.progress_maker(2 + stack_extra)
         yield {"progress": maker(body, progress, **kwargs)}
 
+    def metrics_path(self, path):
+        return path if path in self.commander.store.paths else "<unknown>"
+
+    def is_interactive(self, path, body):
+        """Say if this body is for an interactive command"""
+        name = body.get("command")
+        if type(name) is not str:
+            return False
+
+        info = self.commander.store.paths.get(path, {}).get(name)
+        return info is not None and is_interactive(info["kls"])
+
     async def process_message(self, path, body, message_id, message_key, progress_cb):
+        if self.is_batch(body):
+
+            async def execute(item, progress_cb):
+                if self.is_interactive(path, item):
+                    # Interactive commands need a message_id of their own
+                    raise Finished(
+                        status=400,
+                        error="Interactive commands can't be part of a batch",
+                        error_code="InteractiveInBatch",
+                        wanted=item["command"],
+                    )
+
+                executor = self.commander.executor(
+                    progress_cb, self, message_key=message_key, message_id=message_id
+                )
+                return await execute_on_path(executor, path, item)
+
+            return await self.execute_batch(body, progress_cb, execute)
+
+        extra = {}
+        upload = self.upload_for(message_key)
+        if upload is not None:
+            extra["upload"] = upload
+
+        executor = self.commander.executor(
+            progress_cb, self, message_key=message_key, message_id=message_id, **extra
+        )
+        return await execute_on_path(executor, path, body, allow_ws_only=True)
+
+
+class EventStream:
+    """
+    The events from one command run by an ``SSEHandler``
+
+    Only the last ``max_events`` events are kept for clients that resume.
+    """
+
+    def __init__(self, ident, max_events):
+        self.id = ident
+        self.task = None
+        self.done = False
+        self.count = 0
+        self.listeners = 0
+        self.events = deque(maxlen=max_events)
+        self.changed = asyncio.Event()
+
+    def add(self, event, data):
+        self.count += 1
+        self.events.append((self.count, event, data))
+        self.changed.set()
+
+    def finish(self):
+        self.done = True
+        self.changed.set()
+
+    async def follow(self, after, heartbeat):
+        """
+        Yield ``(number, event, data)`` for every event after ``after`` until
+        the command is finished, and None each time ``heartbeat`` seconds go
+        by without an event.
+        """
+        while True:
+            # Clear before looking so anything added while we are yielding
+            # wakes us straight away
+            self.changed.clear()
+            done = self.done
+
+            for number, event, data in list(self.events):
+                if number > after:
+                    yield number, event, data
+                    after = number
+
+            if done:
+                return
+
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+
+
+class EventStreams:
+    """
+    The event streams an ``SSEHandler`` can resume
+
+    A stream is forgotten ``keep_for`` seconds after its command finishes. If
+    every client of a stream goes away before the command finishes then the
+    command is cancelled if no client resumes it within ``keep_for`` seconds.
+    """
+
+    def __init__(self, *, keep_for=60, max_events=1000):
+        self.streams = {}
+        self.keep_for = keep_for
+        self.max_events = max_events
+
+    def start(self, run):
+        """Make a stream and start ``run(stream)`` in a task for it"""
+        stream = EventStream(str(uuid.uuid4()), self.max_events)
+        self.streams[stream.id] = stream
+
+        def done(res):
+            stream.finish()
+            asyncio.get_event_loop().call_later(self.keep_for, self.forget, stream)
+
+        stream.task = create_task(run(stream), name=f"<event_stream: {stream.id}>")
+        stream.task.add_done_callback(done)
+        return stream
+
+    def find(self, last_event_id):
+        """Return ``(stream, number)`` for this event id or ``(None, None)``"""
+        ident, _, number = (last_event_id or "").rpartition(":")
+        stream = self.streams.get(ident)
+        if stream is None or not number.isdigit():
+            return None, None
+        return stream, int(number)
+
+    def forget(self, stream):
+        if self.streams.get(stream.id) is stream:
+            del self.streams[stream.id]
+
+    def joined(self, stream):
+        stream.listeners += 1
+
+    def left(self, stream):
+        stream.listeners -= 1
+        if stream.listeners == 0 and not stream.done:
+            asyncio.get_event_loop().call_later(self.keep_for, self.abandon, stream)
+
+    def abandon(self, stream):
+        if stream.listeners == 0 and not stream.done:
+            stream.task.cancel()
+
+
+class SSEHandler(Simple, ProcessReplyMixin):
+    """
+    Executes a command and sends progress and the result as Server-Sent Events
+
+    The body of the command is the ``body`` query parameter for GET requests
+    or the request body for POST requests.
+
+    Each message from ``transform_progress`` is sent as a ``progress`` event
+    and the result, or error, is sent as a ``reply`` event before the response
+    is finished. A comment is sent every ``heartbeat_interval`` seconds that
+    nothing else is sent so that proxies don't give up on the connection.
+
+    Every event has an id and a client that reconnects with a ``Last-Event-ID``
+    header carries on from after that event instead of running the command
+    again. Once the ``reply`` has been sent a reconnect gets a 204 so that an
+    ``EventSource`` stops reconnecting.
+    """
+
+    progress_maker = ProgressMessageMaker
+    heartbeat_interval = 15
+
+    def initialize(self, commander, streams):
+        self.commander = commander
+        self.streams = streams
+
+    def transform_progress(self, body, progress, stack_extra=0, **kwargs):
+        maker = self.progress_maker(2 + stack_extra)
+        yield {"progress": maker(body, progress, **kwargs)}
+
+    def encode_event(self, msg):
+        return self.encoder.dumps(msg, self.reprer, pretty=False)
+
+    async def do_get(self):
+        body = self.get_query_argument("body", None)
+        return await self.stream_events(body)
+
+    async def do_post(self):
+        return await self.stream_events(None)
+
+    async def stream_events(self, body):
+        last_event_id = self.request.headers.get("Last-Event-ID")
+
+        if last_event_id:
+            stream, after = self.streams.find(last_event_id)
+            if stream is None:
+                raise Finished(
+                    status=404,
+                    error="No such event stream",
+                    error_code="NoSuchEventStream",
+                    wanted=last_event_id,
+                )
+            if stream.done and after >= stream.count:
+                self.set_status(204)
+                self.finish()
+                return
+        else:
+            if body is None:
+                body = self.raw_body()
+            body = self.decode_body(body, self.encoder.loads)
+            stream = self.streams.start(partial(self.run_command, body))
+            after = 0
+
+            in_flight = self.in_flight
+            if in_flight is not None:
+                in_flight.add_task(stream.task)
+
+        self.set_header("Content-Type", "text/event-stream; charset=UTF-8")
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("X-Accel-Buffering", "no")
+
+        self.streams.joined(stream)
         try:
-            executor = self.commander.executor(
-                progress_cb, self, message_key=message_key, message_id=message_id
-            )
-            return await executor.execute(path, body, allow_ws_only=True)
-        except NoSuchPath as error:
-            raise Finished(
-                status=404,
-                wanted=error.wanted,
-                available=error.available,
-                error="Specified path is invalid",
-            )
+            async for item in stream.follow(after, self.heartbeat_interval):
+                if item is None:
+                    self.write(": heartbeat\n\n")
+                else:
+                    number, event, data = item
+                    self.write(f"id: {stream.id}:{number}\nevent: {event}\ndata: {data}\n\n")
+                await self.flush()
+        except StreamClosedError:
+            return
+        finally:
+            self.streams.left(stream)
+
+        self.finish()
+
+    async def run_command(self, body, stream):
+        path = self.request.path
+        while path and path.endswith("/"):
+            path = path[:-1]
+
+        def progress_cb(message, stack_extra=0, **kwargs):
+            for m in self.transform_progress(body, message, stack_extra=stack_extra, **kwargs):
+                self.process_reply(m)
+                stream.add("progress", self.encode_event(m))
+
+        exc_info = None
+        try:
+            result = await execute_on_path(self.commander.executor(progress_cb, self), path, body)
+            if hasattr(result, "__aiter__"):
+                # The reply is one event, so gather the items
+                result = [item async for item in result]
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            exc_info = sys.exc_info()
+            result = self.message_from_exc(*exc_info)
+
+        if hasattr(result, "as_dict"):
+            result = result.as_dict()
+
+        self.process_reply(result, exc_info=exc_info)
+        stream.add("reply", self.encode_event(result))
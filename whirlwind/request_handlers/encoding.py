@@ -0,0 +1,334 @@
+"""
+Encoders used by the request handlers to turn replies into JSON.
+
+Each reply is encoded once, with the handler's ``reprer`` used for anything
+that isn't already JSON. Choose an encoder by setting ``encoder`` on your
+handler:
+
+.. code-block:: python
+
+    from whirlwind.request_handlers.encoding import JsonEncoder, OrjsonEncoder
+    from whirlwind.request_handlers.command import CommandHandler
+
+    class MyCommandHandler(CommandHandler):
+        encoder = JsonEncoder(compact=True)
+
+The default is ``JsonEncoder()``, which writes HTTP replies with sorted keys
+and indentation. A compact encoder doesn't indent or sort.
+
+Large lists and async iterators are encoded one item at a time with
+``iterencode`` and ``aiterencode`` so the reply never has to exist as one
+string.
+
+``OrjsonEncoder`` uses the ``orjson`` library, which you need to install
+yourself. Note that ``orjson`` knows how to encode things like dataclasses,
+datetimes and UUIDs itself and so those won't be given to the ``reprer``.
+
+Encoders also decode request bodies and websocket messages with ``loads``.
+
+Handlers can decode and encode bodies and replies bigger than
+``offload.threshold`` bytes on a small thread pool so the event loop can get on
+with other requests. This is off by default because it only helps when the json
+library lets go of the GIL while it works. The C decoder and compact encoder in
+the standard library hold it for the whole call, as does ``orjson``, so for
+those it's better to use a faster library than to offload. The pure python
+encoder the standard library uses for indented replies holds it too, but lets
+the event loop have a turn every few milliseconds.
+
+A reply is encoded while the event loop keeps running, so anything given to the
+offload thread pool must not be changed until the reply is sent. That includes
+results that are shared with other callers, like cached results.
+
+.. code-block:: python
+
+    from whirlwind.request_handlers.encoding import Offload
+
+    class MyCommandHandler(CommandHandler):
+        offload = Offload(threshold=512 * 1024, max_workers=4)
+
+.. autoclass:: Encoder
+    :members: dumps, dumpb, iterencode, aiterencode
+
+.. autoclass:: JsonEncoder
+
+.. autoclass:: OrjsonEncoder
+
+Websocket clients can ask for a binary subprotocol instead of JSON. Messages
+and replies then have the same shape but are encoded with ``MsgpackEncoder``
+or ``CborEncoder`` and ``bytes`` are sent as they are instead of being given
+to the ``reprer``. These need the ``msgpack`` and ``cbor2`` libraries.
+
+.. autoclass:: MsgpackEncoder
+
+.. autoclass:: CborEncoder
+
+.. autoclass:: Offload
+    :members: run, should_offload_body, should_offload_reply, shutdown
+"""
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+
+
+class MissingEncoderLibrary(Exception):
+    def __init__(self, library):
+        self.library = library
+        super().__init__(f"The {library} library must be installed to use this encoder")
+
+
+class Encoder:
+    """
+    Base class for encoders that knows how to encode a list one item at a time
+    from the ``dumps`` of the encoder.
+    """
+
+    indent = "    "
+    binary = False
+
+    def __init__(self, *, compact=False):
+        self.compact = compact
+
+    def dumps(self, obj, default, *, pretty=True):
+        """Return obj as a JSON string"""
+        raise NotImplementedError()
+
+    def dumpb(self, obj, default, *, pretty=True):
+        """Return obj as JSON encoded as utf-8 bytes"""
+        return self.dumps(obj, default, pretty=pretty).encode()
+
+    def loads(self, data):
+        """Return the object from this JSON str or bytes"""
+        return json.loads(data)
+
+    def list_separators(self, pretty):
+        """Return the strings for after the ``[``, between items and before the ``]``"""
+        if self.compact:
+            return "", ",", ""
+        elif pretty:
+            return f"\n{self.indent}", f",\n{self.indent}", "\n"
+        else:
+            return "", ", ", ""
+
+    def item(self, obj, default, pretty):
+        encoded = self.dumps(obj, default, pretty=pretty)
+        if pretty and not self.compact:
+            encoded = encoded.replace("\n", f"\n{self.indent}")
+        return encoded
+
+    def iterencode(self, obj, default, *, pretty=True):
+        """
+        Yield obj as JSON in parts
+
+        Lists and tuples are yielded an item at a time and everything else is
+        yielded in one go.
+        """
+        if type(obj) not in (list, tuple):
+            yield self.dumps(obj, default, pretty=pretty)
+            return
+
+        if not obj:
+            yield "[]"
+            return
+
+        start, between, end = self.list_separators(pretty)
+        for i, item in enumerate(obj):
+            yield ("[" + start) if i == 0 else between
+            yield self.item(item, default, pretty)
+        yield end + "]"
+
+    async def aiterencode(self, obj, default, *, pretty=True):
+        """Yield the items from this async iterator as a JSON list in parts"""
+        start, between, end = self.list_separators(pretty)
+
+        first = True
+        async for item in obj:
+            yield ("[" + start) if first else between
+            yield self.item(item, default, pretty)
+            first = False
+
+        if first:
+            yield "[]"
+        else:
+            yield end + "]"
+
+
+class JsonEncoder(Encoder):
+    """
+    Encode using the json module from the standard library.
+
+    If ``compact`` is True then there is no indentation, no sorting of keys and
+    no whitespace after separators.
+    """
+
+    def dumps(self, obj, default, *, pretty=True):
+        if self.compact:
+            return json.dumps(obj, default=default, separators=(",", ":"))
+        elif pretty:
+            return json.dumps(obj, default=default, sort_keys=True, indent="    ")
+        else:
+            return json.dumps(obj, default=default)
+
+
+class OrjsonEncoder(Encoder):
+    """
+    Encode using the orjson library.
+
+    If ``compact`` is False then HTTP replies are indented with two spaces and
+    have sorted keys.
+    """
+
+    indent = "  "
+
+    def __init__(self, *, compact=False):
+        try:
+            import orjson
+        except ImportError:
+            raise MissingEncoderLibrary("orjson")
+
+        self.orjson = orjson
+        super().__init__(compact=compact)
+
+    def options(self, pretty):
+        options = self.orjson.OPT_NON_STR_KEYS
+        if pretty and not self.compact:
+            options |= self.orjson.OPT_INDENT_2 | self.orjson.OPT_SORT_KEYS
+        return options
+
+    def list_separators(self, pretty):
+        if pretty and not self.compact:
+            return f"\n{self.indent}", f",\n{self.indent}", "\n"
+        # orjson never puts whitespace after separators
+        return "", ",", ""
+
+    def dumps(self, obj, default, *, pretty=True):
+        return self.dumpb(obj, default, pretty=pretty).decode()
+
+    def dumpb(self, obj, default, *, pretty=True):
+        return self.orjson.dumps(obj, default=default, option=self.options(pretty))
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+
+class MsgpackEncoder:
+    """Encode websocket messages using MessagePack with the msgpack library"""
+
+    binary = True
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise MissingEncoderLibrary("msgpack")
+
+        self.msgpack = msgpack
+
+    def dumpb(self, obj, default):
+        return self.msgpack.packb(obj, default=default, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+class CborEncoder:
+    """Encode websocket messages using CBOR with the cbor2 library"""
+
+    binary = True
+
+    def __init__(self):
+        try:
+            import cbor2
+        except ImportError:
+            raise MissingEncoderLibrary("cbor2")
+
+        self.cbor2 = cbor2
+
+    def dumpb(self, obj, default):
+        def encode_other(encoder, value):
+            encoder.encode(default(value))
+
+        return self.cbor2.dumps(obj, default=encode_other)
+
+    def loads(self, data):
+        try:
+            return self.cbor2.loads(data)
+        except self.cbor2.CBORDecodeError as error:
+            # Not every version of cbor2 makes these a ValueError
+            raise ValueError(str(error)) from error
+
+
+def estimate_size(obj, limit):
+    """
+    Return roughly how many bytes obj will be as JSON
+
+    This gives up and returns what it has so far once that is more than limit,
+    so it's cheap for small objects and doesn't take long for big ones.
+    """
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if type(obj) is str:
+            size += len(obj) + 2
+        elif type(obj) is dict:
+            size += 2
+            for key, value in obj.items():
+                size += len(key) + 4 if type(key) is str else 8
+                stack.append(value)
+        elif type(obj) in (list, tuple):
+            size += 2 + len(obj)
+            stack.extend(obj)
+        else:
+            size += 8
+
+        if size > limit:
+            break
+    return size
+
+
+class Offload:
+    """
+    Decides when to decode and encode JSON away from the event loop and runs
+    that work on a thread pool of ``max_workers`` threads.
+
+    Anything of ``threshold`` bytes or more is offloaded and a threshold of
+    None means nothing is. The thread pool is made the first time it's needed.
+
+    Handlers use ``default_offload`` unless told otherwise, which has a
+    threshold of None.
+    """
+
+    def __init__(self, *, threshold=1024 * 1024, max_workers=2):
+        self.threshold = threshold
+        self.max_workers = max_workers
+        self._pool = None
+
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="whirlwind-json"
+            )
+        return self._pool
+
+    def should_offload_body(self, body):
+        """Return whether this str or bytes should be decoded on the thread pool"""
+        return self.threshold is not None and len(body) >= self.threshold
+
+    def should_offload_reply(self, msg):
+        """Return whether this reply should be encoded on the thread pool"""
+        if self.threshold is None or type(msg) not in (dict, list):
+            return False
+        return estimate_size(msg, self.threshold) >= self.threshold
+
+    async def run(self, func, *args):
+        """Return the result of calling func with args on the thread pool"""
+        return await asyncio.get_event_loop().run_in_executor(self.pool(), func, *args)
+
+    def shutdown(self, wait=True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+
+# Offloading is opt in, see the module docs
+default_offload = Offload(threshold=None)
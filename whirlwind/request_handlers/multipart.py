@@ -0,0 +1,231 @@
+"""
+Parsing ``multipart/form-data`` bodies as they arrive.
+
+Tornado holds the whole body of a request in memory before it parses the files
+out of it. ``MultipartParser`` is given the body a chunk at a time instead and
+writes each file into a ``SpooledTemporaryFile``, so only ``spool_size`` bytes
+of any file is held in memory.
+
+.. autoclass:: MultipartParser
+    :members: feed, finish, close
+
+.. autoclass:: FormFile
+"""
+from whirlwind.request_handlers.uploads import UploadTooBig
+
+from tornado.httputil import HTTPHeaders, _parse_header
+from tempfile import SpooledTemporaryFile
+
+
+class BadMultipart(ValueError):
+    pass
+
+
+def multipart_boundary(content_type):
+    """
+    Return the boundary from this ``Content-Type`` header as bytes or None if
+    it's not for a ``multipart/form-data`` body
+    """
+    if not content_type.startswith("multipart/form-data"):
+        return None
+
+    for field in content_type.split(";"):
+        key, _, value = field.strip().partition("=")
+        if key == "boundary" and value:
+            if value.startswith('"') and value.endswith('"'):
+                value = value[1:-1]
+            return value.encode()
+
+    return None
+
+
+class FormFile:
+    """
+    A file from a multipart body
+
+    ``file`` is a ``SpooledTemporaryFile`` with the contents of the file and is
+    positioned at the start once the body has been parsed.
+    """
+
+    def __init__(self, name, filename, content_type, headers, spool_size):
+        self.name = name
+        self.size = 0
+        self.headers = headers
+        self.filename = filename
+        self.content_type = content_type
+        self.file = SpooledTemporaryFile(max_size=spool_size)
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self):
+        """Return all of the file and leave it positioned at the start"""
+        self.file.seek(0)
+        try:
+            return self.file.read()
+        finally:
+            self.file.seek(0)
+
+    def __repr__(self):
+        return f"<FormFile {self.name}:{self.filename} ({self.size} bytes)>"
+
+
+class MultipartParser:
+    """
+    Parse a multipart body given to ``feed`` in chunks
+
+    Parts with a filename end up in ``files`` as a dictionary of name to a list
+    of ``FormFile``. Other parts end up in ``arguments`` as a dictionary of name
+    to a list of bytes, like ``request.body_arguments`` in tornado.
+
+    Files are written to disk, but other parts are held in memory, so those
+    have a limit of their own.
+
+    ``UploadTooBig`` is raised if the body is more than ``max_size`` bytes or a
+    part without a filename is more than ``max_field_size`` bytes.
+    ``BadMultipart`` is raised if the body isn't valid.
+    """
+
+    def __init__(self, boundary, *, max_size, spool_size, max_field_size=None):
+        self.max_size = max_size
+        self.spool_size = spool_size
+        self.max_field_size = max_field_size
+        self.delimiter = b"\r\n--" + boundary
+
+        self.size = 0
+        self.part = None
+        self.part_name = None
+        self.state = "preamble"
+
+        # Pretend the body starts with a line break so the first boundary
+        # looks like every other boundary
+        self.buffer = bytearray(b"\r\n")
+
+        self.files = {}
+        self.arguments = {}
+
+    def feed(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise UploadTooBig(self.max_size)
+
+        if self.state == "done":
+            return
+
+        self.buffer.extend(data)
+        while self.step():
+            pass
+
+    def finish(self):
+        """Complain if the body ended before the last boundary and rewind the files"""
+        if self.state != "done":
+            raise BadMultipart("Multipart body ended before the final boundary")
+
+        for files in self.files.values():
+            for f in files:
+                f.file.seek(0)
+
+    def close(self):
+        """Close all the files"""
+        for files in self.files.values():
+            for f in files:
+                f.file.close()
+
+    def step(self):
+        """Parse what we can from the buffer and return whether there may be more to parse"""
+        return getattr(self, f"step_{self.state}")()
+
+    def step_preamble(self):
+        index = self.buffer.find(self.delimiter)
+        if index == -1:
+            # Only keep what could be the start of the delimiter
+            del self.buffer[: -len(self.delimiter)]
+            return False
+
+        del self.buffer[: index + len(self.delimiter)]
+        self.state = "boundary"
+        return True
+
+    def step_boundary(self):
+        if len(self.buffer) < 2:
+            return False
+
+        if self.buffer[:2] == b"--":
+            self.state = "done"
+            self.buffer.clear()
+            return False
+
+        end = self.buffer.find(b"\r\n")
+        if end == -1:
+            return False
+
+        if self.buffer[:end].strip(b" \t"):
+            raise BadMultipart("Expected a line break after the boundary")
+
+        del self.buffer[: end + 2]
+        self.state = "headers"
+        return True
+
+    def step_headers(self):
+        end = self.buffer.find(b"\r\n\r\n")
+        if end == -1:
+            if len(self.buffer) > 64 * 1024:
+                raise BadMultipart("Multipart headers are too long")
+            return False
+
+        try:
+            headers = HTTPHeaders.parse(bytes(self.buffer[:end]).decode("utf-8"))
+        except UnicodeDecodeError:
+            raise BadMultipart("Multipart headers must be utf-8")
+
+        del self.buffer[: end + 4]
+        self.start_part(headers)
+        self.state = "body"
+        return True
+
+    def step_body(self):
+        index = self.buffer.find(self.delimiter)
+        if index == -1:
+            keep = len(self.delimiter) - 1
+            if len(self.buffer) > keep:
+                self.add_to_part(self.buffer[:-keep])
+                del self.buffer[:-keep]
+            return False
+
+        self.add_to_part(self.buffer[:index])
+        del self.buffer[: index + len(self.delimiter)]
+        self.end_part()
+        self.state = "boundary"
+        return True
+
+    def step_done(self):
+        return False
+
+    def start_part(self, headers):
+        disposition, params = _parse_header(headers.get("Content-Disposition", ""))
+        if disposition != "form-data" or not params.get("name"):
+            raise BadMultipart("Multipart part must be form-data with a name")
+
+        name = self.part_name = params["name"]
+        if params.get("filename"):
+            content_type = headers.get("Content-Type", "application/unknown")
+            self.part = FormFile(name, params["filename"], content_type, headers, self.spool_size)
+            self.files.setdefault(name, []).append(self.part)
+        else:
+            self.part = bytearray()
+            self.arguments.setdefault(name, []).append(self.part)
+
+    def add_to_part(self, data):
+        if isinstance(self.part, FormFile):
+            self.part.write(data)
+            return
+
+        if self.max_field_size is not None and len(self.part) + len(data) > self.max_field_size:
+            raise UploadTooBig(self.max_field_size)
+        self.part.extend(data)
+
+    def end_part(self):
+        if not isinstance(self.part, FormFile):
+            self.arguments[self.part_name][-1] = bytes(self.part)
+        self.part = None
@@ -0,0 +1,164 @@
+"""
+Streaming binary uploads into a websocket message.
+
+A client starts an upload by adding ``"upload": true`` to a message:
+
+.. code-block:: json
+
+    {"path": "/v1/commands", "message_id": "abc", "upload": true, "body": {"command": "flash"}}
+
+and then sends the data in binary frames. Each frame starts with two bytes
+that are the length of the ``message_id`` in utf-8 as a big endian number, then
+the ``message_id`` and then the data. A frame with no data ends the upload.
+
+Clients using a binary subprotocol send the data as messages instead, with a
+path of ``__upload__``, the ``message_id`` of the upload and the data as the
+body. A body of ``null`` ends the upload.
+
+The message is processed straight away and gets the data as it arrives through
+an ``Upload``. ``WSHandler`` makes it available to commands as
+``store.injected("upload")``, which is only there for messages with an upload:
+
+.. code-block:: python
+
+    @store.command("flash")
+    class Flash(store.Command):
+        upload = store.injected("upload")
+
+        async def execute(self):
+            async for chunk in self.upload:
+                await write_to_device(chunk)
+
+Data is kept in memory until there is ``upload_spool_size`` bytes of it and is
+then kept in a temporary file. An upload bigger than ``upload_max_size`` bytes
+fails. Both are options on the websocket handler.
+
+.. autoclass:: Upload
+    :members: read, wait
+"""
+from tempfile import SpooledTemporaryFile
+import asyncio
+import struct
+
+
+class UploadTooBig(Exception):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        super().__init__(f"Upload is bigger than the maximum of {max_size} bytes")
+
+
+class UploadInterrupted(Exception):
+    pass
+
+
+def upload_frame(message_id, data):
+    """Return the binary frame that sends this data for this ``message_id``"""
+    ident = message_id.encode()
+    return struct.pack(">H", len(ident)) + ident + data
+
+
+def parse_upload_frame(frame):
+    """Return ``(message_id, data)`` from this binary frame"""
+    if len(frame) < 2:
+        raise ValueError("Upload frame is too short")
+
+    (length,) = struct.unpack(">H", frame[:2])
+    if len(frame) < 2 + length:
+        raise ValueError("Upload frame is too short")
+
+    view = memoryview(frame)
+    return bytes(view[2 : 2 + length]).decode(), view[2 + length :]
+
+
+class Upload:
+    """
+    The data uploaded for a message
+
+    ``await upload.read(n)`` returns up to n bytes, waiting for them to arrive,
+    and returns ``b""`` once all the data has been read. ``async for chunk in
+    upload`` yields the data as it arrives. ``await upload.wait()`` returns the
+    whole upload as a file positioned at the start.
+
+    If the upload is too big or the connection closes first then these raise
+    ``UploadTooBig`` or ``UploadInterrupted``.
+    """
+
+    def __init__(self, *, max_size, spool_size, chunk_size=64 * 1024):
+        self.file = SpooledTemporaryFile(max_size=spool_size)
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.position = 0
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.changed = asyncio.Event()
+
+    def add(self, data):
+        if self.done:
+            return
+
+        if self.max_size is not None and self.size + len(data) > self.max_size:
+            self.fail(UploadTooBig(self.max_size))
+            return
+
+        self.file.seek(0, 2)
+        self.file.write(data)
+        self.size += len(data)
+        self.changed.set()
+
+    def finish(self):
+        self.done = True
+        self.changed.set()
+
+    def fail(self, error):
+        if not self.done:
+            self.error = error
+            self.finish()
+
+    def close(self):
+        self.fail(UploadInterrupted("The upload was closed"))
+        self.file.close()
+
+    async def read(self, n=-1):
+        """Return up to n bytes, or the rest of the upload if n is negative"""
+        if n == 0:
+            return b""
+
+        while True:
+            if self.error is not None:
+                raise self.error
+
+            if self.done or (n > 0 and self.size > self.position):
+                break
+
+            self.changed.clear()
+            await self.changed.wait()
+
+        if n < 0:
+            n = self.size - self.position
+
+        self.file.seek(self.position)
+        data = self.file.read(n)
+        self.position += len(data)
+        return data
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.read(self.chunk_size)
+        if not data:
+            raise StopAsyncIteration
+        return data
+
+    async def wait(self):
+        """Wait for all the data and return the file it's in"""
+        while not self.done:
+            self.changed.clear()
+            await self.changed.wait()
+
+        if self.error is not None:
+            raise self.error
+
+        self.file.seek(0)
+        return self.file
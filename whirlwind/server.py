@@ -1,7 +1,16 @@
+from whirlwind.request_handlers.base import Finished
+from whirlwind.store import create_task
+
 from tornado.httpserver import HTTPServer
+from tornado import netutil
+from contextlib import contextmanager
 import tornado.web
 import logging
 import asyncio
+import signal
+import socket
+import time
+import os
 
 log = logging.getLogger("whirlwind.server")
 
@@ -10,20 +19,241 @@ class ForcedQuit(Exception):
     pass
 
 
+class TCPListener:
+    """
+    Listen on a TCP host and port
+
+    backlog
+        The backlog given to ``listen`` on the socket
+
+    nodelay
+        Set ``TCP_NODELAY`` on the listening socket. Connections accepted from
+        the socket inherit this option on Linux.
+
+    reuse_port
+        Set ``SO_REUSEPORT`` on the socket
+
+    socket_options
+        A list of ``(level, option, value)`` to give to ``setsockopt`` on the
+        listening socket
+    """
+
+    def __init__(
+        self, host, port, *, backlog=128, nodelay=False, reuse_port=False, socket_options=None
+    ):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.nodelay = nodelay
+        self.reuse_port = reuse_port
+        self.socket_options = list(socket_options or [])
+
+    def __str__(self):
+        return f"http://{self.host}:{self.port}"
+
+    def bind(self):
+        """Return a list of bound and listening sockets"""
+        sockets = netutil.bind_sockets(
+            self.port, self.host, backlog=self.backlog, reuse_port=self.reuse_port
+        )
+
+        options = list(self.socket_options)
+        if self.nodelay:
+            options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+
+        for sock in sockets:
+            for option in options:
+                sock.setsockopt(*option)
+
+        return sockets
+
+    def close(self):
+        """Called when the server has stopped listening"""
+
+
+class UnixListener:
+    """
+    Listen on a unix domain socket at this ``path``
+
+    Any existing socket at this path is replaced and the socket file is removed
+    when the server stops.
+    """
+
+    def __init__(self, path, *, mode=0o600, backlog=128, socket_options=None):
+        self.path = path
+        self.mode = mode
+        self.backlog = backlog
+        self.socket_options = list(socket_options or [])
+
+    def __str__(self):
+        return f"http+unix://{self.path}"
+
+    def bind(self):
+        """Return a list with our bound and listening socket"""
+        sock = netutil.bind_unix_socket(self.path, mode=self.mode, backlog=self.backlog)
+        for option in self.socket_options:
+            sock.setsockopt(*option)
+        return [sock]
+
+    def close(self):
+        """Remove our socket file"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
 class Server(object):
-    def __init__(self, final_future):
+    """
+    Manages the life cycle of a tornado web server
+
+    final_future
+        A future that is resolved when the server should stop
+
+    num_workers
+        When None (the default) we serve from this process. Otherwise we bind
+        the listening socket in this process and fork this many worker
+        processes that share it. A value of ``0`` means one worker per cpu.
+
+    worker_restart_delay
+        How long to wait before restarting a worker that died
+
+    worker_restart_max_delay
+        The delay before restarting a worker doubles every time it dies within
+        this many seconds of starting, up to this many seconds
+
+    worker_shutdown_timeout
+        How long to give workers to finish once ``final_future`` is resolved
+        before they are killed. Defaults to a little longer than the
+        ``drain_timeout``
+
+    drain_timeout
+        How long in flight requests are given to finish after we stop accepting
+        new connections before they are cancelled
+
+    metrics
+        An optional ``whirlwind.metrics.Metrics`` object. If provided it is
+        served at ``metrics_path`` and the request handlers record websocket
+        messages into it. With ``num_workers`` every worker has its own copy,
+        so the metrics served are for the worker that answered the request.
+    """
+
+    def __init__(
+        self,
+        final_future,
+        *,
+        num_workers=None,
+        worker_restart_delay=1,
+        worker_restart_max_delay=60,
+        worker_shutdown_timeout=None,
+        drain_timeout=10,
+        metrics=None,
+        metrics_path="/metrics",
+    ):
+        self.metrics = metrics
+        self.metrics_path = metrics_path
         self.final_future = final_future
+        self.drain_timeout = drain_timeout
+        self.num_workers = num_workers
+        self.worker_restart_delay = worker_restart_delay
+        self.worker_restart_max_delay = worker_restart_max_delay
+
+        if worker_shutdown_timeout is None:
+            worker_shutdown_timeout = drain_timeout + 5
+        self.worker_shutdown_timeout = worker_shutdown_timeout
+
+        self.in_flight = InFlight()
+
+    async def serve(self, host=None, port=None, *args, listeners=None, **kwargs):
+        """
+        Start the server and keep serving until ``final_future`` is resolved.
+
+        Instead of a ``host`` and ``port`` you may give ``listeners``, a list of
+        listeners like ``TCPListener`` and ``UnixListener``, and the one
+        application is served from all of them.
+        """
+        if self.num_workers is not None:
+            if listeners is None:
+                listeners = [TCPListener(host, port)]
+            await self.serve_workers(listeners, *args, **kwargs)
+            return
+
+        if listeners is not None:
+            with self.listening(listeners) as sockets:
+                await self.serve_sockets(sockets, *args, **kwargs)
+            return
+
+        http_server = await self.make_http_server(*args, **kwargs)
+        log.info(f"Hosting server at http://{host}:{port}")
+        http_server.listen(port, host)
+        await self.run_http_server(http_server)
+
+    @contextmanager
+    def listening(self, listeners, description=""):
+        """
+        Bind these listeners and yield their sockets. Those sockets are closed
+        afterwards, and so is every listener that was bound, even if a later
+        one fails to bind.
+        """
+        bound = []
+        sockets = []
+        try:
+            for listener in listeners:
+                sockets.extend(listener.bind())
+                bound.append(listener)
+                log.info(f"Hosting server at {listener}{description}")
 
-    async def serve(self, host, port, *args, **kwargs):
+            yield sockets
+        finally:
+            for sock in sockets:
+                sock.close()
+            for listener in bound:
+                listener.close()
+
+    async def serve_workers(self, listeners, *args, **kwargs):
+        """
+        Bind these listeners and then fork ``num_workers`` processes that each
+        serve requests from those sockets.
+
+        Each worker will call ``setup``, ``tornado_routes`` and ``cleanup``
+        for itself and the worker processes are restarted if they die before
+        ``final_future`` is resolved.
+        """
+        num_workers = self.num_workers
+        if not num_workers or num_workers < 0:
+            num_workers = os.cpu_count() or 1
+
+        with self.listening(listeners, f" with {num_workers} workers") as sockets:
+            supervisor = WorkerSupervisor(self, sockets, num_workers, args, kwargs)
+            await supervisor.run()
+
+        try:
+            await self.final_future
+        except ForcedQuit:
+            log.info("The server was told to shut down")
+
+    async def serve_sockets(self, sockets, *args, **kwargs):
+        """Serve from already bound sockets. This is what each worker process does"""
+        http_server = await self.make_http_server(*args, **kwargs)
+        http_server.add_sockets(sockets)
+        await self.run_http_server(http_server)
+
+    async def make_http_server(self, *args, **kwargs):
         server_kwargs = await self.setup(*args, **kwargs)
         if server_kwargs is None:
             server_kwargs = {}
 
-        http_server = HTTPServer(tornado.web.Application(self.tornado_routes(), **server_kwargs))
+        routes = self.tornado_routes()
+        if self.metrics is not None:
+            routes = list(routes) + [self.metrics.route(self.metrics_path)]
 
-        log.info(f"Hosting server at http://{host}:{port}")
+        application = tornado.web.Application(routes, **server_kwargs)
+        application.settings.setdefault("whirlwind_in_flight", self.in_flight)
+        if self.metrics is not None:
+            application.settings.setdefault("whirlwind_metrics", self.metrics)
+        return HTTPServer(application)
 
-        http_server.listen(port, host)
+    async def run_http_server(self, http_server):
         try:
             await self.final_future
         except ForcedQuit:
@@ -31,9 +261,19 @@ class Server(object):
         finally:
             try:
                 http_server.stop()
+                await self.drain()
             finally:
                 await self.cleanup()
 
+    async def drain(self):
+        """
+        Called after we stop accepting new connections and before ``cleanup``.
+
+        By default we tell open websockets we are closing, give in flight requests
+        ``drain_timeout`` seconds to finish and then cancel whatever is left.
+        """
+        await self.in_flight.drain(self.drain_timeout)
+
     async def setup(self, *args, **kwargs):
         """
         Hook that receives all extra args and kwargs from serve
@@ -52,14 +292,220 @@ class Server(object):
         """Called after the server has stopped"""
 
 
-async def wait_for_futures(futures):
+class WorkerSupervisor:
+    """
+    Used by ``Server.serve_workers`` to fork worker processes, restart them if
+    they die and tell them to stop when the server's ``final_future`` is resolved.
     """
-    Helper for waiting on futures in a dictionary of {key: future}
 
-    Useful for waiting on the wsconnections object given to a WSHandler
+    poll_interval = 0.1
+
+    def __init__(self, server, sockets, num_workers, args, kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.server = server
+        self.sockets = sockets
+        self.num_workers = num_workers
+
+        self.pids = {}
+        self.started = {}
+        self.failures = {}
+        self.final_future = server.final_future
+
+    async def run(self):
+        for index in range(self.num_workers):
+            self.start_worker(index)
+
+        try:
+            while not self.final_future.done():
+                self.reap(restart=True)
+                await asyncio.wait([self.final_future], timeout=self.poll_interval)
+        finally:
+            await self.stop()
+
+    def start_worker(self, index):
+        if self.final_future.done():
+            return
+
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker(index)
+
+        log.info(f"Started worker {index} (pid {pid})")
+        self.pids[pid] = index
+        self.started[index] = time.time()
+
+    def run_worker(self, index):
+        """
+        Run inside the forked process and never returns.
+
+        The worker gets a fresh event loop and a final_future of its own that is
+        cancelled when the process receives a SIGTERM or SIGINT.
+        """
+        code = 0
+        try:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+
+            self.server.final_future = loop.create_future()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, self.server.final_future.cancel)
+
+            try:
+                loop.run_until_complete(
+                    self.server.serve_sockets(self.sockets, *self.args, **self.kwargs)
+                )
+            except asyncio.CancelledError:
+                pass
+        except BaseException:
+            log.exception(f"Worker {index} failed")
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self, restart):
+        for pid, index in list(self.pids.items()):
+            try:
+                found, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                found, status = pid, 0
+
+            if found == 0:
+                continue
+
+            del self.pids[pid]
+
+            if not restart:
+                continue
+
+            if os.WIFSIGNALED(status):
+                reason = f"was killed by signal {os.WTERMSIG(status)}"
+            else:
+                reason = f"exited with status {os.WEXITSTATUS(status)}"
+
+            delay = self.restart_delay(index)
+            log.warning(f"Worker {index} (pid {pid}) {reason}, restarting it in {delay}s")
+            asyncio.get_event_loop().call_later(delay, self.start_worker, index)
+
+    def restart_delay(self, index):
+        """
+        Return how long to wait before restarting this worker
+
+        The delay doubles every time the worker dies soon after it started so
+        a worker that can't start doesn't get forked over and over again.
+        """
+        max_delay = self.server.worker_restart_max_delay
+        if time.time() - self.started.get(index, 0) > max_delay:
+            self.failures[index] = 0
+
+        failures = self.failures.get(index, 0)
+        self.failures[index] = failures + 1
+        return min(self.server.worker_restart_delay * 2 ** failures, max_delay)
+
+    async def stop(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        start = time.time()
+        while self.pids and time.time() - start < self.server.worker_shutdown_timeout:
+            self.reap(restart=False)
+            if self.pids:
+                await asyncio.sleep(self.poll_interval)
+
+        for pid, index in list(self.pids.items()):
+            log.warning(f"Worker {index} (pid {pid}) didn't stop in time, killing it")
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            del self.pids[pid]
+
+
+class InFlight:
     """
-    for t in list(futures.values()):
+    Knows about the requests and websockets a server is currently handling so
+    that they can be drained when the server stops.
+
+    The server puts this in the ``whirlwind_in_flight`` setting of the
+    ``tornado.web.Application`` where the request handlers find it.
+    """
+
+    def __init__(self):
+        self.tasks = set()
+        self.draining = False
+        self.websockets = set()
+
+    def add_task(self, task):
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def add_websocket(self, handler):
+        self.websockets.add(handler)
+
+    def remove_websocket(self, handler):
+        self.websockets.discard(handler)
+
+    async def run(self, coro):
+        """Run this coroutine as an in flight task and return the result"""
+        if self.draining:
+            coro.close()
+            raise Finished(
+                status=503, error="Server is shutting down", error_code="ServerShuttingDown"
+            )
+
+        task = create_task(coro, name="<in_flight>")
+        self.add_task(task)
+
         try:
-            await t
-        except:
-            pass
+            return await task
+        except asyncio.CancelledError:
+            if task.cancelled() and self.draining:
+                raise Finished(
+                    status=503, error="Server is shutting down", error_code="ServerShuttingDown"
+                )
+            raise
+
+    async def drain(self, timeout):
+        self.draining = True
+
+        for handler in list(self.websockets):
+            handler.server_closing()
+
+        await wait_for_futures(self.tasks, timeout=timeout)
+
+        for handler in list(self.websockets):
+            handler.close()
+
+
+async def wait_for_futures(futures, timeout=None):
+    """
+    Helper for waiting on futures in a dictionary of {key: future}, or any
+    other collection of futures.
+
+    Useful for waiting on the wsconnections object given to a WSHandler
+
+    The futures are waited on together and any failures are ignored. If a
+    ``timeout`` is given then whatever is still going after that many seconds
+    is cancelled.
+    """
+    if hasattr(futures, "values"):
+        futures = futures.values()
+
+    futures = list(futures)
+    if not futures:
+        return
+
+    _, pending = await asyncio.wait(futures, timeout=timeout)
+
+    if pending:
+        for t in pending:
+            t.cancel()
+        await asyncio.wait(pending)
+
+    for t in futures:
+        if not t.cancelled():
+            t.exception()
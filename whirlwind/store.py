@@ -1,4 +1,7 @@
+from whirlwind.validators import CompiledFieldSpec
 from whirlwind.commander import Command
+from whirlwind.cache import CommandCache, CommandFlights
+from whirlwind.pools import PoolRunner
 
 from delfick_project.norms import dictobj, sb, BadSpecValue, Meta
 from delfick_project.option_merge import NoFormat, MergedOptions
@@ -59,6 +62,13 @@ def create_task(coro, name=None):
         return asyncio.ensure_future(coro)
 
 
+def current_task():
+    if sys.version_info >= (3, 7):
+        return asyncio.current_task()
+    else:
+        return asyncio.Task.current_task()
+
+
 def retrieve_exception(result):
     if result.cancelled():
         return
@@ -93,8 +103,13 @@ async def pass_on_result(fut, command, execute, *, log_exceptions):
         else:
             fut.set_result(result.result())
 
+    def cancel(res):
+        if res.cancelled():
+            task.cancel()
+
     task = create_task(coro, name=f"<pass_on_result: {command.__class__.__name__}>")
     task.add_done_callback(transfer)
+    fut.add_done_callback(cancel)
     return await fut
 
 
@@ -126,6 +141,20 @@ class NonInteractiveParent(Exception):
         super().__init__(self, f"Store commands can only specify an interactive parent: {s}")
 
 
+class CantCacheInteractive(Exception):
+    def __init__(self, wanted):
+        self.wanted = wanted
+        super().__init__(
+            self, f"Interactive commands can not be cached or coalesced: {wanted.__name__}"
+        )
+
+
+class CantPoolInteractive(Exception):
+    def __init__(self, wanted):
+        self.wanted = wanted
+        super().__init__(self, f"Interactive commands can not be run in a pool: {wanted.__name__}")
+
+
 class ProcessItem:
     def __init__(self, fut, command, execute, messages):
         self.fut = fut
@@ -220,37 +249,56 @@ class command_spec(sb.Spec):
         self.paths = paths
         self.existing_commands = {}
 
-    def make_command(self, meta, val, existing):
-        v = sb.set_options(
+        self.path_spec = sb.set_options(
             path=sb.required(sb.string_spec()), allow_ws_only=sb.defaulted(sb.boolean(), False)
-        ).normalise(meta, val)
-
-        path = v["path"]
-        allow_ws_only = v["allow_ws_only"]
-
-        if path not in self.paths:
-            raise NoSuchPath(path, sorted(self.paths))
-
-        val = sb.set_options(
+        )
+        self.body_spec = sb.set_options(
             body=sb.required(
                 sb.set_options(args=sb.dictionary_spec(), command=sb.required(sb.string_spec()))
             )
-        ).normalise(meta, val)
+        )
 
-        args = val["body"]["args"]
-        name = val["body"]["command"]
+    def path_options(self, meta, val):
+        """Return ``(path, allow_ws_only)`` from val"""
+        # Check the usual case by hand and leave anything else to path_spec
+        # so it can complain the way it always has
+        if type(val) is dict:
+            path = val.get("path")
+            allow_ws_only = val.get("allow_ws_only", False)
+            if type(path) is str and type(allow_ws_only) is bool:
+                return path, allow_ws_only
+
+        v = self.path_spec.normalise(meta, val)
+        return v["path"], v["allow_ws_only"]
+
+    def command_options(self, meta, val):
+        """Return ``(command, args)`` from val"""
+        body = val.get("body") if type(val) is dict else None
+        if type(body) is dict:
+            name = body.get("command")
+            args = body.get("args", sb.NotSpecified)
+            if type(name) is str and (args is sb.NotSpecified or type(args) is dict):
+                return name, {} if args is sb.NotSpecified else args
+
+        v = self.body_spec.normalise(meta, val)
+        return v["body"]["command"], v["body"]["args"]
 
-        if existing:
-            name = val["body"]["command"] = f"{existing['path']}:{name}"
+    def make_command(self, meta, val, existing):
+        path, allow_ws_only = self.path_options(meta, val)
+
+        if path not in self.paths:
+            raise NoSuchPath(path, sorted(self.paths))
+
+        name, args = self.command_options(meta, val)
 
-        extra_context = {}
         if existing:
-            extra_context["_parent_command"] = existing["command"]
+            name = f"{existing['path']}:{name}"
 
         everything = meta.everything
-        if isinstance(meta.everything, MergedOptions):
-            everything = meta.everything.wrapped()
-        everything.update(extra_context)
+        if existing:
+            if isinstance(everything, MergedOptions):
+                everything = everything.wrapped()
+            everything.update({"_parent_command": existing["command"]})
         meta = Meta(everything, []).at("body")
 
         available_commands = self.paths[path]
@@ -263,7 +311,8 @@ class command_spec(sb.Spec):
                 meta=meta.at("command"),
             )
 
-        command = available_commands[name]["spec"].normalise(meta.at("args"), args)
+        info = available_commands[name]
+        command = info["spec"].normalise(meta.at("args"), args)
 
         if not allow_ws_only and command.__whirlwind_ws_only__:
             raise BadSpecValue(
@@ -273,7 +322,7 @@ class command_spec(sb.Spec):
                 meta=meta.at("command"),
             )
 
-        return command, name
+        return command, name, info
 
     def available(self, available_commands, *, allow_ws_only):
         available = []
@@ -298,7 +347,8 @@ class command_spec(sb.Spec):
 
     def normalise_filled(self, meta, val):
         parent_existing, message_id_tuple = self.find_command(meta.everything.get("message_id"))
-        command, path = self.make_command(meta, val, parent_existing)
+        command, path, info = self.make_command(meta, val, parent_existing)
+        shared = "cache" in info or "coalesce" in info
 
         existing = None
         if command and is_interactive(command):
@@ -313,7 +363,10 @@ class command_spec(sb.Spec):
 
             try:
                 if not existing:
-                    return await command.execute()
+                    if not shared:
+                        return await self.execute_command(info, command)
+                    progress_cb = meta.everything.get("progress_cb")
+                    return await self.execute_shared(info, command, progress_cb)
                 else:
                     final_future = meta.everything.get("final_future")
                     return await self.execute_interactive(
@@ -325,6 +378,39 @@ class command_spec(sb.Spec):
 
         return execute
 
+    def execute_command(self, info, command):
+        runner = info.get("runner")
+        if runner is None:
+            return command.execute()
+        return runner.run(command)
+
+    async def execute_shared(self, info, command, progress_cb):
+        cache = info.get("cache")
+        flights = info.get("coalesce")
+
+        key = (cache or flights).key_for(command)
+        if key is None:
+            return await self.execute_command(info, command)
+
+        if cache is not None:
+            found, result = cache.get(key)
+            if found:
+                return result
+
+        async def execute(command):
+            result = await self.execute_command(info, command)
+            if hasattr(result, "__aiter__"):
+                # More than one caller gets this result so it can't be used up
+                result = [item async for item in result]
+            if cache is not None:
+                cache.set(key, result)
+            return result
+
+        if flights is None:
+            return await execute(command)
+
+        return await flights.run(key, command, progress_cb, execute)
+
     async def execute_interactive(self, final_future, parent_existing, existing, command):
         holder_kls = MessageHolder
         if hasattr(command, "MessageHolder"):
@@ -373,6 +459,37 @@ class Store:
         self.paths = defaultdict(dict)
         self.command_spec = command_spec(self.paths)
 
+    def cache_for(self, name, path=None):
+        """Return the ``whirlwind.cache.CommandCache`` for this command or None"""
+        return self.paths[self.normalise_path(path)].get(name, {}).get("cache")
+
+    def cache_stats(self):
+        """Return ``{path: {name: stats}}`` for every cached command"""
+        found = {}
+        for path, commands in self.paths.items():
+            for name, info in commands.items():
+                if info.get("cache") is not None:
+                    found.setdefault(path, {})[name] = info["cache"].stats()
+        return found
+
+    def invalidate(self, name=None, *, path=None, **args):
+        """
+        Forget cached results.
+
+        With no name this forgets everything for every command, otherwise it
+        calls ``invalidate(**args)`` on the cache for that command.
+        """
+        if name is None:
+            for commands in self.paths.values():
+                for info in commands.values():
+                    if info.get("cache") is not None:
+                        info["cache"].invalidate()
+            return
+
+        cache = self.cache_for(name, path=path)
+        if cache is not None:
+            cache.invalidate(**args)
+
     def clone(self):
         new_store = Store(self.prefix, self.default_path, self.formatter)
         for path, commands in self.paths.items():
@@ -386,7 +503,9 @@ class Store:
                     return NoFormat(None)
                 return f"{{{path}}}"
 
-        return dictobj.Field(find_value(), formatted=True, format_into=format_into)
+        field = dictobj.Field(find_value(), formatted=True, format_into=format_into)
+        field.injected_path = path
+        return field
 
     def normalise_prefix(self, prefix, trailing_slash=True):
         if prefix is None:
@@ -422,7 +541,48 @@ class Store:
                     slash = "/"
                 self.paths[path][f"{new_prefix}{slash}{name}"] = options
 
-    def command(self, name, *, path=None, parent=None):
+    def command_name(self, name, path, parent):
+        """Return the name a command is registered as, which includes its parent"""
+        if not parent:
+            return f"{self.prefix}{name}"
+
+        if not is_interactive(parent):
+            raise NonInteractiveParent(parent)
+
+        for p, o in self.paths[path].items():
+            if o["kls"] is parent:
+                return f"{p}:{name}"
+
+        raise NoSuchParent(parent)
+
+    def command(
+        self,
+        name,
+        *,
+        path=None,
+        parent=None,
+        cache=None,
+        coalesce=False,
+        executor=None,
+        pool=None,
+        compiled=True,
+    ):
+        """
+        Return a decorator that registers a Command class with the store
+
+        ``cache`` may be a ``whirlwind.cache.CachePolicy`` for commands that
+        only read data. Identical calls to those commands then share a result.
+
+        If ``coalesce`` is True then identical calls to this command that
+        happen at the same time share one execution.
+
+        ``executor`` may be ``"thread"`` or ``"process"`` to run the command
+        away from the event loop, optionally in the ``concurrent.futures``
+        executor given as ``pool``. See ``whirlwind.pools``.
+
+        The arguments are checked by a ``whirlwind.validators.CompiledFieldSpec``
+        made now unless ``compiled`` is False.
+        """
         path = self.normalise_path(path)
 
         def decorator(kls):
@@ -432,25 +592,26 @@ class Store:
             kls.__whirlwind_command__ = True
             kls.__whirlwind_ws_only__ = is_interactive(kls) or parent
 
-            n = name
-            spec = kls.FieldSpec(formatter=self.formatter)
-
-            if parent and not is_interactive(parent):
-                raise NonInteractiveParent(parent)
-            elif parent:
-                found = False
-                for p, o in self.paths[path].items():
-                    if o["kls"] is parent:
-                        n = f"{p}:{name}"
-                        found = True
-                        break
-
-                if not found:
-                    raise NoSuchParent(parent)
+            if compiled:
+                spec = CompiledFieldSpec(kls, formatter=self.formatter)
             else:
-                n = f"{self.prefix}{n}"
-
-            self.paths[path][n] = {"kls": kls, "spec": spec}
+                spec = kls.FieldSpec(formatter=self.formatter)
+
+            n = self.command_name(name, path, parent)
+
+            if is_interactive(kls):
+                if cache is not None or coalesce:
+                    raise CantCacheInteractive(kls)
+                if executor is not None:
+                    raise CantPoolInteractive(kls)
+
+            info = self.paths[path][n] = {"kls": kls, "spec": spec}
+            if executor is not None:
+                info["runner"] = PoolRunner(executor, kls, pool)
+            if cache is not None:
+                info["cache"] = CommandCache(cache, kls)
+            if coalesce:
+                info["coalesce"] = CommandFlights(kls)
             return kls
 
         return decorator
@@ -6,6 +6,10 @@ server.
 
 .. autofunction:: port_connected
 
+.. autoclass:: UnixResolver
+
+.. autoclass:: ResolvingWebSocketClientConnection
+
 .. autofunction:: with_timeout
 
 .. autofunction:: async_as_background
@@ -24,11 +28,15 @@ server.
 .. autoclass:: WSStream
     :members:
 """
+from whirlwind.server import UnixListener
+
 from delfick_project.errors import DelfickErrorTestMixin
 from asynctest import TestCase as AsyncTestCase
-from tornado.websocket import websocket_connect
-from tornado.httpclient import AsyncHTTPClient
+from tornado.websocket import websocket_connect, WebSocketClientConnection
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.tcpclient import TCPClient
 from contextlib import contextmanager
+from tornado.netutil import Resolver
 from delfick_project.norms import sb
 from functools import partial
 import logging
@@ -56,15 +64,67 @@ def free_port():
 def port_connected(port):
     """
     Return whether something is listening on this port
+
+    If port is a string then we treat it as the path to a unix socket
     """
-    s = socket.socket()
+    if isinstance(port, str):
+        s = socket.socket(socket.AF_UNIX)
+        address = port
+    else:
+        s = socket.socket()
+        address = ("127.0.0.1", port)
+
     s.settimeout(5)
     try:
-        s.connect(("127.0.0.1", port))
-        s.close()
+        s.connect(address)
         return True
     except Exception:
         return False
+    finally:
+        s.close()
+
+
+class UnixResolver(Resolver):
+    """
+    A tornado Resolver that resolves every host to the unix socket at ``socket_path``
+
+    .. code-block:: python
+
+        from whirlwind import test_helpers as wthp
+
+        from tornado.httpclient import AsyncHTTPClient
+
+        client = AsyncHTTPClient(force_instance=True, resolver=wthp.UnixResolver(socket_path=path))
+        await client.fetch("http://localhost/v1/somewhere")
+    """
+
+    def initialize(self, socket_path):
+        self.socket_path = socket_path
+
+    async def resolve(self, host, port, family=socket.AF_UNSPEC):
+        return [(socket.AF_UNIX, self.socket_path)]
+
+
+class ResolvingWebSocketClientConnection(WebSocketClientConnection):
+    """
+    A websocket client connection that connects using ``resolver``
+
+    ``websocket_connect`` always makes a ``TCPClient`` with the default
+    resolver, so this is used to make websocket connections to a unix socket.
+    """
+
+    def __init__(self, request, resolver, **kwargs):
+        self.resolver = resolver
+        super().__init__(request, **kwargs)
+
+    @property
+    def tcp_client(self):
+        return self._tcp_client
+
+    @tcp_client.setter
+    def tcp_client(self, tcp_client):
+        # Use our resolver instead of the TCPClient made by tornado
+        self._tcp_client = TCPClient(resolver=self.resolver)
 
 
 def with_timeout(func):
@@ -313,7 +373,8 @@ class ServerRunner:
         when we want to shutdown the server.
 
     port
-        The port to serve on
+        The port to serve on. If this is a string then we treat it as the path
+        to a unix socket and serve on that instead
 
     server
         An object with a ``serve(host, port, *args, **kwargs)`` method. This
@@ -375,6 +436,12 @@ class ServerRunner:
         self.final_future = final_future
         self.setup(*args, **kwargs)
 
+    @property
+    def unix_socket(self):
+        """The path to the unix socket we serve on or None if we serve on a TCP port"""
+        if isinstance(self.port, str):
+            return self.port
+
     def setup(self, *args, **kwargs):
         """
         Used to take in extra ``*args`` and ``**kwargs`` passed into ``__init__``.
@@ -432,10 +499,13 @@ class ServerRunner:
         await self.before_start()
 
         async def doit():
+            host, port, kwargs = "127.0.0.1", self.port, self.server_kwargs
+            if self.unix_socket:
+                host, port = None, None
+                kwargs = {**kwargs, "listeners": [UnixListener(self.unix_socket)]}
+
             with self.wrapper:
-                await self.server.serve(
-                    "127.0.0.1", self.port, *self.server_args, **self.server_kwargs
-                )
+                await self.server.serve(host, port, *self.server_args, **kwargs)
 
         assert not port_connected(self.port)
         self.t = async_as_background(doit())
@@ -475,22 +545,61 @@ class ServerRunner:
         """Hook to return the path to the websocket handler on the server"""
         return "/v1/ws"
 
+    @property
+    def netloc(self):
+        """The host and port used in urls to the server"""
+        if self.unix_socket:
+            return "localhost"
+        return f"127.0.0.1:{self.port}"
+
     def ws_url(self, path=None):
         """
         Hook to return the websocket address to our websocket handler
 
         .. code-block:: python
 
-            f"ws://127.0.0.1:{self.port}{self.ws_path}"
+            f"ws://{self.netloc}{self.ws_path}"
         """
-        return f"ws://127.0.0.1:{self.port}{path or self.ws_path}"
+        return f"ws://{self.netloc}{path or self.ws_path}"
 
-    async def ws_connect(self, skip_hook=False, path=None):
+    def http_client(self):
+        """
+        Return the AsyncHTTPClient used to talk to the server.
+
+        If we are serving on a unix socket then the client resolves to that socket
+        """
+        if self.unix_socket:
+            return AsyncHTTPClient(
+                force_instance=True, resolver=UnixResolver(socket_path=self.unix_socket)
+            )
+        return AsyncHTTPClient()
+
+    async def ws_connect(
+        self, skip_hook=False, path=None, subprotocols=None, compression_options=None
+    ):
         """
         Create a connection to our ``self.ws_url``, call the ``after_ws_open``
         hook with the connection and return the connection.
+
+        ``subprotocols`` is a list of subprotocols to ask the server for and
+        ``compression_options`` turns on compression if it isn't None.
         """
-        connection = await websocket_connect(self.ws_url(path))
+        if self.unix_socket:
+            request = HTTPRequest(self.ws_url(path), connect_timeout=20, request_timeout=20)
+            connection = await ResolvingWebSocketClientConnection(
+                request,
+                UnixResolver(socket_path=self.unix_socket),
+                subprotocols=subprotocols,
+                compression_options=compression_options,
+                # The default websocket_connect gives the connection
+                max_message_size=10 * 1024 * 1024,
+            ).connect_future
+        else:
+            connection = await websocket_connect(
+                self.ws_url(path),
+                subprotocols=subprotocols,
+                compression_options=compression_options,
+            )
 
         if not skip_hook:
             await self.after_ws_open(connection)
@@ -596,14 +705,16 @@ class ServerRunner:
         text_output
             If not None then assert the response body equals ``text_output``
         """
-        client = AsyncHTTPClient()
+        client = self.http_client()
 
         if "raise_error" not in kwargs:
             kwargs["raise_error"] = False
 
-        response = await client.fetch(
-            f"http://127.0.0.1:{self.port}{path}", method=method, **kwargs
-        )
+        try:
+            response = await client.fetch(f"http://{self.netloc}{path}", method=method, **kwargs)
+        finally:
+            if self.unix_socket:
+                client.close()
 
         output = response.body
         test.assertEqual(response.code, status, output)
@@ -0,0 +1,143 @@
+"""
+Checking the arguments of store commands with specs made once.
+
+A ``dictobj`` ``FieldSpec`` makes a spec for every field each time it is used
+and then goes through every spec in the chain for each field. When a command is
+registered the store instead makes a ``CompiledFieldSpec``. The first time it is
+used this makes the specs and checks fields that use simple specs like
+``sb.string_spec``, ``sb.integer_spec`` or ``sb.boolean``, optionally with a
+default, ``required`` or ``nullable``, with a plain type check.
+
+Other fields, like injected ones, and values that don't pass the type check are
+normalised once by the spec for that field. Errors are collected the same way
+``FieldSpec`` does, so they are the same as they have always been.
+
+Give ``compiled=False`` to ``store.command`` to use the ``FieldSpec`` as is.
+
+.. autoclass:: CompiledFieldSpec
+"""
+from delfick_project.norms import sb, BadSpec, BadSpecValue, Meta
+
+# Returned by a check when the value has to be given to the spec for the field
+Slow = object()
+
+# Specs that return values of these exact types as they are
+passthrough = {
+    sb.string_spec: (str,),
+    sb.boolean: (bool,),
+    sb.integer_spec: (int,),
+    sb.float_spec: (float,),
+    sb.dictionary_spec: (dict,),
+    sb.none_spec: (type(None),),
+}
+
+
+def check_required(spec, inner):
+    return lambda val: Slow if val is sb.NotSpecified else inner(val)
+
+
+def check_defaulted(spec, inner):
+    dflt = spec.default(None)
+    return lambda val: dflt if val is sb.NotSpecified else inner(val)
+
+
+def check_nullable(spec, inner):
+    return lambda val: None if val is None else inner(val)
+
+
+def wrapped(spec):
+    """Return ``(check maker, inner spec)`` for the specs we can see through"""
+    kls = type(spec)
+    if kls is sb.required:
+        return check_required, spec.spec
+    elif kls is sb.defaulted:
+        return check_defaulted, spec.spec
+    elif kls is sb.or_spec and len(spec.specs) == 2 and type(spec.specs[0]) is sb.none_spec:
+        # What dictobj.NullableField makes
+        return check_nullable, spec.specs[1]
+    return None, None
+
+
+def compile_field(spec):
+    """
+    Return a function that returns what ``spec`` makes of a value or ``Slow``
+    if only the spec can say. Or return None if the spec has to be used for
+    every value.
+    """
+    if type(spec) is sb.any_spec:
+        return lambda val: val
+
+    maker, inner_spec = wrapped(spec)
+    if maker is not None:
+        inner = compile_field(inner_spec)
+        return None if inner is None else maker(spec, inner)
+
+    types = passthrough.get(type(spec))
+    if types is None:
+        return None
+    return lambda val: val if type(val) in types else Slow
+
+
+class CompiledFieldSpec:
+    """
+    Normalises a dictionary into an instance of a ``dictobj.Spec`` class like
+    ``kls.FieldSpec(formatter=formatter)`` does.
+    """
+
+    def __init__(self, kls, formatter=None):
+        self.kls = kls
+        self.formatter = formatter
+        self.field_spec = kls.FieldSpec(formatter=formatter)
+
+        self.spec = None
+        self.checks = None
+
+    def compile(self):
+        """Make the spec and the checks for each field if we haven't yet"""
+        if self.spec is None:
+            spec = self.field_spec.make_spec(Meta.empty())
+            if not spec.validators:
+                self.checks = [
+                    (name, field_spec, compile_field(field_spec))
+                    for name, field_spec in spec.expected.items()
+                ]
+            self.spec = spec
+        return self.spec
+
+    def normalise(self, meta, val):
+        try:
+            spec = self.compile()
+        except Exception:
+            # Field specs can be made lazily and so may not work until later.
+            # Either way the FieldSpec complains like it always has
+            return self.field_spec.normalise(meta, val)
+
+        if self.checks is None or type(val) is not dict:
+            return spec.normalise(meta, val)
+
+        return spec.kls(**self.values(meta, val))
+
+    def values(self, meta, val):
+        values = {}
+        errors = []
+
+        for name, field_spec, check in self.checks:
+            nxt = val.get(name, sb.NotSpecified)
+            if check is not None:
+                result = check(nxt)
+                if result is not Slow:
+                    values[name] = result
+                    continue
+
+            try:
+                values[name] = field_spec.normalise(meta.at(name), nxt)
+            except BadSpec as error:
+                errors.append(error)
+
+        if errors:
+            raise BadSpecValue(meta=meta, _errors=errors)
+
+        return values
+
+    def empty_normalise(self, **kwargs):
+        return self.normalise(Meta.empty(), kwargs)